@@ -0,0 +1,50 @@
+import sys
+import importlib
+
+# Subcommands: (module, entry function, summary). A command's module is imported only when it runs,
+# so provider SDKs, pandas and torch are loaded only by the commands that use them.
+COMMANDS = {
+    "generate": ("generate_async", "main", "Score a JSONLines file with the educational template on Vertex AI."),
+    "generate-linguistic": ("generate_async_linguistic", "main", "Score a JSONLines file with the linguistic template on Vertex AI."),
+    "generate-generic": ("generic_generate_async", "main", "Run any template file (e.g. template_ner.txt) over a JSONLines file on Vertex AI."),
+    "cascade": ("cascade_generate_async", "main", "Score with the local classifier and send only uncertain lines to Vertex AI."),
+    "plan": ("plan_run", "main", "Estimate requests, tokens, cost and wall time for a run."),
+    "classify": ("run_single_file", "cli", "Score a JSONLines file with the local classifier."),
+    "convert": ("convert_jsonlines_formatted", "main", "Convert generator output to text/metadata/prompt/score records."),
+    "to-parquet": ("convert_jsonl_to_parquet", "main", "Shuffle a JSONLines file into Parquet shards."),
+    "training-set": ("make_training_set", "main", "Split processed files into shuffled, stratified train and validation sets."),
+    "report": ("score_report", "main", "Report score distributions per language and source for processed JSONL or Parquet files."),
+    "batch-submit": ("submit_batch_job", "main", "Submit a Vertex AI batch prediction job."),
+    "batch-status": ("check_batch_status", "main", "Check the status of a batch prediction job."),
+    "batch-fetch": ("fetch_batch_predictions", "main", "Stream the JSONL predictions of a batch job from Cloud Storage into an output file."),
+    "batch-example": ("fetch_example_result", "main", "Fetch an example result from a BigQuery output table."),
+    "single-vertex": ("singleline_vertex", "main", "Score line by line on Vertex AI, resuming from the output file."),
+    "single-gemini": ("singleline_googleapi", "main", "Score line by line with the Gemini API (GEMINI_API_KEY)."),
+    "single-groq": ("singleline_groq", "main", "Score with an OpenAI-compatible chat API (Groq by default)."),
+    "generate-single": ("generate_single", "main", "Print Gemini API responses for a JSONLines file (GEMINI_API_KEY)."),
+}
+
+def usage():
+    width = max(len(name) for name in COMMANDS)
+    lines = ["usage: askllm <command> [options]", "", "commands:"]
+    lines += [f"  {name:<{width}}  {summary}" for name, (_, _, summary) in COMMANDS.items()]
+    lines += ["", "Run askllm <command> --help for the options of a command."]
+    return "\n".join(lines)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return
+    command = argv[0]
+    if command not in COMMANDS:
+        print(f"askllm: unknown command '{command}'\n\n{usage()}", file=sys.stderr)
+        sys.exit(2)
+    module_name, entry, _ = COMMANDS[command]
+    module = importlib.import_module(module_name)
+    # Every command parses sys.argv itself; argparse takes the program name from argv[0]
+    sys.argv = [f"askllm {command}"] + argv[1:]
+    getattr(module, entry)()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import random
+import asyncio
+import logging
+import argparse
+from argparse import Namespace
+from tqdm import tqdm
+import generate_async
+from endpoint_pool import EndpointPool
+from hedging import Hedger
+from loop_tools import client_session
+from profiler import PROFILER, profile_prefix
+from jsonl_io import COMPRESS_CHOICES, count_complete_lines, open_jsonl, output_path, strip_compression
+from columnar_input import count_records
+from generate_async import PROJECT_ID, LOCATION, ENDPOINT_TEMPLATE, BATCH_SIZE, WAIT_TIME, get_auth_token, process_batch
+
+# Values written to the score_source column
+SOURCE_CLASSIFIER = "classifier"
+SOURCE_LLM = "llm"
+SOURCE_CALIBRATION = "llm_calibration"
+SOURCE_FALLBACK = "classifier_fallback"
+
+def score_locally(args, classifier_file):
+    # Imported here so the LLM stage can run without torch once the classifier output exists
+    import run_single_file
+    run_single_file.main(Namespace(
+        model_name=args.classifier_model,
+        input_file=args.jsonl_file,
+        output_file=classifier_file,
+        text_column=args.text_column,
+        max_length=args.classifier_max_length,
+        batch_size=args.classifier_batch_size,
+        compress_level=args.compress_level,
+        # The LLM stage reads the text back from this output, so it is kept even for Parquet and Arrow inputs
+        sidecar=False,
+    ))
+
+def route(score, low, high, rng, calibration_rate):
+    if low <= score <= high:
+        return SOURCE_LLM
+    if rng.random() < calibration_rate:
+        return SOURCE_CALIBRATION
+    return SOURCE_CLASSIFIER
+
+async def score_with_llm(batch, endpoints, language, total_words, wait_rate_limit):
+    retry_limit = 5
+    for attempt in range(retry_limit + 1):
+        get_auth_token()  # Refresh the token before processing each batch
+        async with client_session(generate_async.request_timeout) as session:
+            success, total_words, processed_batch = await process_batch(session, batch.copy(), endpoints, language, total_words)
+        if success:
+            return processed_batch, total_words
+        if attempt < retry_limit:
+            logging.warning(f"Retrying LLM batch due to rate limit (attempt {attempt + 1}).")
+            await asyncio.sleep(wait_rate_limit)
+    logging.error(f"LLM batch failed after {retry_limit} attempts. Keeping classifier scores.")
+    return batch, total_words
+
+def finalize(pending, scored):
+    import pandas as pd
+
+    for idx, row in pending.iterrows():
+        if row['score_source'] == SOURCE_CLASSIFIER:
+            pending.loc[idx, 'educational score'] = row['int_score']
+            continue
+        llm_score = scored.loc[idx].get('educational score') if idx in scored.index else None
+        if llm_score is None or pd.isna(llm_score):
+            # The LLM request failed, so the classifier score is all we have
+            pending.loc[idx, 'educational score'] = row['int_score']
+            pending.loc[idx, 'score_source'] = SOURCE_FALLBACK
+        else:
+            pending.loc[idx, 'educational score'] = llm_score
+            pending.loc[idx, 'reason'] = scored.loc[idx].get('reason')
+    return pending
+
+async def process_cascade(args):
+    # Imported here so --help and askllm start without loading pandas
+    import pandas as pd
+
+    PROFILER.watch_loop()
+    classifier_file = args.classifier_output or output_path(f"{strip_compression(args.output_jsonl_file)}.classifier.jsonl", [args.jsonl_file], args.compress)
+    # A classifier output cut short by a killed run is resumed rather than read as if complete
+    total_lines = count_records(args.jsonl_file)
+    scored_lines = count_complete_lines(classifier_file)
+    if scored_lines > total_lines:
+        raise ValueError(f"{classifier_file} has {scored_lines} lines but {args.jsonl_file} has {total_lines}; it is not the classifier output of this input.")
+    if scored_lines < total_lines:
+        logging.info(f"Scoring {args.jsonl_file} with the local classifier into {classifier_file} ({scored_lines} of {total_lines} lines done)...")
+        score_locally(args, classifier_file)
+
+    with PROFILER.stage("read"):
+        df = pd.read_json(classifier_file, lines=True)
+    logging.info(f"Loaded {len(df)} classifier-scored lines from {classifier_file}.")
+
+    rng = random.Random(args.seed)
+    df['score_source'] = [route(score, args.low, args.high, rng, args.calibration_rate) for score in df['score']]
+    counts = df['score_source'].value_counts().to_dict()
+    num_llm = counts.get(SOURCE_LLM, 0) + counts.get(SOURCE_CALIBRATION, 0)
+    logging.info(f"Routing: {counts}. {num_llm} of {len(df)} lines ({num_llm / max(len(df), 1):.1%}) go to the LLM.")
+
+    if args.dryrun:
+        return
+
+    generate_async.load_templates()
+    generate_async.request_timeout = args.request_timeout or None
+    generate_async.hedger = Hedger(args.hedge_budget) if args.hedge_budget else None
+    endpoints = EndpointPool.from_args(args.endpoints_file, PROJECT_ID, LOCATION, args.model_id, ENDPOINT_TEMPLATE)
+    total_words = 0
+
+    # Lines are written in input order; a window is flushed whenever it holds BATCH_SIZE LLM lines
+    with open_jsonl(args.output_jsonl_file, 'w', level=args.compress_level) as writer:
+        with tqdm(total=len(df), desc="Processing lines") as pbar:
+            window_start = 0
+            llm_positions = [i for i, source in enumerate(df['score_source']) if source != SOURCE_CLASSIFIER]
+            for start in range(0, len(llm_positions) + 1, BATCH_SIZE):
+                chunk = llm_positions[start:start + BATCH_SIZE]
+                window_end = chunk[-1] + 1 if start + BATCH_SIZE < len(llm_positions) else len(df)
+                pending = df[window_start:window_end].copy()
+                llm_batch = pending[pending['score_source'] != SOURCE_CLASSIFIER]
+                scored = llm_batch
+                if len(llm_batch):
+                    scored, total_words = await score_with_llm(llm_batch, endpoints, args.language, total_words, args.wait_rate_limit)
+                with PROFILER.stage("write"):
+                    writer.write_all(finalize(pending, scored).to_dict(orient='records'))
+                pbar.update(len(pending))
+                window_start = window_end
+                if window_end >= len(df):
+                    break
+                if len(llm_batch):
+                    logging.info(f"{len(llm_batch)} LLM lines done. Waiting {WAIT_TIME} seconds before next batch.")
+                    with PROFILER.stage("pacing"):
+                        await asyncio.sleep(WAIT_TIME)
+
+    logging.info(f"Total words processed (input + output): {total_words}")
+    PROFILER.report()
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a JSONLines file with the local classifier and send only uncertain lines to the Vertex AI API.")
+    parser.add_argument('--jsonl_file', type=str, required=True, help='Path to the JSONLines file.')
+    parser.add_argument('--output_jsonl_file', type=str, required=True, help='Path to the output JSONLines file.')
+    parser.add_argument('--classifier_output', type=str, help='run_single_file.py output to reuse, completed first if it is cut short (default: <output_jsonl_file>.classifier.jsonl, created if missing).')
+    parser.add_argument('--language', type=str, choices=['en', 'sv', 'da', 'nb', 'nn'], default='en', help='Language for the prompt (default: en).')
+    parser.add_argument('--low', type=float, default=2.0, help='Lower bound of the classifier score band sent to the LLM (default: 2.0).')
+    parser.add_argument('--high', type=float, default=3.5, help='Upper bound of the classifier score band sent to the LLM (default: 3.5).')
+    parser.add_argument('--calibration_rate', type=float, default=0.01, help='Fraction of lines outside the band also sent to the LLM for calibration (default: 0.01).')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for the calibration sample (default: 42).')
+    parser.add_argument('--classifier_model', type=str, default='north/scandinavian_education_classifier_bert', help='Local classifier model.')
+    parser.add_argument('--text_column', type=str, default='text', help='Text field used by the local classifier (default: text).')
+    parser.add_argument('--classifier_max_length', type=int, default=512, help='Maximum sequence length for the local classifier (default: 512).')
+    parser.add_argument('--classifier_batch_size', type=int, default=1024, help='Batch size for the local classifier (default: 1024).')
+    parser.add_argument('--wait_rate_limit', type=int, default=300, help='Wait in seconds before retrying after hitting rate limit (default: 300 seconds).')
+    parser.add_argument('--endpoints_file', type=str, help='JSON list of {"project_id", "location", "rpm"} endpoints to load-balance over (default: the built-in project and region).')
+    parser.add_argument('--request_timeout', type=float, default=120, help='Deadline in seconds for each LLM request, 0 for none (default: 120).')
+    parser.add_argument('--hedge_budget', type=float, default=0, help='Send a duplicate of LLM requests slower than the observed p95 latency, for at most this fraction of requests (default: 0, off).')
+    parser.add_argument('--dryrun', action='store_true', help='Only report how many lines would go to the LLM.')
+    parser.add_argument('--model_id', type=str, default='gemini-1.5-flash-001', help='Model ID to use for the API.')
+    parser.add_argument('--compress', type=str, choices=COMPRESS_CHOICES, default='auto', help='Compress the output as .zst or .gz, or not at all; auto picks .zst when the input is compressed or at least 1 GB (default: auto). Output names ending in .gz or .zst are always compressed.')
+    parser.add_argument('--compress_level', type=int, help='zstd or gzip level for compressed output (default: 3 for zstd, 6 for gzip).')
+    parser.add_argument('--profile', action='store_true', help='Time the classifier and LLM stages and write <output_jsonl_file>.profile.txt and a Chrome trace (<output_jsonl_file>.profile.trace.json).')
+    parser.add_argument('--profile_sample', action='store_true', help='With --profile, also sample the main thread\'s stacks to <output_jsonl_file>.profile.samples.txt.')
+
+    args = parser.parse_args()
+    args.output_jsonl_file = output_path(args.output_jsonl_file, [args.jsonl_file], args.compress)
+
+    if args.profile:
+        PROFILER.enable(profile_prefix(args.output_jsonl_file), args.profile_sample)
+    asyncio.run(process_cascade(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,6 @@
 import argparse
 import logging
 import json
-import google.auth
-import google.auth.transport.requests
 import requests
 
 # Configure logging
@@ -11,6 +9,10 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 def check_batch_prediction_job_status(project_id, location, job_id):
     ENDPOINT = f"https://{location}-aiplatform.googleapis.com/v1/projects/{project_id}/locations/{location}/batchPredictionJobs/{job_id}"
     
+    # Imported here so --help works without the Google libraries installed
+    import google.auth
+    import google.auth.transport.requests
+
     credentials, _ = google.auth.default()
     credentials.refresh(google.auth.transport.requests.Request())
     auth_token = credentials.token
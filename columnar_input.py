@@ -0,0 +1,123 @@
+from itertools import islice
+from jsonl_io import count_lines, is_jsonl, open_jsonl
+
+# Inputs read with pyarrow; .arrow covers Arrow IPC files as well as the stream files in Hugging Face dataset caches
+COLUMNAR_SUFFIXES = (".parquet", ".arrow", ".feather")
+# Columns the templates and the classifier read the document from
+TEXT_FIELDS = ["text", "content"]
+# Identifier columns carried into the output, so it can be joined on them as well as on the row index
+ID_FIELDS = ["id"]
+# Row index written into every line of the output of a Parquet or Arrow input
+ROW_FIELD = "row"
+# Rows per record batch read from a Parquet row group
+BATCH_ROWS = 1 << 16
+
+def is_columnar(path):
+    return path.endswith(COLUMNAR_SUFFIXES)
+
+def is_input(path):
+    return is_jsonl(path) or is_columnar(path)
+
+def open_arrow(path):
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+
+    source = pa.memory_map(path, 'r')
+    try:
+        return ipc.open_file(source)
+    except pa.ArrowInvalid:
+        # Hugging Face dataset caches are Arrow streams rather than files
+        source.seek(0)
+        return ipc.open_stream(source)
+
+def arrow_schema(path):
+    # Imported here so JSONL inputs need no pyarrow
+    import pyarrow.parquet as pq
+
+    if path.endswith(".parquet"):
+        return pq.ParquetFile(path).schema_arrow
+    return open_arrow(path).schema
+
+def input_columns(path, columns=TEXT_FIELDS, extra=()):
+    # The text columns the file has, plus its id and any extra fields (e.g. --language_field); nothing else is decoded
+    names = arrow_schema(path).names
+    if not any(column in names for column in columns):
+        raise ValueError(f"{path} has none of the columns {', '.join(columns)}.")
+    return [column for column in dict.fromkeys(list(columns) + ID_FIELDS + [field for field in extra if field]) if column in names]
+
+def record_batches(path, columns, start=0):
+    # Yields (row index of the first row, record batch) with only the given columns, from row start on.
+    # Parquet row groups before start are skipped without being read.
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+
+    row = 0
+    if path.endswith(".parquet"):
+        parquet_file = pq.ParquetFile(path)
+        for group in range(parquet_file.num_row_groups):
+            rows = parquet_file.metadata.row_group(group).num_rows
+            if row + rows <= start:
+                row += rows
+                continue
+            for batch in parquet_file.iter_batches(batch_size=BATCH_ROWS, row_groups=[group], columns=columns):
+                if row + batch.num_rows > start:
+                    skip = max(0, start - row)
+                    yield row + skip, batch.slice(skip)
+                row += batch.num_rows
+        return
+    reader = open_arrow(path)
+    batches = (reader.get_batch(i) for i in range(reader.num_record_batches)) if isinstance(reader, ipc.RecordBatchFileReader) else reader
+    for batch in batches:
+        if row + batch.num_rows > start:
+            skip = max(0, start - row)
+            yield row + skip, batch.select(columns).slice(skip)
+        row += batch.num_rows
+
+def count_records(path):
+    # Lines of a JSONL file, rows of a Parquet (from its footer) or Arrow file
+    if not is_columnar(path):
+        return count_lines(path)
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(path).metadata.num_rows
+    return sum(batch.num_rows for _, batch in record_batches(path, []))
+
+def iter_records(path, columns=TEXT_FIELDS, start=0, end=None):
+    # Records from line or row start up to end: whole JSONL lines, or the given columns and id of a
+    # Parquet or Arrow file with the row index under ROW_FIELD
+    if not is_columnar(path):
+        with open_jsonl(path) as reader:
+            yield from islice(reader, start, end)
+        return
+    for first, batch in record_batches(path, input_columns(path, columns), start):
+        for row, record in enumerate(batch.to_pylist(), first):
+            if end is not None and row >= end:
+                return
+            yield {ROW_FIELD: row, **record}
+
+def read_frame(path, columns=TEXT_FIELDS, extra=()):
+    # The DataFrame the generators work on: a JSONL file as before, or the given columns and id of a Parquet or
+    # Arrow file, read row group by row group, with the row index as a column and as the frame's index
+    import pandas as pd
+
+    if not is_columnar(path):
+        # pandas decompresses .gz and .zst inputs by their suffix
+        return pd.read_json(path, lines=True)
+    import pyarrow as pa
+
+    columns = input_columns(path, columns, extra)
+    batches = [batch for _, batch in record_batches(path, columns)]
+    table = pa.Table.from_batches(batches) if batches else arrow_schema(path).empty_table().select(columns)
+    frame = table.to_pandas()
+    frame.insert(0, ROW_FIELD, frame.index)
+    return frame
+
+def output_records(frame, sidecar=False):
+    # Outputs of Parquet and Arrow inputs are sidecars: the results with the row index and id, without the text
+    if sidecar:
+        frame = frame.drop(columns=TEXT_FIELDS, errors='ignore')
+    return frame.to_dict(orient='records')
+
+def without_text(record, columns=TEXT_FIELDS):
+    return {field: value for field, value in record.items() if field not in columns}
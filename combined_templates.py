@@ -0,0 +1,55 @@
+import os
+import json
+from collections import Counter
+from response_schema import derive_schema, template_path
+
+# Task names for the scoring templates; other files are named after their file name
+TASK_NAMES = {
+    "template.json": "educational",
+    "template_linguistic.json": "linguistic",
+}
+
+# Framing of the combined prompt. The document is included once and each task refers back to it.
+COMBINED_INTRO = "Below is a document followed by {count} separate evaluation tasks. Carry out each task independently on the same document.\n\nThe document:\n{{content}}\n"
+DOCUMENT_REFERENCE = "[the document above]"
+TASK_HEADER = "\n\nTask \"{name}\":\n\n"
+TASK_RENAME = "\nIn the combined answer, call the field \"{field}\" of this task \"{column}\"."
+COMBINED_OUTPUT = "\n\nAnswer with a single JSON object holding the fields of all tasks: {columns}."
+
+def task_name(template_file):
+    filename = os.path.basename(template_file)
+    return TASK_NAMES.get(filename, os.path.splitext(filename)[0].replace("template_", ""))
+
+def combine_templates(template_files):
+    # Returns ({language: template}, {language: schema}) for the languages all files share.
+    # Fields asked for by more than one task (such as "reason") are prefixed with the task name;
+    # all other fields keep their name, so the score columns are the same as in separate runs.
+    loaded = []
+    for template_file in template_files:
+        with open(template_path(template_file), 'r') as f:
+            loaded.append((task_name(template_file), json.load(f)))
+    languages = [language for language in loaded[0][1] if all(language in templates for _, templates in loaded)]
+
+    combined_templates, combined_schemas = {}, {}
+    for language in languages:
+        schemas = [(name, derive_schema(templates[language])) for name, templates in loaded]
+        for name, schema in schemas:
+            if schema is None:
+                raise ValueError(f"Template '{name}' ({language}) asks for no known response fields and cannot be combined.")
+        shared = Counter(field for _, schema in schemas for field in schema["properties"])
+
+        prompt = COMBINED_INTRO.format(count=len(loaded))
+        properties, required = {}, []
+        for (name, templates), (_, schema) in zip(loaded, schemas):
+            prompt += TASK_HEADER.format(name=name) + templates[language].replace("{content}", DOCUMENT_REFERENCE)
+            for field, spec in schema["properties"].items():
+                column = f"{name} {field}" if shared[field] > 1 else field
+                if column != field:
+                    prompt += TASK_RENAME.format(field=field, column=column)
+                properties[column] = spec
+                required.append(column)
+        prompt += COMBINED_OUTPUT.format(columns=", ".join(f'"{column}"' for column in required))
+
+        combined_templates[language] = prompt
+        combined_schemas[language] = {"type": "OBJECT", "properties": properties, "required": required}
+    return combined_templates, combined_schemas
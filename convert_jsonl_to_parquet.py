@@ -1,38 +1,166 @@
 import os
 import json
+import math
+import random
 import argparse
-import pandas as pd
-import numpy as np
+import logging
+import tempfile
+from profiler import PROFILER, profile_prefix
+from jsonl_io import data_size, loads, open_file, orjson
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def convert_metadata_to_string(row):
-    return json.dumps(row) if isinstance(row, dict) else str(row)
+    if row is None:
+        return None
+    if isinstance(row, dict):
+        return orjson.dumps(row).decode('utf-8') if orjson else json.dumps(row)
+    return str(row)
+
+def scatter_to_buckets(lines, bucket_dir, num_buckets, rng):
+    # First pass: send every line to a random bucket file so each bucket fits in memory
+    buckets = [open(os.path.join(bucket_dir, f"bucket-{i:05d}.jsonl"), 'wb') for i in range(num_buckets)]
+    num_rows = 0
+    try:
+        for line in lines:
+            if not line.strip():
+                continue
+            buckets[rng.randrange(num_buckets)].write(line if line.endswith(b'\n') else line + b'\n')
+            num_rows += 1
+    finally:
+        for bucket in buckets:
+            bucket.close()
+    return [bucket.name for bucket in buckets], num_rows
+
+def iter_shuffled_rows(bucket_files, rng):
+    # Second pass: shuffle each bucket in memory; buckets are visited in random order
+    for bucket_file in rng.sample(bucket_files, len(bucket_files)):
+        with open(bucket_file, 'rb') as f:
+            lines = f.readlines()
+        os.remove(bucket_file)
+        rng.shuffle(lines)
+        yield from lines
+
+def rows_to_table(lines, metadata_fields=None):
+    # pyarrow is imported where it is used, so make_training_set.py can reuse the shuffle for JSONL without it
+    import pyarrow as pa
+
+    records = [loads(line) for line in lines]
+    # Metadata is serialised per record; the row group is then converted to Arrow in a single call
+    for record in records:
+        if 'metadata' in record:
+            metadata = record['metadata']
+            if metadata_fields is not None and isinstance(metadata, dict):
+                # Older conversions kept the whole record, text included, in metadata
+                metadata = {field: metadata[field] for field in metadata_fields if field in metadata}
+            record['metadata'] = convert_metadata_to_string(metadata)
+    # from_pylist would take the columns from the first record only; a struct array has every field any record has
+    return pa.Table.from_struct_array(pa.array(records))
+
+def conform(table, schema):
+    # Casts a table to the unified schema; fields it lacks are filled with nulls
+    import pyarrow as pa
 
-def split_jsonl_to_parquet(input_file, output_dir, num_parts=8):
+    columns = [table.column(field.name).cast(field.type) if field.name in table.column_names else pa.nulls(table.num_rows, field.type) for field in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+def rewrite_shard(path, schema, row_group_size):
+    # Rewrites a shard written before a later row group widened the schema, and leaves it open for more rows;
+    # this reads the whole shard back into memory
+    import pyarrow.parquet as pq
+
+    table = conform(pq.read_table(path), schema)
+    writer = pq.ParquetWriter(path, schema)
+    writer.write_table(table, row_group_size=row_group_size)
+    return writer
+
+def split_jsonl_to_parquet(input_file, output_dir, num_parts=8, target_shard_size_mb=None, seed=None, bucket_size_mb=256, row_group_size=10000, metadata_fields=None):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    
-    # Read the JSONLines file into a DataFrame
-    df = pd.read_json(input_file, lines=True)
-    
-    # Shuffle the DataFrame
-    df = df.sample(frac=1).reset_index(drop=True)
-    
-    # Convert metadata column to string
-    if 'metadata' in df.columns:
-        df['metadata'] = df['metadata'].apply(convert_metadata_to_string)
-    
-    # Split the DataFrame into parts
-    splits = np.array_split(df, num_parts)
-    
-    # Write each part to a Parquet file
-    for i, split_df in enumerate(splits):
-        output_file = os.path.join(output_dir, f'train-00000-{i:02x}-00008.parquet')
-        split_df.to_parquet(output_file, index=False)
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Convert a JSONLines file into multiple Parquet files.")
+    input_bytes = data_size(input_file)
+    if target_shard_size_mb:
+        # Shard size is measured on the JSONL input; Parquet output is usually smaller
+        num_parts = max(1, math.ceil(input_bytes / (target_shard_size_mb * 1024 * 1024)))
+    num_buckets = max(1, math.ceil(input_bytes / (bucket_size_mb * 1024 * 1024)))
+    rng = random.Random(seed)
+
+    with tempfile.TemporaryDirectory(dir=output_dir) as bucket_dir:
+        with PROFILER.stage("scatter"), open_file(input_file, 'rb') as f:
+            bucket_files, num_rows = scatter_to_buckets(f, bucket_dir, num_buckets, rng)
+        write_parquet_shards(PROFILER.timed("shuffle", iter_shuffled_rows(bucket_files, rng)), num_rows, output_dir, num_parts, row_group_size, metadata_fields=metadata_fields)
+
+def write_parquet_shards(lines, num_rows, output_dir, num_parts, row_group_size, split='train', metadata_fields=None, shards=None):
+    # shards maps the path of every shard written so far to its schema; pass the same dict for several
+    # splits to give them all the same schema
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    num_parts = max(1, min(num_parts, num_rows))
+    part_sizes = [num_rows // num_parts + (1 if i < num_rows % num_parts else 0) for i in range(num_parts)]
+
+    shards = {} if shards is None else shards
+    schema = pa.unify_schemas(list(shards.values()), promote_options='permissive') if shards else None
+    writer = None
+    part = 0
+    part_rows = 0
+    pending = []
+
+    def flush():
+        nonlocal schema, writer
+        # Every row group's schema is unified with those before it: a field that is null so far takes the type
+        # of its first value, fields first seen later are added, and the row group is cast to the result
+        with PROFILER.stage("parse"):
+            table = rows_to_table(pending, metadata_fields)
+            schema = table.schema if schema is None else pa.unify_schemas([schema, table.schema], promote_options='permissive')
+            table = conform(table, schema)
+        path = os.path.join(output_dir, f'{split}-{part:05d}-of-{num_parts:05d}.parquet')
+        if writer is None:
+            writer = pq.ParquetWriter(path, schema)
+        elif writer.schema != schema:
+            writer.close()
+            writer = rewrite_shard(path, schema, row_group_size)
+        with PROFILER.stage("write"):
+            writer.write_table(table, row_group_size=row_group_size)
+        shards[path] = schema
+        pending.clear()
+
+    for line in lines:
+        pending.append(line)
+        part_rows += 1
+        if len(pending) == row_group_size or part_rows == part_sizes[part]:
+            flush()
+        if part_rows == part_sizes[part]:
+            writer.close()
+            writer = None
+            part += 1
+            part_rows = 0
+
+    # Shards closed before the schema last widened are rewritten with the final one
+    for path, shard_schema in shards.items():
+        if shard_schema != schema:
+            rewrite_shard(path, schema, row_group_size).close()
+            shards[path] = schema
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a JSONLines file into multiple shuffled Parquet files. A field that first appears, or first has a non-null value, after a shard was written makes that shard be read back and rewritten with the wider schema.")
     parser.add_argument('--input_file', type=str, required=True, help='Input JSONLines file.')
     parser.add_argument('--output_dir', type=str, required=True, help='Directory to save the Parquet files.')
+    parser.add_argument('--num_parts', type=int, default=8, help='Number of Parquet shards (default: 8).')
+    parser.add_argument('--target_shard_size_mb', type=float, help='Target shard size in MB of JSONL input; overrides --num_parts.')
+    parser.add_argument('--seed', type=int, help='Seed for the shuffle (default: random).')
+    parser.add_argument('--bucket_size_mb', type=float, default=256, help='Approximate size of each in-memory shuffle bucket in MB (default: 256).')
+    parser.add_argument('--row_group_size', type=int, default=10000, help='Rows per Parquet row group (default: 10000).')
+    parser.add_argument('--metadata_fields', type=str, nargs='*', help='Keep only these fields of metadata; give none to leave it empty (default: all of it).')
+    parser.add_argument('--profile', action='store_true', help='Time the scatter, shuffle, parse and write stages and write <output_dir>.profile.txt and a Chrome trace (<output_dir>.profile.trace.json).')
+    parser.add_argument('--profile_sample', action='store_true', help='With --profile, also sample stacks to <output_dir>.profile.samples.txt.')
     args = parser.parse_args()
-    
-    split_jsonl_to_parquet(args.input_file, args.output_dir)
+
+    if args.profile:
+        PROFILER.enable(profile_prefix(args.output_dir), args.profile_sample)
+    split_jsonl_to_parquet(args.input_file, args.output_dir, args.num_parts, args.target_shard_size_mb, args.seed, args.bucket_size_mb, args.row_group_size, args.metadata_fields)
+    PROFILER.report()
+
+if __name__ == "__main__":
+    main()
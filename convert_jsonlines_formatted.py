@@ -0,0 +1,191 @@
+import os
+import json
+import math
+import argparse
+import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from profiler import PROFILER, enable_worker, profile_prefix
+from jsonl_io import COMPRESS_CHOICES, is_jsonl, loads, open_file, orjson, output_path, strip_compression
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Field mappings for the outputs of the different generators. score_fields are further scores written as their own
+# integer columns next to score; metadata_fields, when set, is the whitelist of fields kept in metadata.
+SPECS = {
+    "clean": {"text_field": "text", "score_field": "cleanliness score", "score_fields": ["trimmed cleanliness score"]},
+    "edu": {"text_field": "content", "score_field": "educational score", "score_fields": []},
+}
+
+# Fields the generators write besides the scores; without a whitelist they are left out of metadata
+GENERATED_FIELDS = ["reason", "trimmed reason", "educational reason", "linguistic reason"]
+
+# Rows per Parquet row group when writing Parquet directly
+ROW_GROUP_SIZE = 10000
+
+def dumps(record):
+    return orjson.dumps(record) + b'\n' if orjson else (json.dumps(record) + '\n').encode('utf-8')
+
+def load_spec(spec):
+    if spec in SPECS:
+        return dict(SPECS[spec])
+    with open(spec, 'r') as f:
+        loaded = json.load(f)
+    missing = {"text_field", "score_field"} - set(loaded)
+    if missing:
+        raise ValueError(f"Spec {spec} is missing {sorted(missing)}.")
+    return loaded
+
+def to_score(value):
+    # Extra scores that are missing, NaN or not numbers are written as null
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+def excluded_fields(spec):
+    # Without a whitelist, metadata is the record minus the text, the scores and the reasons, so no document is stored twice
+    return {spec["text_field"], spec["score_field"], *spec.get("score_fields", []), *GENERATED_FIELDS}
+
+def project_metadata(record, fields, excluded):
+    if fields is not None:
+        return {field: record[field] for field in fields if field in record}
+    return {field: value for field, value in record.items() if field not in excluded}
+
+def convert_record(line, spec, prompt, excluded):
+    # Returns (new_record, None) or (None, skip_reason)
+    try:
+        record = loads(line)
+    except ValueError:
+        return None, "invalid_json"
+    if not isinstance(record, dict):
+        return None, "invalid_json"
+    score = record.get(spec["score_field"], 0)
+
+    # Check if the score is NaN and skip if true
+    if isinstance(score, float) and math.isnan(score):
+        return None, "nan_score"
+    try:
+        score = int(score)
+    except (ValueError, TypeError):
+        return None, "invalid_score"
+
+    new_record = {
+        "text": record.get(spec["text_field"]),
+        "metadata": project_metadata(record, spec.get("metadata_fields"), excluded),
+        "prompt": prompt,
+        "score": score,
+    }
+    for field in spec.get("score_fields", []):
+        new_record[field] = to_score(record.get(field))
+    return new_record, None
+
+def convert_file(input_filepath, output_filepath, spec, output_format, compress_level=None):
+    # The prompt names the uncompressed file, so it is the same whichever way the input is stored
+    prompt = os.path.basename(strip_compression(input_filepath))
+    counts = Counter()
+    excluded = excluded_fields(spec)
+    # Reading and parsing is timed as it is consumed; the rest of the file stage is writing
+    with PROFILER.stage("file"), open_file(input_filepath, 'rb') as infile:
+        records = PROFILER.timed("read_parse", (convert_record(line, spec, prompt, excluded) for line in infile if line.strip()))
+        if output_format == "parquet":
+            write_parquet(records, output_filepath, counts, spec.get("score_fields", []))
+        else:
+            with open_file(output_filepath, 'wb', compress_level) as outfile:
+                for new_record, reason in records:
+                    if reason:
+                        counts[reason] += 1
+                        continue
+                    outfile.write(dumps(new_record))
+                    counts["written"] += 1
+    return input_filepath, counts
+
+def write_parquet(records, output_filepath, counts, score_fields=()):
+    # Imported here so plain JSONL conversion does not need pyarrow
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from convert_jsonl_to_parquet import convert_metadata_to_string
+
+    # Scores are typed columns that can be filtered without parsing metadata
+    schema = pa.schema([("text", pa.string()), ("metadata", pa.string()), ("prompt", pa.string()), ("score", pa.int64())] + [(field, pa.int64()) for field in score_fields])
+    pending = []
+    with pq.ParquetWriter(output_filepath, schema) as writer:
+        for new_record, reason in records:
+            if reason:
+                counts[reason] += 1
+                continue
+            new_record["metadata"] = convert_metadata_to_string(new_record["metadata"])
+            pending.append(new_record)
+            counts["written"] += 1
+            if len(pending) == ROW_GROUP_SIZE:
+                with PROFILER.stage("write"):
+                    writer.write_table(pa.Table.from_pylist(pending, schema=schema))
+                pending.clear()
+        if pending:
+            with PROFILER.stage("write"):
+                writer.write_table(pa.Table.from_pylist(pending, schema=schema))
+
+def convert_jsonlines_files(input_dir, output_dir, spec, output_format="jsonl", num_workers=None, compress='auto', compress_level=None):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    jobs = []
+    for filename in sorted(os.listdir(input_dir)):
+        if is_jsonl(filename):
+            input_filepath = os.path.join(input_dir, filename)
+            stem = strip_compression(filename)[:-len(".jsonl")]
+            if output_format == "parquet":
+                output_filepath = os.path.join(output_dir, stem + ".parquet")
+            else:
+                output_filepath = output_path(os.path.join(output_dir, stem + ".jsonl"), [input_filepath], compress)
+            jobs.append((input_filepath, output_filepath))
+
+    totals = Counter()
+    # With --profile every worker profiles itself and leaves a part file for the report
+    worker_setup = dict(initializer=enable_worker, initargs=(PROFILER.prefix, PROFILER.sampler is not None)) if PROFILER.enabled else {}
+    with ProcessPoolExecutor(max_workers=num_workers, **worker_setup) as pool:
+        futures = [pool.submit(convert_file, input_filepath, output_filepath, spec, output_format, compress_level) for input_filepath, output_filepath in jobs]
+        for future in as_completed(futures):
+            input_filepath, counts = future.result()
+            totals.update(counts)
+            skipped = {reason: count for reason, count in counts.items() if reason != "written"}
+            logging.info(f"{os.path.basename(input_filepath)}: wrote {counts['written']} records, skipped {sum(skipped.values())} {skipped or ''}")
+    logging.info(f"Converted {len(jobs)} files: {dict(totals)}")
+    return totals
+
+def main(default_spec=None):
+    parser = argparse.ArgumentParser(description="Convert JSONLines files to a new format.")
+    parser.add_argument('--input_dir', type=str, required=True, help='Directory containing the input JSONLines files.')
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory to save the converted files.')
+    parser.add_argument('--spec', type=str, default=default_spec, required=default_spec is None, help=f'Field mapping: one of {sorted(SPECS)} or a JSON file with text_field and score_field, and optionally score_fields and metadata_fields.')
+    parser.add_argument('--text_field', type=str, help='Override the text field of the spec.')
+    parser.add_argument('--score_field', type=str, help='Override the score field of the spec.')
+    parser.add_argument('--score_fields', type=str, nargs='*', help='Override the further score fields of the spec, written as integer columns next to score (e.g. "trimmed cleanliness score").')
+    parser.add_argument('--metadata_fields', type=str, nargs='*', help='Keep only these fields in metadata; give none to leave it empty (default: every field but the text, the scores and the reasons).')
+    parser.add_argument('--output_format', type=str, choices=['jsonl', 'parquet'], default='jsonl', help='Write JSONL or Parquet directly (default: jsonl).')
+    parser.add_argument('--num_workers', type=int, default=None, help='Number of files converted in parallel (default: CPU count).')
+    parser.add_argument('--compress', type=str, choices=COMPRESS_CHOICES, default='auto', help='Compress JSONL outputs as .zst or .gz, or not at all; auto picks .zst for compressed or 1 GB inputs (default: auto).')
+    parser.add_argument('--compress_level', type=int, help='zstd or gzip level for compressed output (default: 3 for zstd, 6 for gzip).')
+    parser.add_argument('--profile', action='store_true', help='Time reading, parsing and writing in every worker and write <output_dir>.profile.txt and a Chrome trace (<output_dir>.profile.trace.json).')
+    parser.add_argument('--profile_sample', action='store_true', help='With --profile, also sample each worker\'s stacks to <output_dir>.profile.samples.txt.')
+    args = parser.parse_args()
+
+    if args.profile:
+        PROFILER.enable(profile_prefix(args.output_dir), args.profile_sample)
+
+    spec = load_spec(args.spec)
+    if args.text_field:
+        spec["text_field"] = args.text_field
+    if args.score_field:
+        spec["score_field"] = args.score_field
+    if args.score_fields is not None:
+        spec["score_fields"] = args.score_fields
+    if args.metadata_fields is not None:
+        spec["metadata_fields"] = args.metadata_fields
+
+    convert_jsonlines_files(args.input_dir, args.output_dir, spec, args.output_format, args.num_workers, args.compress, args.compress_level)
+    PROFILER.report()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import json
+import logging
+from collections import Counter
+from jsonl_io import open_file
+
+# Error classes for records that failed in the async generators; the single-line scripts use the exception name
+REQUEST_FAILED = "request_failed"
+INVALID_RESPONSE = "invalid_response"
+RATE_LIMITED = "rate_limited"
+FAILED_CHUNKS = "failed_chunks"
+
+def dead_letter_path(output_file):
+    return f"{output_file}.dead.jsonl"
+
+def dumps(record):
+    # Records read through pandas may hold NaN and timestamps
+    return json.dumps(record, ensure_ascii=False, default=str)
+
+def load_dead_letters(path):
+    with open(path, 'r') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    logging.info(f"Loaded {len(entries)} failed records from {path}.")
+    return entries
+
+class DeadLetters:
+    # One line per failed record: {"line", "error", "attempts", "detail", "record"}, where line is the
+    # record's line in the input and output files, so --retry_from can redo just these records.
+    # A retry pass passes the dead-letter entries it is re-running; their positions map back to lines.
+    # A new file is written next to path and replaces it on close, so a --retry_from pass that stops
+    # early keeps the file it was re-running.
+    def __init__(self, path, mode='w', retried=None):
+        self.path = path
+        self.tmp_path = f"{path}.tmp" if mode == 'w' else path
+        self.file = open(self.tmp_path, mode)
+        self.lines = [entry["line"] for entry in retried] if retried else None
+        self.prior_attempts = [entry["attempts"] for entry in retried] if retried else None
+        self.counts = Counter()
+
+    def add(self, idx, record, error, attempts, detail=None):
+        line = self.lines[idx] if self.lines else int(idx)
+        if self.prior_attempts:
+            attempts += self.prior_attempts[idx]
+        entry = {"line": line, "error": error, "attempts": attempts, "record": record}
+        if detail:
+            entry["detail"] = detail
+        self.file.write(dumps(entry) + "\n")
+        self.file.flush()
+        self.counts[error] += 1
+
+    def add_frame(self, frame, error, attempts, detail=None):
+        for idx, row in frame.iterrows():
+            self.add(idx, row.to_dict(), error, attempts, detail)
+
+    def close(self, completed=True):
+        self.file.close()
+        if not completed:
+            if self.tmp_path != self.path:
+                kept = f" and kept {self.path}" if os.path.exists(self.path) else ""
+                logging.warning(f"Stopped early; wrote this run's failed records to {self.tmp_path}{kept}.")
+            return
+        if self.tmp_path != self.path:
+            os.replace(self.tmp_path, self.path)
+        total = sum(self.counts.values())
+        if total:
+            logging.warning(f"{total} failed records written to {self.path}: {dict(self.counts)}. Re-run them with --retry_from {self.path}.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(exc_type is None)
+
+class MergeWriter:
+    # Stands in for the output writer in a --retry_from pass. Records arrive in dead-letter order and are put
+    # back at their original line of the output file on close; lines past the end of the output (a run that
+    # stopped early) are appended in line order. Records that were never written keep their old line.
+    def __init__(self, output_file, retried):
+        self.output_file = output_file
+        self.lines = [entry["line"] for entry in retried]
+        self.merged = {}
+
+    def write(self, record):
+        self.merged[self.lines[len(self.merged)]] = record
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        existing = 0
+        tmp_file = f"{self.output_file}.merge"
+        # The merged file is compressed like the output it replaces
+        with open_file(tmp_file, 'w', like=self.output_file) as out:
+            if os.path.exists(self.output_file):
+                with open_file(self.output_file, 'r') as f:
+                    for existing, line in enumerate(f, start=1):
+                        record = self.merged.get(existing - 1)
+                        out.write(dumps(record) + "\n" if record is not None else line)
+            for line in sorted(line for line in self.merged if line >= existing):
+                out.write(dumps(self.merged[line]) + "\n")
+        os.replace(tmp_file, self.output_file)
+        logging.info(f"Merged {len(self.merged)} retried records into {self.output_file}.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def retry_records(retried, output_file, dead_letters, score, max_retries=5):
+    # --retry_from for the single-line scripts: score(record) returns the scored record or raises
+    with MergeWriter(output_file, retried) as writer:
+        for idx, entry in enumerate(retried):
+            record = entry["record"]
+            for attempt in range(1, max_retries + 1):
+                try:
+                    writer.write(score(dict(record)))
+                    break
+                except Exception as e:
+                    error = e
+                    logging.error(f"An error occurred while retrying line {entry['line'] + 1} (attempt {attempt}): {e}")
+            else:
+                writer.write(record)
+                dead_letters.add(idx, record, type(error).__name__, max_retries, str(error))
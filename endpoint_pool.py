@@ -0,0 +1,116 @@
+import math
+import time
+import json
+import asyncio
+import logging
+from loop_tools import SampledLog
+
+# Requests per minute assumed for an endpoint when the config does not say
+DEFAULT_RPM = 200
+# Cooldown after a 429/5xx, doubled per consecutive failure up to MAX_COOLDOWN seconds
+BASE_COOLDOWN = 5
+MAX_COOLDOWN = 300
+# Weight of the latest outcome in the health score
+HEALTH_ALPHA = 0.1
+
+class Endpoint:
+    def __init__(self, project_id, location, url, rpm=DEFAULT_RPM):
+        self.project_id = project_id
+        self.location = location
+        self.url = url
+        self.rpm = rpm
+        self.tokens = float(rpm)
+        self.updated = time.monotonic()
+        self.health = 1.0
+        self.failures = 0
+        self.cooldown_until = 0.0
+
+    def __repr__(self):
+        return f"{self.project_id}/{self.location}"
+
+    def refill(self, now):
+        self.tokens = min(self.rpm, self.tokens + (now - self.updated) * self.rpm / 60)
+        self.updated = now
+
+    def available(self, now):
+        return now >= self.cooldown_until and self.tokens >= 1
+
+    def score(self):
+        return self.tokens * self.health
+
+class EndpointPool:
+    # Routes each request to the (project, region) with the most remaining capacity,
+    # weighted by health, and drains traffic away from endpoints returning 429/5xx
+    def __init__(self, endpoints):
+        if not endpoints:
+            raise ValueError("Endpoint pool needs at least one endpoint.")
+        self.endpoints = endpoints
+        # A burst of 429/5xx would otherwise log one line per request
+        self.sampled_log = SampledLog()
+
+    @classmethod
+    def single(cls, project_id, location, model_id, endpoint_template):
+        # A lone endpoint is paced by the caller's batching as before, so it has no client-side limit
+        url = endpoint_template.format(location=location, project_id=project_id, model_id=model_id)
+        return cls([Endpoint(project_id, location, url, rpm=math.inf)])
+
+    @classmethod
+    def from_file(cls, endpoints_file, model_id, endpoint_template):
+        # [{"project_id": "...", "location": "...", "rpm": 200}, ...]
+        with open(endpoints_file, 'r') as f:
+            config = json.load(f)
+        endpoints = [
+            Endpoint(entry["project_id"], entry["location"], endpoint_template.format(location=entry["location"], project_id=entry["project_id"], model_id=model_id), entry.get("rpm", DEFAULT_RPM))
+            for entry in config
+        ]
+        logging.info(f"Loaded endpoint pool: {endpoints}")
+        return cls(endpoints)
+
+    @classmethod
+    def from_args(cls, endpoints_file, project_id, location, model_id, endpoint_template):
+        if endpoints_file:
+            return cls.from_file(endpoints_file, model_id, endpoint_template)
+        return cls.single(project_id, location, model_id, endpoint_template)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def healthy(self):
+        now = time.monotonic()
+        return [endpoint for endpoint in self.endpoints if now >= endpoint.cooldown_until]
+
+    def should_retry(self, status):
+        # A 429/5xx is retried at once on another endpoint while any endpoint is out of cooldown;
+        # with a single endpoint there is no other, and the caller handles it as before
+        return len(self.endpoints) > 1 and (status == 429 or status >= 500) and bool(self.healthy())
+
+    async def acquire(self):
+        # Waits until some endpoint is out of cooldown and has a request token left
+        while True:
+            now = time.monotonic()
+            for endpoint in self.endpoints:
+                endpoint.refill(now)
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.available(now)]
+            if candidates:
+                endpoint = max(candidates, key=Endpoint.score)
+                endpoint.tokens -= 1
+                return endpoint
+            await asyncio.sleep(0.1)
+
+    def record(self, endpoint, status):
+        # status is the HTTP status, or None when the request raised
+        if status == 200:
+            endpoint.failures = 0
+            endpoint.health = (1 - HEALTH_ALPHA) * endpoint.health + HEALTH_ALPHA
+            return
+        endpoint.health = (1 - HEALTH_ALPHA) * endpoint.health
+        # A lone endpoint is never cooled down: it would hold up every later request, where before
+        # the pool only the failed request was affected
+        if status is not None and (status == 429 or status >= 500) and len(self.endpoints) > 1:
+            endpoint.failures += 1
+            cooldown = min(MAX_COOLDOWN, BASE_COOLDOWN * 2 ** (endpoint.failures - 1))
+            endpoint.cooldown_until = time.monotonic() + cooldown
+            self.sampled_log.log(logging.WARNING, "endpoint_cooldown", "Endpoint %s returned %s; cooling down for %s seconds (health %.2f).", endpoint, status, cooldown, endpoint.health)
+
+    def summary(self):
+        return ", ".join(f"{endpoint}: health {endpoint.health:.2f}" for endpoint in self.endpoints)
@@ -0,0 +1,86 @@
+import json
+import argparse
+import logging
+from gcs_batch import Storage
+from dead_letter import REQUEST_FAILED, INVALID_RESPONSE, DeadLetters, dead_letter_path
+from response_schema import RESPONSE_STATS, read_templates, parse_response, log_response_stats
+from jsonl_io import COMPRESS_CHOICES, open_jsonl, output_path
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def prediction_files(storage, predictions_uri):
+    # The job writes predictions*.jsonl (sometimes gzipped) into a prediction-model-<time> directory under the prefix
+    return [uri for uri in storage.list(predictions_uri) if uri.endswith(('.jsonl', '.jsonl.gz')) and 'predictions' in uri.rsplit('/', 1)[-1]]
+
+def read_prediction(line, schema):
+    # Returns (input line, fields, None) or (input line, None, (error, detail)); the line comes from the request's labels
+    prediction = json.loads(line)
+    request_line = int(prediction["request"]["labels"]["line"])
+    if prediction.get("status"):
+        return request_line, None, (REQUEST_FAILED, prediction["status"])
+    try:
+        response_text = prediction["response"]["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        RESPONSE_STATS['invalid'] += 1
+        return request_line, None, (INVALID_RESPONSE, "No text in the prediction")
+    response_json, errors = parse_response(response_text, schema)
+    if errors:
+        return request_line, None, (INVALID_RESPONSE, '; '.join(errors))
+    return request_line, {field: response_json[field] for field in schema['properties']}, None
+
+def fetch_predictions(predictions_uri, input_jsonl_file, output_jsonl_file, language, template_file='template.json', dead_letter_file=None, compress_level=None):
+    _, response_schemas = read_templates(template_file)
+    schema = response_schemas[language]
+    storage = Storage()
+
+    # Predictions arrive in no particular order, so only the scores are kept until every file has been read
+    scores = {}
+    failures = {}
+    files = prediction_files(storage, predictions_uri)
+    logging.info(f"Found {len(files)} prediction files under {predictions_uri}.")
+    for uri in files:
+        count = 0
+        for line in storage.iter_lines(uri):
+            request_line, fields, failure = read_prediction(line, schema)
+            if fields:
+                scores[request_line] = fields
+                failures.pop(request_line, None)
+            elif request_line not in scores:
+                failures[request_line] = failure
+            count += 1
+        logging.info(f"Read {count} predictions from {uri}.")
+
+    # Written in input order, with the same fields as generate_async.py; failed lines stay in place, unscored
+    dead_letters = DeadLetters(dead_letter_file or dead_letter_path(output_jsonl_file))
+    try:
+        with open_jsonl(input_jsonl_file) as reader, open_jsonl(output_jsonl_file, 'w', level=compress_level) as writer:
+            for line_no, record in enumerate(reader):
+                if line_no in scores:
+                    record.update(scores[line_no])
+                elif line_no in failures:
+                    dead_letters.add(line_no, record, failures[line_no][0], 1, failures[line_no][1])
+                writer.write(record)
+    finally:
+        dead_letters.close()
+        log_response_stats()
+    logging.info(f"Wrote {len(scores)} scored lines to {output_jsonl_file}.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream the JSONL predictions of a batch prediction job from Cloud Storage and merge them into the input file.")
+    parser.add_argument('--predictions_uri', type=str, required=True, help='Prefix the job wrote its predictions to, e.g. gs://bucket/path/predictions.')
+    parser.add_argument('--input_jsonl_file', type=str, required=True, help='The JSONL file the job was submitted from.')
+    parser.add_argument('--output_jsonl_file', type=str, required=True, help='Path to the output JSONL file.')
+    parser.add_argument('--language', type=str, choices=['en', 'sv', 'da', 'nb', 'nn'], default='en', help='Language of the prompt the job used (default: en).')
+    parser.add_argument('--template_file', type=str, default='template.json', help='Template file the job used (default: template.json).')
+    parser.add_argument('--dead_letter_file', type=str, help='Where failed and invalid predictions are written (default: <output_jsonl_file>.dead.jsonl).')
+    parser.add_argument('--compress', type=str, choices=COMPRESS_CHOICES, default='auto', help='Compress the output as .zst or .gz, or not at all; auto picks .zst when the input is compressed or at least 1 GB (default: auto). Output names ending in .gz or .zst are always compressed.')
+    parser.add_argument('--compress_level', type=int, help='zstd or gzip level for compressed output (default: 3 for zstd, 6 for gzip).')
+
+    args = parser.parse_args()
+    args.output_jsonl_file = output_path(args.output_jsonl_file, [args.input_jsonl_file], args.compress)
+
+    fetch_predictions(args.predictions_uri, args.input_jsonl_file, args.output_jsonl_file, args.language, args.template_file, args.dead_letter_file, args.compress_level)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,15 @@
 import argparse
 import json
 import logging
-from google.cloud import bigquery
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Fetch an example result from the output table
 def fetch_example_result(project_id, dataset_name, output_table_name):
+    # Imported here so --help works without the batch extra (google-cloud-bigquery)
+    from google.cloud import bigquery
+
     client = bigquery.Client(project=project_id)
     query = f"SELECT * FROM `{project_id}.{dataset_name}.{output_table_name}` LIMIT 1"
     query_job = client.query(query)
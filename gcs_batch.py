@@ -0,0 +1,164 @@
+import io
+import os
+import gzip
+import json
+import time
+import random
+import logging
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# The Cloud Storage JSON API; STORAGE_EMULATOR_HOST points it at a local stand-in such as fake-gcs-server
+# (e.g. http://localhost:4443), the same variable the google-cloud-storage client reads
+STORAGE_HOST = os.environ.get("STORAGE_EMULATOR_HOST", "https://storage.googleapis.com")
+
+# Resumable uploads are sent in chunks; GCS wants a multiple of 256 KiB for every chunk but the last
+CHUNK_SIZE = 32 * 256 * 1024
+# Request files uploaded at once
+UPLOAD_WORKERS = 8
+# Requests per request file; Vertex AI reads the files of a job in parallel
+SHARD_LINES = 20000
+# Attempts per chunk or download before giving up, with backoff doubled per attempt
+MAX_ATTEMPTS = 5
+BASE_BACKOFF = 1
+
+def split_uri(uri):
+    # "gs://bucket/some/prefix" -> ("bucket", "some/prefix")
+    if not uri.startswith("gs://"):
+        raise ValueError(f"Expected a gs:// URI, got {uri}")
+    bucket, _, name = uri[len("gs://"):].partition("/")
+    return bucket, name
+
+def backoff(attempt):
+    time.sleep(BASE_BACKOFF * 2 ** attempt * random.uniform(0.5, 1))
+
+def write_request_shards(requests_iter, shard_dir, shard_lines=SHARD_LINES, compress=True):
+    # Writes (line, request) pairs as {"request": ...} lines into request-00000.jsonl(.gz) files and returns their paths.
+    # The input line goes into the request's labels, which Vertex AI echoes back with each prediction.
+    os.makedirs(shard_dir, exist_ok=True)
+    paths = []
+    out = None
+    for count, (line, request) in enumerate(requests_iter):
+        if count % shard_lines == 0:
+            if out:
+                out.close()
+            path = os.path.join(shard_dir, f"request-{len(paths):05d}.jsonl" + (".gz" if compress else ""))
+            out = gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) if compress else open(path, 'w', encoding='utf-8')
+            paths.append(path)
+        request = dict(request, labels={"line": str(line)})
+        out.write(json.dumps({"request": request}, ensure_ascii=False) + "\n")
+    if out:
+        out.close()
+    return paths
+
+class Storage:
+    # Minimal Cloud Storage client over the JSON API: parallel resumable uploads, listing and streamed downloads.
+    # Against an emulator no credentials are needed; otherwise application default credentials are used.
+    def __init__(self, host=STORAGE_HOST):
+        self.host = host.rstrip('/')
+        self.session = requests.Session()
+        if host == "https://storage.googleapis.com":
+            # Imported here so runs against an emulator need no Google Cloud libraries
+            from google.auth import default
+            from google.auth.transport.requests import Request
+
+            credentials, _ = default()
+            credentials.refresh(Request())
+            self.session.headers["Authorization"] = f"Bearer {credentials.token}"
+
+    def upload(self, path, uri):
+        bucket, name = split_uri(uri)
+        size = os.path.getsize(path)
+        content_type = "application/gzip" if path.endswith(".gz") else "application/jsonl"
+        response = self.session.post(f"{self.host}/upload/storage/v1/b/{bucket}/o", params={"uploadType": "resumable", "name": name},
+                                     headers={"X-Upload-Content-Type": content_type, "X-Upload-Content-Length": str(size)},
+                                     json={"name": name, "contentType": content_type})
+        response.raise_for_status()
+        session_uri = response.headers["Location"]
+
+        offset = 0
+        attempt = 0
+        with open(path, 'rb') as f:
+            while True:
+                f.seek(offset)
+                chunk = f.read(CHUNK_SIZE)
+                content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{size}" if chunk else f"bytes */{size}"
+                try:
+                    response = self.session.put(session_uri, data=chunk, headers={"Content-Range": content_range})
+                    if response.status_code in (200, 201):
+                        return uri
+                    if response.status_code == 308:
+                        # Chunk stored; the Range header says how far the upload got
+                        offset = self.committed(response)
+                        attempt = 0
+                        continue
+                    if response.status_code < 500 and response.status_code != 429:
+                        response.raise_for_status()
+                    error = f"HTTP {response.status_code}"
+                except requests.ConnectionError as e:
+                    error = repr(e)
+                attempt += 1
+                if attempt >= MAX_ATTEMPTS:
+                    raise RuntimeError(f"Upload of {path} to {uri} failed after {attempt} attempts: {error}")
+                logging.warning(f"Upload of {path} interrupted at byte {offset} ({error}), resuming.")
+                backoff(attempt)
+                offset = self.resume_offset(session_uri, size)
+
+    def committed(self, response):
+        # "Range: bytes=0-1234" means bytes up to 1234 are stored; no header means none are
+        stored = response.headers.get("Range")
+        return int(stored.rsplit("-", 1)[1]) + 1 if stored else 0
+
+    def resume_offset(self, session_uri, size):
+        response = self.session.put(session_uri, headers={"Content-Range": f"bytes */{size}"})
+        if response.status_code in (200, 201):
+            return size
+        if response.status_code == 308:
+            return self.committed(response)
+        response.raise_for_status()
+        return 0
+
+    def upload_all(self, paths, uri_prefix, workers=UPLOAD_WORKERS):
+        uris = [f"{uri_prefix.rstrip('/')}/{os.path.basename(path)}" for path in paths]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for uri in pool.map(self.upload, paths, uris):
+                logging.info(f"Uploaded {uri}")
+        return uris
+
+    def list(self, uri_prefix):
+        bucket, prefix = split_uri(uri_prefix)
+        params = {"prefix": prefix, "fields": "items(name,size),nextPageToken"}
+        while True:
+            response = self.session.get(f"{self.host}/storage/v1/b/{bucket}/o", params=params)
+            response.raise_for_status()
+            listing = response.json()
+            for item in listing.get("items", []):
+                yield f"gs://{bucket}/{item['name']}"
+            if not listing.get("nextPageToken"):
+                return
+            params["pageToken"] = listing["nextPageToken"]
+
+    def iter_lines(self, uri):
+        # Streams the object line by line without keeping it in memory; .gz objects are decompressed on the fly
+        bucket, name = split_uri(uri)
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                response = self.session.get(f"{self.host}/storage/v1/b/{bucket}/o/{quote(name, safe='')}", params={"alt": "media"}, stream=True)
+                response.raise_for_status()
+                break
+            except (requests.ConnectionError, requests.HTTPError) as e:
+                if attempt + 1 >= MAX_ATTEMPTS or (isinstance(e, requests.HTTPError) and e.response.status_code < 500):
+                    raise
+                backoff(attempt)
+        with response:
+            # Undo transfer-level gzip (decompressive transcoding) as well as gzip-compressed objects
+            response.raw.decode_content = True
+            # Keeps the raw stream open at its end, as io wrappers expect
+            response.raw.auto_close = False
+            stream = io.BufferedReader(response.raw, CHUNK_SIZE)
+            if name.endswith(".gz"):
+                stream = gzip.GzipFile(fileobj=stream)
+            for line in stream:
+                if line.strip():
+                    yield line
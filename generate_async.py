@@ -1,14 +1,20 @@
 import os
-import json
-import aiohttp
 import asyncio
 import logging
 import argparse
-import pandas as pd
-import jsonlines
-from google.auth.transport.requests import Request
-from google.auth import default
 from tqdm import tqdm
+from endpoint_pool import EndpointPool
+from dead_letter import REQUEST_FAILED, INVALID_RESPONSE, RATE_LIMITED, DeadLetters, MergeWriter, dead_letter_path, load_dead_letters
+from language_routing import LanguageRouter
+from combined_templates import combine_templates
+from loop_tools import SampledLog, LoopLagMonitor, client_session, offload, read_json, run
+from profiler import PROFILER, profile_prefix
+from jsonl_io import COMPRESS_CHOICES, open_jsonl, output_path
+from multi_input import MAX_OPEN_FILES, expand_inputs, make_sources, process_interleaved
+from columnar_input import is_columnar, is_input, output_records, read_frame
+from hedging import Hedger, send_hedged
+from streaming import OutputTokenCaps, send_request_stream
+from response_schema import INVALID_RETRIES, RESPONSE_STATS, read_templates, with_schema, parse_response, log_response_stats
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,9 +24,10 @@ PROJECT_ID = "north-390910"
 LOCATION = "us-central1"
 ENDPOINT_TEMPLATE = "https://{location}-aiplatform.googleapis.com/v1/projects/{project_id}/locations/{location}/publishers/google/models/{model_id}:generateContent"
 
-# Load the templates
-with open('template.json', 'r') as f:
-    TEMPLATES = json.load(f)
+# Templates and their response schemas, filled by load_templates() on first use
+TEMPLATE_FILE = 'template.json'
+TEMPLATES = {}
+RESPONSE_SCHEMAS = {}
 
 # Model configuration
 GENERATION_CONFIG = {
@@ -31,6 +38,9 @@ GENERATION_CONFIG = {
     "response_mime_type": "application/json",
 }
 
+# Output-token caps per language, tightened from observed response lengths in --stream mode
+OUTPUT_TOKEN_CAPS = OutputTokenCaps(GENERATION_CONFIG["max_output_tokens"])
+
 # Batch size and wait time
 BATCH_SIZE = 200
 WAIT_TIME = 65  # Wait time between batches in seconds
@@ -39,7 +49,30 @@ WAIT_TIME = 65  # Wait time between batches in seconds
 auth_token = None
 credentials = None
 
+# Per-request deadline in seconds and the optional hedger, set from the command line
+request_timeout = None
+hedger = None
+
+# Per-request warnings are sampled so a burst of failures does not tie up the event loop
+sampled_log = SampledLog()
+
+# Failed records go to the dead-letter file when one is open
+dead_letters = None
+
+# Picks the prompt language per record when --language_field or --language_model is given
+router = None
+
+def load_templates():
+    if not TEMPLATES:
+        templates, schemas = read_templates(TEMPLATE_FILE)
+        TEMPLATES.update(templates)
+        RESPONSE_SCHEMAS.update(schemas)
+
 def get_auth_token():
+    # Imported here so --help and planning do not pay for google-auth
+    from google.auth import default
+    from google.auth.transport.requests import Request
+
     global auth_token, credentials
     if credentials is None:
         credentials, _ = default()
@@ -48,7 +81,11 @@ def get_auth_token():
     logging.info("Authentication token refreshed.")
     return auth_token
 
-async def send_request(session, endpoint, prompt, idx):
+def format_prompt(line, language):
+    input_text = (line.get('text') or line.get('content'))[:1000]  # Trim content to 1000 characters
+    return TEMPLATES[language].format(content=input_text)
+
+async def send_request(session, endpoints, prompt, idx, generation_config=GENERATION_CONFIG):
     headers = {
         "Authorization": f"Bearer {auth_token}",
         "Content-Type": "application/json",
@@ -58,121 +95,288 @@ async def send_request(session, endpoint, prompt, idx):
             "role": "user",
             "parts": [{"text": prompt}]
         }],
-        "generation_config": GENERATION_CONFIG,
+        "generation_config": generation_config,
     }
-    try:
-        async with session.post(endpoint, headers=headers, json=payload) as response:
-            if response.status == 200:
-                result = await response.json()
-                return idx, result
-            elif response.status == 401:
-                logging.error(f"Request {idx} failed with status: 401 Unauthorized. Check your credentials.")
-                return idx, 'unauthorized'
-            elif response.status == 429:
-                logging.warning(f"Request {idx} hit rate limit. Waiting for 5 minutes.")
-                await asyncio.sleep(300)  # Wait for 5 minutes before retrying
-                return idx, 'rate_limit'
-            else:
-                logging.error(f"Request {idx} failed with status: {response.status}")
-                return idx, None
-    except Exception as e:
-        logging.error(f"Request {idx} failed with exception: {e}")
-        return idx, None
+    for attempt in range(len(endpoints)):
+        endpoint = await endpoints.acquire()
+        try:
+            async with session.post(endpoint.url, headers=headers, json=payload) as response:
+                endpoints.record(endpoint, response.status)
+                if response.status == 200:
+                    result = await read_json(response)
+                    return idx, result
+                elif response.status == 401:
+                    sampled_log.log(logging.ERROR, "unauthorized", "Request %s failed with status: 401 Unauthorized. Check your credentials.", idx)
+                    return idx, 'unauthorized'
+                elif endpoints.should_retry(response.status):
+                    sampled_log.log(logging.WARNING, "endpoint_retry", "Request %s failed with status %s on %s. Retrying on another endpoint.", idx, response.status, endpoint)
+                    continue
+                elif response.status == 429:
+                    sampled_log.log(logging.WARNING, "rate_limit", "Request %s hit rate limit. Waiting for 5 minutes.", idx)
+                    await asyncio.sleep(300)  # Wait for 5 minutes before retrying
+                    return idx, 'rate_limit'
+                else:
+                    sampled_log.log(logging.ERROR, "request_failed", "Request %s failed with status: %s", idx, response.status)
+                    return idx, None
+        except Exception as e:
+            endpoints.record(endpoint, None)
+            sampled_log.log(logging.ERROR, "request_exception", "Request %s failed with exception: %r", idx, e)
+            return idx, None
+    return idx, None
 
-async def process_batch(session, batch, endpoint, language, total_words):
-    tasks = []
-    chat_prompt = TEMPLATES[language]
+def generation_config_for(language, stream):
+    generation_config = with_schema(GENERATION_CONFIG, RESPONSE_SCHEMAS[language])
+    if stream:
+        generation_config = dict(generation_config, max_output_tokens=OUTPUT_TOKEN_CAPS.cap(language))
+    return generation_config
 
+def build_prompts(batch, language):
+    # With a router every record carries the template language picked for it, so mixed-language
+    # files go through one pass; otherwise language applies to the whole batch
+    languages = {}
+    prompts = {}
+    words = 0
     for idx, line in batch.iterrows():
-        input_text = (line.get('text') or line.get('content'))[:1000]  # Trim content to 1000 characters
-        prompt = chat_prompt.format(content=input_text)
-        total_words += len(prompt.split())
-        tasks.append(send_request(session, endpoint, prompt, idx))
-    
-    responses = await asyncio.gather(*tasks)
-    
-    for idx, response in responses:
-        if response == 'rate_limit':
-            return False, total_words, None  # Indicate that rate limit was hit and retry is needed
-        if response == 'unauthorized':
-            raise Exception("Unauthorized request. Check your credentials.")
-        if response is not None:
-            try:
-                response_json_str = response['candidates'][0]['content']['parts'][0]['text']
-                response_json = json.loads(response_json_str)
-                batch.loc[idx, 'reason'] = response_json.get('reason', 'No reason found')
-                batch.loc[idx, 'educational score'] = response_json.get('educational score', 0)
+        languages[idx] = line['prompt_language'] if router else language
+        prompts[idx] = format_prompt(line, languages[idx])
+        words += len(prompts[idx].split())
+    return languages, prompts, words
+
+async def process_batch(session, batch, endpoints, language, total_words, stream=False, batch_dead_letters=None):
+    # Rendering runs in the CPU pool so it does not hold up socket reads of other requests
+    languages, prompts, words = await offload(build_prompts, batch, language, stage="prompt")
+    total_words += words
+    generation_configs = {lang: generation_config_for(lang, stream) for lang in set(languages.values())}
+
+    # Responses that fail validation are re-requested instead of being written with default scores
+    pending = list(prompts)
+    failed = {}
+    for attempt in range(INVALID_RETRIES + 1):
+        with PROFILER.stage("network"):
+            if stream:
+                responses = await asyncio.gather(*(send_hedged(hedger, lambda idx=idx: send_request_stream(session, endpoints, prompts[idx], idx, generation_configs[languages[idx]], RESPONSE_SCHEMAS[languages[idx]], auth_token, sampled_log)) for idx in pending))
+            else:
+                responses = await asyncio.gather(*(send_hedged(hedger, lambda idx=idx: send_request(session, endpoints, prompts[idx], idx, generation_configs[languages[idx]])) for idx in pending))
+        pending = []
+        with PROFILER.stage("parse"):
+            for idx, response in responses:
+                if response == 'rate_limit':
+                    return False, total_words, None  # Indicate that rate limit was hit and retry is needed
+                if response == 'unauthorized':
+                    raise Exception("Unauthorized request. Check your credentials.")
+                if response is None:
+                    failed[idx] = (REQUEST_FAILED, attempt + 1, None)
+                    continue
+                schema = RESPONSE_SCHEMAS[languages[idx]]
+                try:
+                    response_json_str = response['candidates'][0]['content']['parts'][0]['text']
+                    if stream:
+                        OUTPUT_TOKEN_CAPS.observe(languages[idx], response['usageMetadata']['candidatesTokenCount'], truncated=response['candidates'][0].get('finishReason') == 'MAX_TOKENS')
+                except (KeyError, IndexError, TypeError) as e:
+                    sampled_log.log(logging.ERROR, "unreadable_response", "Failed to process response for request %s: %r", idx, e)
+                    response_json_str = None
+                response_json, errors = parse_response(response_json_str, schema)
+                if errors:
+                    sampled_log.log(logging.WARNING, "invalid_response", "Invalid response for request %s (attempt %s): %s", idx, attempt + 1, '; '.join(errors))
+                    pending.append(idx)
+                    failed[idx] = (INVALID_RESPONSE, attempt + 1, '; '.join(errors))
+                    continue
+                failed.pop(idx, None)
+                for field in schema['properties']:
+                    batch.loc[idx, field] = response_json[field]
                 total_words += len(response_json_str.split())
-            except Exception as e:
-                logging.error(f"Failed to process response for request {idx}: {e}")
+        if not pending:
+            break
+    RESPONSE_STATS['given_up'] += len(pending)
+    # With several input files every batch brings the dead letters of its own file
+    batch_dead_letters = batch_dead_letters or dead_letters
+    if batch_dead_letters:
+        for idx, (error, attempts, detail) in failed.items():
+            record = batch.loc[idx].drop(labels=list(RESPONSE_SCHEMAS[languages[idx]]['properties']) + ['prompt_language'], errors='ignore').to_dict()
+            batch_dead_letters.add(idx, record, error, attempts, detail)
 
     return True, total_words, batch
 
-async def process_json_lines(jsonl_file, output_jsonl_file, language, dryrun, model_id):
+def configure(language, timeout=None, hedge_budget=0, language_field=None, language_model=None, combine_with=None):
+    global request_timeout, hedger, router
+    load_templates()
+    request_timeout = timeout or None
+    hedger = Hedger(hedge_budget) if hedge_budget else None
+    if combine_with:
+        # One request per document answers every template; the combined schema has the fields of all of them
+        templates, schemas = combine_templates([TEMPLATE_FILE] + combine_with)
+        TEMPLATES.clear()
+        TEMPLATES.update(templates)
+        RESPONSE_SCHEMAS.clear()
+        RESPONSE_SCHEMAS.update(schemas)
+        logging.info(f"Combined {TEMPLATE_FILE} with {', '.join(combine_with)} for languages {', '.join(TEMPLATES)}.")
+        if language not in TEMPLATES:
+            raise ValueError(f"Language '{language}' is missing from one of the combined template files.")
+    # Built after --combine_with, which can leave fewer languages than the template file has
+    router = LanguageRouter(language, language_field, language_model, TEMPLATES) if language_field or language_model else None
+
+async def process_json_lines(jsonl_file, output_jsonl_file, language, dryrun, model_id, stream=False, endpoints_file=None, timeout=None, hedge_budget=0, retry_from=None, dead_letter_file=None, language_field=None, language_model=None, combine_with=None, compress_level=None):
+    # Imported here so --help and the planner, which only needs format_prompt, start quickly
+    import pandas as pd
+
+    global dead_letters
+    PROFILER.watch_loop()
+    configure(language, timeout, hedge_budget, language_field, language_model, combine_with)
     total_words = 0
     retry_limit = 5
-    retry_attempts = 0
 
-    logging.info(f"Loading lines from {jsonl_file}...")
-    df = pd.read_json(jsonl_file, lines=True)
-    logging.info(f"Loaded {len(df)} lines from the file.")
+    retried = None
+    if retry_from:
+        # Only the dead-letter records are re-run; their results are merged back into the existing output
+        with PROFILER.stage("read"):
+            retried = load_dead_letters(retry_from)
+            df = pd.DataFrame([entry["record"] for entry in retried])
+    else:
+        logging.info(f"Loading lines from {jsonl_file}...")
+        with PROFILER.stage("read"):
+            df = read_frame(jsonl_file, extra=[language_field])
+        logging.info(f"Loaded {len(df)} lines from the file.")
+
+    if router and len(df):
+        with PROFILER.stage("route"):
+            df['prompt_language'] = df.apply(router, axis=1)
+        logging.info(f"Prompt languages: {router.summary()}")
 
-    endpoint = ENDPOINT_TEMPLATE.format(location=LOCATION, project_id=PROJECT_ID, model_id=model_id)
+    endpoints = EndpointPool.from_args(endpoints_file, PROJECT_ID, LOCATION, model_id, ENDPOINT_TEMPLATE)
 
     if dryrun:
-        first_line = df.iloc[0]
-        input_text = (first_line.get('text') or first_line.get('content'))[:1000]
-        chat_prompt = TEMPLATES[language].format(content=input_text)
-        print(f"Dryrun: {chat_prompt}")
+        first_language = df.iloc[0]['prompt_language'] if router else language
+        print(f"Dryrun ({first_language}): {format_prompt(df.iloc[0], first_language)}")
         return
 
-    with jsonlines.open(output_jsonl_file, mode='w') as writer:
-        with tqdm(total=len(df), desc="Processing lines") as pbar:
-            for start in range(0, len(df), BATCH_SIZE):
-                end = min(start + BATCH_SIZE, len(df))
-                batch = df[start:end].copy()  # Make a copy to avoid SettingWithCopyWarning
-                get_auth_token()  # Refresh the token before processing each batch
-                async with aiohttp.ClientSession() as session:
-                    success, total_words, processed_batch = await process_batch(session, batch, endpoint, language, total_words)
-
-                if not success:
-                    if retry_attempts < retry_limit:
-                        retry_attempts += 1
-                        logging.warning(f"Retrying batch {start}-{end} due to rate limit.")
-                        await asyncio.sleep(300)  # Wait for 5 minutes before retrying
-                        continue
+    # The output of a Parquet or Arrow input is a sidecar keyed by row index, without the text
+    sidecar = is_columnar(jsonl_file)
+    lag_monitor = LoopLagMonitor()
+    lag_monitor.start()
+    try:
+        # Closed with the failures of a run that raises too; the --retry_from file is only replaced when it completes
+        with DeadLetters(dead_letter_file or dead_letter_path(output_jsonl_file), retried=retried) as dead_letters, \
+                (MergeWriter(output_jsonl_file, retried) if retried else open_jsonl(output_jsonl_file, 'w', level=compress_level)) as writer:
+            with tqdm(total=len(df), desc="Processing lines") as pbar:
+                for start in range(0, len(df), BATCH_SIZE):
+                    end = min(start + BATCH_SIZE, len(df))
+                    for attempt in range(retry_limit + 1):
+                        batch = df[start:end].copy()  # Make a copy to avoid SettingWithCopyWarning
+                        get_auth_token()  # Refresh the token before processing each batch
+                        async with client_session(request_timeout) as session:
+                            success, total_words, processed_batch = await process_batch(session, batch, endpoints, language, total_words, stream)
+                        if success:
+                            break
+                        if attempt < retry_limit:
+                            logging.warning(f"Retrying batch {start}-{end} due to rate limit.")
+                            await asyncio.sleep(300)  # Wait for 5 minutes before retrying
                     else:
+                        # The rest of the file is not attempted; it goes to the dead-letter file for --retry_from
                         logging.error(f"Batch {start}-{end} failed after {retry_limit} attempts.")
+                        dead_letters.add_frame(df[start:], RATE_LIMITED, retry_limit + 1)
                         break
-                
-                retry_attempts = 0  # Reset retry attempts after successful batch
-                writer.write_all(processed_batch.to_dict(orient='records'))
-                pbar.update(len(batch))
-                logging.info(f"{len(batch)} of {BATCH_SIZE} succeeded. Waiting {WAIT_TIME} seconds before next batch.")
-                await asyncio.sleep(WAIT_TIME)
-
-            # Process and write the last batch if it's not a multiple of BATCH_SIZE
-            if end < len(df):
-                last_batch = df[end:].copy()
-                success, total_words, processed_last_batch = await process_batch(session, last_batch, endpoint, language, total_words)
-                if success:
-                    writer.write_all(processed_last_batch.to_dict(orient='records'))
-                    pbar.update(len(last_batch))
-                    logging.info(f"Processed the last batch of {len(last_batch)} lines.")
 
+                    await offload(writer.write_all, output_records(processed_batch, sidecar), stage="write")
+                    pbar.update(len(batch))
+                    logging.info(f"{len(batch)} of {BATCH_SIZE} succeeded. Waiting {WAIT_TIME} seconds before next batch.")
+                    with PROFILER.stage("pacing"):
+                        await asyncio.sleep(WAIT_TIME)
+    finally:
+        lag_monitor.stop()
     logging.info(f"Total words processed (input + output): {total_words}")
+    log_response_stats()
+    logging.info(f"Endpoints: {endpoints.summary()}")
+    logging.info(f"Event loop lag: {lag_monitor.summary()}")
+    if sampled_log.counts:
+        logging.info(f"Request problems: {sampled_log.summary()}")
+    if hedger:
+        logging.info(f"Hedging: {hedger.summary()}")
+    PROFILER.report()
+
+async def process_json_files(jsonl_files, output_dir, language, dryrun, model_id, stream=False, endpoints_file=None, timeout=None, hedge_budget=0, language_field=None, language_model=None, combine_with=None, compress='auto', compress_level=None, max_open_files=MAX_OPEN_FILES):
+    PROFILER.watch_loop()
+    configure(language, timeout, hedge_budget, language_field, language_model, combine_with)
+    sources = make_sources(jsonl_files, output_dir, compress, compress_level)
+    endpoints = EndpointPool.from_args(endpoints_file, PROJECT_ID, LOCATION, model_id, ENDPOINT_TEMPLATE)
+
+    if dryrun:
+        for source in sources:
+            print(f"Dryrun: {source.input_file} -> {source.output_file}" + (f", resuming at line {source.start}" if source.start else ""))
+        return
 
-def main():
+    def read(path):
+        df = read_frame(path, extra=[language_field])
+        if router and len(df):
+            df['prompt_language'] = df.apply(router, axis=1)
+        logging.info(f"Loaded {len(df)} lines from {path}.")
+        return df
+
+    async def process(session, batch, batch_dead_letters):
+        return await process_batch(session, batch, endpoints, language, 0, stream, batch_dead_letters)
+
+    lag_monitor = LoopLagMonitor()
+    lag_monitor.start()
+    try:
+        # Refresh the token before processing each batch
+        total_words = await process_interleaved(sources, read, process, get_auth_token, BATCH_SIZE, WAIT_TIME, 300, request_timeout, max_open_files)
+    finally:
+        lag_monitor.stop()
+    logging.info(f"Total words processed (input + output): {total_words}")
+    log_response_stats()
+    if router:
+        logging.info(f"Prompt languages: {router.summary()}")
+    logging.info(f"Endpoints: {endpoints.summary()}")
+    logging.info(f"Event loop lag: {lag_monitor.summary()}")
+    if sampled_log.counts:
+        logging.info(f"Request problems: {sampled_log.summary()}")
+    if hedger:
+        logging.info(f"Hedging: {hedger.summary()}")
+    PROFILER.report()
+
+def main(template_file=TEMPLATE_FILE):
+    global TEMPLATE_FILE
+    # generate_async_linguistic.py runs this with template_linguistic.json
+    TEMPLATE_FILE = template_file
     parser = argparse.ArgumentParser(description="Process a JSONLines file with the Vertex AI API.")
-    parser.add_argument('--jsonl_file', type=str, required=True, help='Path to the JSONLines file.')
-    parser.add_argument('--output_jsonl_file', type=str, required=True, help='Path to the output JSONLines file.')
-    parser.add_argument('--language', type=str, choices=['en', 'sv', 'da', 'nb', 'nn'], default='en', help='Language for the prompt (default: en).')
+    parser.add_argument('--jsonl_file', type=str, nargs='+', required=True, help='Path to the JSONLines file, or a Parquet or Arrow file of which only text, content and id are read; with --output_dir, any number of files, globs (quoted) or directories.')
+    parser.add_argument('--output_jsonl_file', type=str, help='Path to the output JSONLines file.')
+    parser.add_argument('--output_dir', type=str, help='Score every --jsonl_file in one run, interleaving their lines, and write <name>_processed.jsonl for each here. Rerunning resumes each file after its last written line.')
+    parser.add_argument('--max_open_files', type=int, default=MAX_OPEN_FILES, help=f'With --output_dir, how many input files are read into memory and interleaved at once (default: {MAX_OPEN_FILES}).')
+    parser.add_argument('--language', type=str, choices=['en', 'sv', 'da', 'nb', 'nn'], default='en', help='Language for the prompt, and the fallback when routing per record (default: en).')
+    parser.add_argument('--language_field', type=str, help='Pick the prompt language per record from this field (e.g. language, with values such as nb or nob_Latn).')
+    parser.add_argument('--language_model', type=str, help='fastText language-ID model (e.g. lid.176.bin) for records without a usable --language_field.')
     parser.add_argument('--dryrun', action='store_true', help='Perform a dry run without sending requests.')
     parser.add_argument('--model_id', type=str, default='gemini-1.5-flash-001', help='Model ID to use for the API.')
+    parser.add_argument('--endpoints_file', type=str, help='JSON list of {"project_id", "location", "rpm"} endpoints to load-balance over (default: the built-in project and region).')
+    parser.add_argument('--request_timeout', type=float, default=120, help='Deadline in seconds for each request, 0 for none (default: 120).')
+    parser.add_argument('--hedge_budget', type=float, default=0, help='Send a duplicate of requests slower than the observed p95 latency, for at most this fraction of requests (default: 0, off).')
+    parser.add_argument('--dead_letter_file', type=str, help='Where failed records are written with their error and attempt count (default: <output_jsonl_file>.dead.jsonl).')
+    parser.add_argument('--retry_from', type=str, help='Re-run only the records in this dead-letter file and merge the results into --output_jsonl_file.')
+    parser.add_argument('--combine_with', type=str, nargs='+', help=f'Other template files (e.g. template.json or template_linguistic.json) to score in the same request as {TEMPLATE_FILE}, writing all their scores to one output.')
+    parser.add_argument('--compress', type=str, choices=COMPRESS_CHOICES, default='auto', help='Compress the output as .zst or .gz, or not at all; auto picks .zst when the input is compressed or at least 1 GB (default: auto). Output names ending in .gz or .zst are always compressed.')
+    parser.add_argument('--compress_level', type=int, help='zstd or gzip level for compressed output (default: 3 for zstd, 6 for gzip).')
+    parser.add_argument('--profile', action='store_true', help='Time the read, prompt, network, parse and write stages and write <output_jsonl_file>.profile.txt and a Chrome trace (<output_jsonl_file>.profile.trace.json).')
+    parser.add_argument('--profile_sample', action='store_true', help='With --profile, also sample the event-loop thread\'s stacks to <output_jsonl_file>.profile.samples.txt.')
+    parser.add_argument('--uvloop', action='store_true', help='Run on uvloop if it is installed.')
+    parser.add_argument('--stream', action='store_true', help='Use streamGenerateContent, stop reading once the required fields are complete and cap output tokens from observed response lengths.')
 
     args = parser.parse_args()
+    if args.output_dir:
+        if args.output_jsonl_file or args.retry_from or args.dead_letter_file:
+            parser.error("--output_dir writes one output and dead-letter file per input; use --output_jsonl_file, --retry_from and --dead_letter_file for single files.")
+        jsonl_files = expand_inputs(args.jsonl_file, accept=is_input)
+        if args.profile:
+            PROFILER.enable(profile_prefix(args.output_dir), args.profile_sample)
+        run(process_json_files(jsonl_files, args.output_dir, args.language, args.dryrun, args.model_id, args.stream, args.endpoints_file, args.request_timeout, args.hedge_budget, args.language_field, args.language_model, args.combine_with, args.compress, args.compress_level, args.max_open_files), args.uvloop)
+        return
+    if len(args.jsonl_file) != 1 or not args.output_jsonl_file:
+        parser.error("Give one --jsonl_file with --output_jsonl_file, or several with --output_dir.")
+    args.jsonl_file = args.jsonl_file[0]
+    args.output_jsonl_file = output_path(args.output_jsonl_file, [args.jsonl_file], args.compress)
 
-    asyncio.run(process_json_lines(args.jsonl_file, args.output_jsonl_file, args.language, args.dryrun, args.model_id))
+    if args.profile:
+        PROFILER.enable(profile_prefix(args.output_jsonl_file), args.profile_sample)
+    run(process_json_lines(args.jsonl_file, args.output_jsonl_file, args.language, args.dryrun, args.model_id, args.stream, args.endpoints_file, args.request_timeout, args.hedge_budget, args.retry_from, args.dead_letter_file, args.language_field, args.language_model, args.combine_with, args.compress_level), args.uvloop)
 
 if __name__ == "__main__":
     main()
@@ -1,21 +1,13 @@
 import os
 import time
-import json
-import google.generativeai as genai
-import jsonlines
 import argparse
 import logging
+from response_schema import read_templates, with_schema, parse_response
+from jsonl_io import open_jsonl
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Configure the Vertex AI API details
-genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-
-# Load the templates from the template.json file
-with open('template.json', 'r') as f:
-    templates = json.load(f)
-
 # Define the model configuration
 generation_config = {
     "temperature": 1,
@@ -25,25 +17,35 @@ generation_config = {
     "response_mime_type": "application/json",
 }
 
-# Create the model
-model = genai.GenerativeModel(
-    model_name="gemini-1.5-flash",
-    generation_config=generation_config,
-    # safety_settings = Adjust safety settings
-    # See https://ai.google.dev/gemini-api/docs/safety-settings
-)
+def create_model():
+    # The SDK is imported and configured here so --help needs neither the SDK nor an API key
+    import google.generativeai as genai
+
+    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+    return genai.GenerativeModel(
+        model_name="gemini-1.5-flash",
+        generation_config=generation_config,
+        # safety_settings = Adjust safety settings
+        # See https://ai.google.dev/gemini-api/docs/safety-settings
+    )
 
 def process_json_lines(json_lines_file, language):
+    model = create_model()
+    templates, response_schemas = read_templates('template.json')
     chat_prompt = templates[language]
+    schema = response_schemas[language]
 
-    with jsonlines.open(json_lines_file, mode='r') as reader:
+    with open_jsonl(json_lines_file) as reader:
         for line in reader:
             try:
                 text = line.get('text') or line.get('content')
                 if text:
                     prompt = chat_prompt.format(content=text)
-                    response = model.generate_content(prompt)
+                    response = model.generate_content(prompt, generation_config=with_schema(generation_config, schema))
                     print(response.text)
+                    _, errors = parse_response(response.text, schema)
+                    if errors:
+                        logging.warning(f"Invalid response: {'; '.join(errors)}")
                 else:
                     logging.error(f"Field 'text' or 'content' not found in line: {line}")
                 time.sleep(1)  # Wait to prevent hitting rate limits
@@ -1,14 +1,19 @@
 import os
+import re
 import json
-import aiohttp
 import asyncio
 import logging
 import argparse
-import pandas as pd
-import jsonlines
-from google.auth.transport.requests import Request
-from google.auth import default
 from tqdm import tqdm
+from endpoint_pool import EndpointPool
+from dead_letter import REQUEST_FAILED, INVALID_RESPONSE, RATE_LIMITED, FAILED_CHUNKS, DeadLetters, MergeWriter, dead_letter_path, load_dead_letters
+from loop_tools import SampledLog, LoopLagMonitor, client_session, offload, read_json, run
+from profiler import PROFILER, profile_prefix
+from jsonl_io import COMPRESS_CHOICES, open_jsonl, output_path
+from multi_input import MAX_OPEN_FILES, expand_inputs, make_sources, process_interleaved
+from columnar_input import is_columnar, is_input, output_records, read_frame
+from hedging import Hedger, send_hedged
+from response_schema import INVALID_RETRIES, RESPONSE_STATS, load_schema_file, with_schema, parse_response, log_response_stats
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -30,11 +35,35 @@ GENERATION_CONFIG = {
 # Batch size and wait time
 BATCH_SIZE = 200
 
+# Chunked mode: sentence boundaries and a rough characters-per-token estimate for the chunk budget
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+CHARS_PER_TOKEN = 4
+
 # Fetch and cache the authentication token
 auth_token = None
 credentials = None
 
+# Per-request deadline in seconds and the optional hedger, set from the command line
+request_timeout = None
+hedger = None
+
+# Per-record warnings are sampled so a burst of failures does not tie up the event loop
+sampled_log = SampledLog()
+
+# Failed records go to the dead-letter file when one is open
+dead_letters = None
+
+# Result columns written by this script, left out of dead-letter records
+RESULT_COLUMNS = ['askLLMresult', 'askLLMchunks', 'askLLMfailed_chunks']
+
+# Optional response schema, loaded from --response_schema_file
+response_schema = None
+
 def get_auth_token():
+    # Imported here so --help and planning do not pay for google-auth
+    from google.auth import default
+    from google.auth.transport.requests import Request
+
     global auth_token, credentials
     if credentials is None:
         credentials, _ = default()
@@ -50,7 +79,68 @@ def trim_text(text, max_length):
         return trimmed_text[:last_period + 1]
     return trimmed_text
 
-async def send_request(session, endpoint, prompt, idx):
+def load_template(template_file):
+    with open(template_file, 'r') as f:
+        template = f.read()
+        if '{content}' not in template:
+            raise ValueError("Template file must contain '{content}' placeholder.")
+
+        # Replace curly quotes with straight quotes
+        template = template.replace('“', '"').replace('”', '"')
+        logging.info(f"Template loaded successfully.")
+    return template
+
+def format_prompt(line, template, max_length):
+    return template.replace("{content}", trim_text((line.get('text') or line.get('content')), max_length))
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+def chunk_text(text, chunk_tokens):
+    # Pack whole sentences into chunks of at most chunk_tokens; a longer sentence gets a chunk of its own
+    chunks, current, current_tokens = [], [], 0
+    for sentence in SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        tokens = estimate_tokens(sentence)
+        if current and current_tokens + tokens > chunk_tokens:
+            chunks.append(' '.join(current))
+            current, current_tokens = [], 0
+        current.append(sentence)
+        current_tokens += tokens
+    if current:
+        chunks.append(' '.join(current))
+    return chunks
+
+def add_dead_letters(batch, failed, batch_dead_letters=None):
+    # With several input files every batch brings the dead letters of its own file
+    batch_dead_letters = batch_dead_letters or dead_letters
+    if batch_dead_letters:
+        for idx, (error, attempts, detail) in failed.items():
+            record = batch.loc[idx].drop(labels=RESULT_COLUMNS, errors='ignore').to_dict()
+            batch_dead_letters.add(idx, record, error, attempts, detail)
+
+def parse_ner_response(response_text):
+    # The model answers with one {"Frase": ..., "Navngitte enheter": ...} object per line, a JSON list of them,
+    # or a single object; curly quotes are normalised first as in the template
+    response_text = response_text.replace('“', '"').replace('”', '"').strip()
+    try:
+        parsed = json.loads(response_text)
+        entries = parsed if isinstance(parsed, list) else [parsed]
+    except json.JSONDecodeError:
+        # A malformed line is skipped so the rest of the chunk's sentences are kept
+        entries = []
+        for line in response_text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                sampled_log.log(logging.WARNING, "malformed_ner_line", "Skipping malformed line in NER response: %s (%s)", line[:200], e)
+    return [entry for entry in entries if isinstance(entry, dict) and "Frase" in entry]
+
+async def send_request(session, endpoints, prompt, idx):
     headers = {
         "Authorization": f"Bearer {auth_token}",
         "Content-Type": "application/json",
@@ -60,156 +150,378 @@ async def send_request(session, endpoint, prompt, idx):
             "role": "user",
             "parts": [{"text": prompt}]
         }],
-        "generation_config": GENERATION_CONFIG,
+        "generation_config": with_schema(GENERATION_CONFIG, response_schema),
     }
-    try:
-        async with session.post(endpoint, headers=headers, json=payload) as response:
-            if response.status == 200:
-                result = await response.json()
-                return idx, result
-            elif response.status == 401:
-                logging.error(f"Request {idx} failed with status: 401 Unauthorized. Check your credentials.")
-                return idx, 'unauthorized'
-            elif response.status == 429:
-                logging.warning(f"Request {idx} hit rate limit. Waiting for 5 minutes.")
-                await asyncio.sleep(300)  # Wait for 5 minutes before retrying
-                return idx, 'rate_limit'
-            else:
-                logging.error(f"Request {idx} failed with status: {response.status}")
-                return idx, None
-    except Exception as e:
-        logging.error(f"Request {idx} failed with exception: {e}")
-        return idx, None
+    for attempt in range(len(endpoints)):
+        endpoint = await endpoints.acquire()
+        try:
+            async with session.post(endpoint.url, headers=headers, json=payload) as response:
+                endpoints.record(endpoint, response.status)
+                if response.status == 200:
+                    result = await read_json(response)
+                    return idx, result
+                elif response.status == 401:
+                    sampled_log.log(logging.ERROR, "unauthorized", "Request %s failed with status: 401 Unauthorized. Check your credentials.", idx)
+                    return idx, 'unauthorized'
+                elif endpoints.should_retry(response.status):
+                    sampled_log.log(logging.WARNING, "endpoint_retry", "Request %s failed with status %s on %s. Retrying on another endpoint.", idx, response.status, endpoint)
+                    continue
+                elif response.status == 429:
+                    sampled_log.log(logging.WARNING, "rate_limit", "Request %s hit rate limit. Waiting for 5 minutes.", idx)
+                    await asyncio.sleep(300)  # Wait for 5 minutes before retrying
+                    return idx, 'rate_limit'
+                else:
+                    sampled_log.log(logging.ERROR, "request_failed", "Request %s failed with status: %s", idx, response.status)
+                    return idx, None
+        except Exception as e:
+            endpoints.record(endpoint, None)
+            sampled_log.log(logging.ERROR, "request_exception", "Request %s failed with exception: %r", idx, e)
+            return idx, None
+    return idx, None
 
-async def process_batch(session, batch, endpoint, template, total_words, max_length):
-    tasks = []
+def build_prompts(batch, template, max_length):
+    prompts = {idx: format_prompt(line, template, max_length) for idx, line in batch.iterrows()}
+    return prompts, sum(len(prompt.split()) for prompt in prompts.values())
 
+def build_chunk_prompts(batch, template, chunk_tokens):
+    # Returns [(idx, chunk_no, prompt)] and the number of chunks per document
+    prompts, chunk_counts = [], {}
     for idx, line in batch.iterrows():
-        input_text = trim_text((line.get('text') or line.get('content')), max_length)
-        prompt = template.replace("{content}", input_text)
-        logging.info(f"Formatted prompt for line {idx}.")
-        total_words += len(prompt.split())
-        tasks.append(send_request(session, endpoint, prompt, idx))
-    
-    responses = await asyncio.gather(*tasks)
-    
-    for idx, response in responses:
-        if response == 'rate_limit':
-            logging.warning(f"Rate limit hit for request {idx}. Retrying...")
-            return False, total_words, None  # Indicate that rate limit was hit and retry is needed
-        if response == 'unauthorized':
-            raise Exception("Unauthorized request. Check your credentials.")
-        if response is not None:
+        chunks = chunk_text((line.get('text') or line.get('content')), chunk_tokens)
+        chunk_counts[idx] = len(chunks)
+        prompts.extend((idx, chunk_no, template.replace("{content}", chunk)) for chunk_no, chunk in enumerate(chunks))
+    return prompts, chunk_counts
+
+def assemble_chunked(batch, chunk_counts, response_texts):
+    # Parses the NER lines of every chunk and reassembles each document's sentences in chunk order,
+    # one JSON line per sentence. Returns the dead-letter entries of documents with failed chunks.
+    entries = {idx: [None] * count for idx, count in chunk_counts.items()}
+    for (idx, chunk_no), response_text in response_texts.items():
+        try:
+            entries[idx][chunk_no] = parse_ner_response(response_text)
+        except Exception as e:
+            logging.error(f"Failed to process response for request {idx}/{chunk_no}: {e}")
+
+    failed_docs = {}
+    for idx, chunk_entries in entries.items():
+        failed = sum(1 for chunk in chunk_entries if chunk is None)
+        if failed:
+            # The whole document is re-run by --retry_from
+            failed_docs[idx] = (FAILED_CHUNKS, 1, f"{failed} of {len(chunk_entries)} chunks failed")
+        sentences = [entry for chunk in chunk_entries if chunk for entry in chunk]
+        batch.loc[idx, 'askLLMresult'] = '\n'.join(json.dumps(entry, ensure_ascii=False) for entry in sentences)
+        batch.loc[idx, 'askLLMchunks'] = len(chunk_entries)
+        batch.loc[idx, 'askLLMfailed_chunks'] = failed
+    return failed_docs
+
+async def process_batch(session, batch, endpoints, template, total_words, max_length, batch_dead_letters=None):
+    # Rendering runs in the CPU pool so it does not hold up socket reads of other requests
+    prompts, words = await offload(build_prompts, batch, template, max_length, stage="prompt")
+    total_words += words
+    logging.info(f"Formatted {len(prompts)} prompts.")
+
+    # With a response schema, responses that fail validation are re-requested
+    pending = list(prompts)
+    failed = {}
+    for attempt in range(INVALID_RETRIES + 1 if response_schema else 1):
+        with PROFILER.stage("network"):
+            responses = await asyncio.gather(*(send_hedged(hedger, lambda idx=idx: send_request(session, endpoints, prompts[idx], idx)) for idx in pending))
+        pending = []
+        with PROFILER.stage("parse"):
+            for idx, response in responses:
+                if response == 'rate_limit':
+                    logging.warning(f"Rate limit hit for request {idx}. Retrying...")
+                    return False, total_words, None  # Indicate that rate limit was hit and retry is needed
+                if response == 'unauthorized':
+                    raise Exception("Unauthorized request. Check your credentials.")
+                if response is not None:
+                    try:
+                        logging.debug("Response for request %s: %s", idx, response)
+                        response_text = response['candidates'][0]['content']['parts'][0]['text']
+                    except Exception as e:
+                        sampled_log.log(logging.ERROR, "unreadable_response", "Failed to process response for request %s due to unexpected error: %r. Response: %s", idx, e, response)
+                        failed[idx] = (INVALID_RESPONSE, attempt + 1, str(e))
+                        continue
+                    if response_schema:
+                        _, errors = parse_response(response_text, response_schema)
+                        if errors:
+                            sampled_log.log(logging.WARNING, "invalid_response", "Invalid response for request %s (attempt %s): %s", idx, attempt + 1, '; '.join(errors))
+                            pending.append(idx)
+                            failed[idx] = (INVALID_RESPONSE, attempt + 1, '; '.join(errors))
+                            continue
+                    failed.pop(idx, None)
+                    batch.loc[idx, 'askLLMresult'] = response_text
+                    total_words += len(response_text.split())
+                else:
+                    sampled_log.log(logging.ERROR, "no_response", "No response for request %s", idx)
+                    failed[idx] = (REQUEST_FAILED, attempt + 1, None)
+        if not pending:
+            break
+    RESPONSE_STATS['given_up'] += len(pending)
+    add_dead_letters(batch, failed, batch_dead_letters)
+    return True, total_words, batch
+
+async def process_batch_chunked(session, batch, endpoints, template, total_words, chunk_tokens):
+    prompts, chunk_counts = await offload(build_chunk_prompts, batch, template, chunk_tokens, stage="prompt")
+    total_words += sum(len(prompt.split()) for _, _, prompt in prompts)
+    with PROFILER.stage("network"):
+        responses = await asyncio.gather(*(send_hedged(hedger, lambda prompt=prompt, key=(idx, chunk_no): send_request(session, endpoints, prompt, key)) for idx, chunk_no, prompt in prompts))
+
+    with PROFILER.stage("parse"):
+        response_texts = {}
+        for (idx, chunk_no), response in responses:
+            if response == 'rate_limit':
+                logging.warning(f"Rate limit hit for request {idx}/{chunk_no}. Retrying...")
+                return False, total_words, None  # Indicate that rate limit was hit and retry is needed
+            if response == 'unauthorized':
+                raise Exception("Unauthorized request. Check your credentials.")
+            if response is None:
+                sampled_log.log(logging.ERROR, "no_response", "No response for request %s/%s", idx, chunk_no)
+                continue
             try:
-                logging.debug(f"Response for request {idx}: {response}")
-                response_text = response['candidates'][0]['content']['parts'][0]['text']
-                batch.loc[idx, 'askLLMresult'] = response_text
-                total_words += len(response_text.split())
+                response_texts[(idx, chunk_no)] = response['candidates'][0]['content']['parts'][0]['text']
+                total_words += len(response_texts[(idx, chunk_no)].split())
             except Exception as e:
-                logging.error(f"Failed to process response for request {idx} due to unexpected error: {e}")
-                logging.error(f"Response structure for request {idx}: {json.dumps(response, indent=2)}")
-        else:
-            logging.error(f"No response for request {idx}")
+                sampled_log.log(logging.ERROR, "unreadable_response", "Failed to process response for request %s/%s: %r", idx, chunk_no, e)
+
+    add_dead_letters(batch, await offload(assemble_chunked, batch, chunk_counts, response_texts, stage="assemble"))
     return True, total_words, batch
 
-async def process_json_lines(jsonl_file, output_jsonl_file, template_file, dryrun, model_id, wait_rate_limit, wait_time, max_length, max_num_requests):
+def chunked_batches(df, chunk_tokens):
+    # Group documents so that each batch sends roughly BATCH_SIZE chunk requests
+    start, requests = 0, 0
+    for end, (_, line) in enumerate(df.iterrows(), start=1):
+        requests += len(chunk_text((line.get('text') or line.get('content')), chunk_tokens))
+        if requests >= BATCH_SIZE:
+            yield start, end
+            start, requests = end, 0
+    if start < len(df):
+        yield start, len(df)
+
+async def process_json_lines_chunked(df, writer, endpoints, template, wait_rate_limit, wait_time, chunk_tokens, sidecar=False):
+    total_words = 0
+    retry_limit = 5
+
+    with tqdm(total=len(df), desc="Processing lines") as pbar:
+        for start, end in chunked_batches(df, chunk_tokens):
+            for attempt in range(retry_limit + 1):
+                batch = df[start:end].copy()  # Make a copy to avoid SettingWithCopyWarning
+                get_auth_token()  # Refresh the token before processing each batch
+                async with client_session(request_timeout) as session:
+                    success, total_words, processed_batch = await process_batch_chunked(session, batch, endpoints, template, total_words, chunk_tokens)
+                if success:
+                    break
+                if attempt < retry_limit:
+                    logging.warning(f"Retrying batch {start}-{end} due to rate limit.")
+                    await asyncio.sleep(wait_rate_limit)  # Wait for wait_rate_limit seconds before retrying
+            else:
+                logging.error(f"Batch {start}-{end} failed after {retry_limit} attempts.")
+                dead_letters.add_frame(df[start:], RATE_LIMITED, retry_limit + 1)
+                break
+
+            await offload(writer.write_all, output_records(processed_batch, sidecar), stage="write")
+            pbar.update(len(batch))
+            logging.info(f"Processed lines {start}-{end}. Waiting {wait_time} seconds before next batch.")
+            with PROFILER.stage("pacing"):
+                await asyncio.sleep(wait_time)
+
+    logging.info(f"Total words processed (input + output): {total_words}")
+
+async def process_json_lines_batched(df, writer, endpoints, template, wait_rate_limit, wait_time, max_length, max_num_requests, sidecar=False):
     total_words = 0
     retry_limit = 5
-    retry_attempts = 0
     request_count = 0
+    total_requests = min(len(df), max_num_requests) if max_num_requests else len(df)
 
-    logging.info(f"Loading lines from {jsonl_file}...")
-    df = pd.read_json(jsonl_file, lines=True)
-    logging.info(f"Loaded {len(df)} lines from the file.")
+    with tqdm(total=total_requests, desc="Processing lines") as pbar:
+        for start in range(0, len(df), BATCH_SIZE):
+            if max_num_requests and request_count >= max_num_requests:
+                logging.info(f"Reached the maximum number of requests: {max_num_requests}. Stopping.")
+                break
 
-    endpoint = ENDPOINT_TEMPLATE.format(location=LOCATION, project_id=PROJECT_ID, model_id=model_id)
+            end = min(start + BATCH_SIZE, len(df))
+            batch_size = end - start
+            if max_num_requests:
+                batch_size = min(batch_size, max_num_requests - request_count)
 
-    with open(template_file, 'r') as f:
-        template = f.read()
-        if '{content}' not in template:
-            raise ValueError("Template file must contain '{content}' placeholder.")
-        
-        # Replace curly quotes with straight quotes
-        template = template.replace('“', '"').replace('”', '"')
-        logging.info(f"Template loaded successfully.")
+            for attempt in range(retry_limit + 1):
+                batch = df[start:start + batch_size].copy()  # Make a copy to avoid SettingWithCopyWarning
+                get_auth_token()  # Refresh the token before processing each batch
+                async with client_session(request_timeout) as session:
+                    success, total_words, processed_batch = await process_batch(session, batch, endpoints, template, total_words, max_length)
+                if success:
+                    break
+                if attempt < retry_limit:
+                    logging.warning(f"Retrying batch {start}-{end} due to rate limit.")
+                    await asyncio.sleep(wait_rate_limit)  # Wait for wait_rate_limit seconds before retrying
+            else:
+                # The rest of the file is not attempted; it goes to the dead-letter file for --retry_from
+                logging.error(f"Batch {start}-{end} failed after {retry_limit} attempts.")
+                remaining = max_num_requests - request_count if max_num_requests else len(df) - start
+                dead_letters.add_frame(df[start:start + remaining], RATE_LIMITED, retry_limit + 1)
+                break
+
+            await offload(writer.write_all, output_records(processed_batch, sidecar), stage="write")
+            pbar.update(len(batch))
+            logging.info(f"{len(batch)} of {batch_size} succeeded. Waiting {wait_time} seconds before next batch.")
+            with PROFILER.stage("pacing"):
+                await asyncio.sleep(wait_time)
+
+            request_count += len(batch)
+
+    logging.info(f"Total words processed (input + output): {total_words}")
+
+async def process_json_lines(jsonl_file, output_jsonl_file, template_file, dryrun, model_id, wait_rate_limit, wait_time, max_length, max_num_requests, chunk_tokens=None, response_schema_file=None, endpoints_file=None, timeout=None, hedge_budget=0, retry_from=None, dead_letter_file=None, compress_level=None):
+    # Imported here so --help and the planner, which only needs format_prompt, start quickly
+    import pandas as pd
+
+    global response_schema, request_timeout, hedger, dead_letters
+    PROFILER.watch_loop()
+    request_timeout = timeout or None
+    hedger = Hedger(hedge_budget) if hedge_budget else None
+    retried = None
+    if retry_from:
+        # Only the dead-letter records are re-run; their results are merged back into the existing output
+        with PROFILER.stage("read"):
+            retried = load_dead_letters(retry_from)
+            df = pd.DataFrame([entry["record"] for entry in retried])
+    else:
+        logging.info(f"Loading lines from {jsonl_file}...")
+        with PROFILER.stage("read"):
+            df = read_frame(jsonl_file)
+        logging.info(f"Loaded {len(df)} lines from the file.")
+
+    endpoints = EndpointPool.from_args(endpoints_file, PROJECT_ID, LOCATION, model_id, ENDPOINT_TEMPLATE)
+
+    template = load_template(template_file)
+
+    if response_schema_file:
+        response_schema = load_schema_file(response_schema_file)
 
     if dryrun:
         first_line = df.iloc[0]
-        input_text = trim_text((first_line.get('text') or first_line.get('content')), max_length)
-        chat_prompt = template.replace("{content}", input_text)
-        print(f"Dryrun: {chat_prompt}")
+        if chunk_tokens:
+            chunks = chunk_text((first_line.get('text') or first_line.get('content')), chunk_tokens)
+            print(f"Dryrun: first line splits into {len(chunks)} chunks. First chunk prompt: {template.replace('{content}', chunks[0] if chunks else '')}")
+            return
+        print(f"Dryrun: {format_prompt(first_line, template, max_length)}")
         return
 
-    total_requests = min(len(df), max_num_requests) if max_num_requests else len(df)
-    
-    with jsonlines.open(output_jsonl_file, mode='w') as writer:
-        with tqdm(total=total_requests, desc="Processing lines") as pbar:
-            for start in range(0, len(df), BATCH_SIZE):
-                if max_num_requests and request_count >= max_num_requests:
-                    logging.info(f"Reached the maximum number of requests: {max_num_requests}. Stopping.")
-                    break
-
-                end = min(start + BATCH_SIZE, len(df))
-                batch_size = end - start
+    # The output of a Parquet or Arrow input is a sidecar keyed by row index, without the text
+    sidecar = is_columnar(jsonl_file)
+    lag_monitor = LoopLagMonitor()
+    lag_monitor.start()
+    try:
+        # Closed with the failures of a run that raises too; the --retry_from file is only replaced when it completes
+        with DeadLetters(dead_letter_file or dead_letter_path(output_jsonl_file), retried=retried) as dead_letters, \
+                (MergeWriter(output_jsonl_file, retried) if retried else open_jsonl(output_jsonl_file, 'w', level=compress_level)) as writer:
+            if chunk_tokens:
+                # Whole documents are annotated, so --max_length does not apply; --max_num_requests limits documents
                 if max_num_requests:
-                    batch_size = min(batch_size, max_num_requests - request_count)
+                    df = df[:max_num_requests]
+                await process_json_lines_chunked(df, writer, endpoints, template, wait_rate_limit, wait_time, chunk_tokens, sidecar)
+            else:
+                await process_json_lines_batched(df, writer, endpoints, template, wait_rate_limit, wait_time, max_length, max_num_requests, sidecar)
+    finally:
+        lag_monitor.stop()
 
-                batch = df[start:start + batch_size].copy()  # Make a copy to avoid SettingWithCopyWarning
-                get_auth_token()  # Refresh the token before processing each batch
-                async with aiohttp.ClientSession() as session:
-                    success, total_words, processed_batch = await process_batch(session, batch, endpoint, template, total_words, max_length)
-
-                if not success:
-                    if retry_attempts < retry_limit:
-                        retry_attempts += 1
-                        logging.warning(f"Retrying batch {start}-{end} due to rate limit.")
-                        await asyncio.sleep(wait_rate_limit)  # Wait for wait_rate_limit seconds before retrying
-                        continue
-                    else:
-                        logging.error(f"Batch {start}-{end} failed after {retry_limit} attempts.")
-                        break
-                
-                retry_attempts = 0  # Reset retry attempts after successful batch
-                writer.write_all(processed_batch.to_dict(orient='records'))
-                pbar.update(len(batch))
-                logging.info(f"{len(batch)} of {batch_size} succeeded. Waiting {wait_time} seconds before next batch.")
-                await asyncio.sleep(wait_time)
+    log_response_stats()
+    logging.info(f"Endpoints: {endpoints.summary()}")
+    logging.info(f"Event loop lag: {lag_monitor.summary()}")
+    if sampled_log.counts:
+        logging.info(f"Request problems: {sampled_log.summary()}")
+    if hedger:
+        logging.info(f"Hedging: {hedger.summary()}")
+    PROFILER.report()
 
-                request_count += len(batch)
+async def process_json_files(jsonl_files, output_dir, template_file, dryrun, model_id, wait_rate_limit, wait_time, max_length, max_num_requests, response_schema_file=None, endpoints_file=None, timeout=None, hedge_budget=0, compress='auto', compress_level=None, max_open_files=MAX_OPEN_FILES):
+    global response_schema, request_timeout, hedger
+    PROFILER.watch_loop()
+    request_timeout = timeout or None
+    hedger = Hedger(hedge_budget) if hedge_budget else None
+    sources = make_sources(jsonl_files, output_dir, compress, compress_level)
+    endpoints = EndpointPool.from_args(endpoints_file, PROJECT_ID, LOCATION, model_id, ENDPOINT_TEMPLATE)
 
-                if max_num_requests and request_count >= max_num_requests:
-                    logging.info(f"Reached the maximum number of requests: {max_num_requests}. Stopping.")
-                    break
+    template = load_template(template_file)
 
-            # Process and write the last batch if it's not a multiple of BATCH_SIZE
-            if end < len(df) and (not max_num_requests or request_count < max_num_requests):
-                last_batch_size = (max_num_requests - request_count) if max_num_requests else len(df) - end
-                last_batch = df[end:end + last_batch_size].copy()
-                async with aiohttp.ClientSession() as session:
-                    success, total_words, processed_last_batch = await process_batch(session, last_batch, endpoint, template, total_words, max_length)
-                if success:
-                    writer.write_all(processed_last_batch.to_dict(orient='records'))
-                    pbar.update(len(last_batch))
-                    logging.info(f"Processed the last batch of {len(last_batch)} lines.")
+    if response_schema_file:
+        response_schema = load_schema_file(response_schema_file)
 
-    logging.info(f"Total words processed (input + output): {total_words}")
+    if dryrun:
+        for source in sources:
+            print(f"Dryrun: {source.input_file} -> {source.output_file}" + (f", resuming at line {source.start}" if source.start else ""))
+        return
 
+    def read(path):
+        df = read_frame(path)
+        logging.info(f"Loaded {len(df)} lines from {path}.")
+        return df
+
+    async def process(session, batch, batch_dead_letters):
+        return await process_batch(session, batch, endpoints, template, 0, max_length, batch_dead_letters)
+
+    lag_monitor = LoopLagMonitor()
+    lag_monitor.start()
+    try:
+        # Refresh the token before processing each batch; --max_num_requests counts requests over all files
+        total_words = await process_interleaved(sources, read, process, get_auth_token, BATCH_SIZE, wait_time, wait_rate_limit, request_timeout, max_open_files, max_num_requests)
+    finally:
+        lag_monitor.stop()
+    logging.info(f"Total words processed (input + output): {total_words}")
+    log_response_stats()
+    logging.info(f"Endpoints: {endpoints.summary()}")
+    logging.info(f"Event loop lag: {lag_monitor.summary()}")
+    if sampled_log.counts:
+        logging.info(f"Request problems: {sampled_log.summary()}")
+    if hedger:
+        logging.info(f"Hedging: {hedger.summary()}")
+    PROFILER.report()
 
 def main():
     parser = argparse.ArgumentParser(description="Process a JSONLines file with the Vertex AI API.")
-    parser.add_argument('--jsonl_file', type=str, required=True, help='Path to the JSONLines file.')
-    parser.add_argument('--output_jsonl_file', type=str, required=True, help='Path to the output JSONLines file.')
+    parser.add_argument('--jsonl_file', type=str, nargs='+', required=True, help='Path to the JSONLines file, or a Parquet or Arrow file of which only text, content and id are read; with --output_dir, any number of files, globs (quoted) or directories.')
+    parser.add_argument('--output_jsonl_file', type=str, help='Path to the output JSONLines file.')
+    parser.add_argument('--output_dir', type=str, help='Process every --jsonl_file in one run, interleaving their lines, and write <name>_processed.jsonl for each here. Rerunning resumes each file after its last written line.')
+    parser.add_argument('--max_open_files', type=int, default=MAX_OPEN_FILES, help=f'With --output_dir, how many input files are read into memory and interleaved at once (default: {MAX_OPEN_FILES}).')
     parser.add_argument('--template_file', type=str, required=True, help='Path to the template file.')
     parser.add_argument('--dryrun', action='store_true', help='Perform a dry run without sending requests.')
     parser.add_argument('--model_id', type=str, default='gemini-1.5-flash-001', help='Model ID to use for the API.')
     parser.add_argument('--wait_rate_limit', type=int, default=300, help='Rate limit in seconds for retrying after hitting rate limit (default: 300 seconds).')
     parser.add_argument('--wait_time', type=int, default=65, help='Wait time in seconds between batches (default: 65 seconds).')
     parser.add_argument('--max_length', type=int, default=1000, help='Maximum length of input text to be processed (default: 1000 characters).')
-    parser.add_argument('--max_num_requests', type=int, help='Maximum number of requests to process.')
+    parser.add_argument('--max_num_requests', type=int, help='Maximum number of requests to process; with --chunk_tokens, the maximum number of documents, each of which may take several requests.')
+    parser.add_argument('--response_schema_file', type=str, help='JSON file with a Vertex AI response schema; responses are validated against it and invalid ones re-requested.')
+    parser.add_argument('--endpoints_file', type=str, help='JSON list of {"project_id", "location", "rpm"} endpoints to load-balance over (default: the built-in project and region).')
+    parser.add_argument('--request_timeout', type=float, default=120, help='Deadline in seconds for each request, 0 for none (default: 120).')
+    parser.add_argument('--hedge_budget', type=float, default=0, help='Send a duplicate of requests slower than the observed p95 latency, for at most this fraction of requests (default: 0, off).')
+    parser.add_argument('--dead_letter_file', type=str, help='Where failed records are written with their error and attempt count (default: <output_jsonl_file>.dead.jsonl).')
+    parser.add_argument('--retry_from', type=str, help='Re-run only the records in this dead-letter file and merge the results into --output_jsonl_file.')
+    parser.add_argument('--compress', type=str, choices=COMPRESS_CHOICES, default='auto', help='Compress the output as .zst or .gz, or not at all; auto picks .zst when the input is compressed or at least 1 GB (default: auto). Output names ending in .gz or .zst are always compressed.')
+    parser.add_argument('--compress_level', type=int, help='zstd or gzip level for compressed output (default: 3 for zstd, 6 for gzip).')
+    parser.add_argument('--profile', action='store_true', help='Time the read, prompt, network, parse and write stages and write <output_jsonl_file>.profile.txt and a Chrome trace (<output_jsonl_file>.profile.trace.json).')
+    parser.add_argument('--profile_sample', action='store_true', help='With --profile, also sample the event-loop thread\'s stacks to <output_jsonl_file>.profile.samples.txt.')
+    parser.add_argument('--uvloop', action='store_true', help='Run on uvloop if it is installed.')
+    parser.add_argument('--chunk_tokens', type=int, help='Split whole documents on sentence boundaries into chunks of about this many tokens and send them concurrently instead of trimming to --max_length.')
 
     args = parser.parse_args()
+    if args.output_dir:
+        if args.output_jsonl_file or args.retry_from or args.dead_letter_file:
+            parser.error("--output_dir writes one output and dead-letter file per input; use --output_jsonl_file, --retry_from and --dead_letter_file for single files.")
+        if args.chunk_tokens:
+            parser.error("--chunk_tokens works on one --jsonl_file at a time.")
+        jsonl_files = expand_inputs(args.jsonl_file, accept=is_input)
+        if args.profile:
+            PROFILER.enable(profile_prefix(args.output_dir), args.profile_sample)
+        run(process_json_files(jsonl_files, args.output_dir, args.template_file, args.dryrun, args.model_id, args.wait_rate_limit, args.wait_time, args.max_length, args.max_num_requests, args.response_schema_file, args.endpoints_file, args.request_timeout, args.hedge_budget, args.compress, args.compress_level, args.max_open_files), args.uvloop)
+        return
+    if len(args.jsonl_file) != 1 or not args.output_jsonl_file:
+        parser.error("Give one --jsonl_file with --output_jsonl_file, or several with --output_dir.")
+    args.jsonl_file = args.jsonl_file[0]
+    args.output_jsonl_file = output_path(args.output_jsonl_file, [args.jsonl_file], args.compress)
 
-    asyncio.run(process_json_lines(args.jsonl_file, args.output_jsonl_file, args.template_file, args.dryrun, args.model_id, args.wait_rate_limit, args.wait_time, args.max_length, args.max_num_requests))
+    if args.profile:
+        PROFILER.enable(profile_prefix(args.output_jsonl_file), args.profile_sample)
+    run(process_json_lines(args.jsonl_file, args.output_jsonl_file, args.template_file, args.dryrun, args.model_id, args.wait_rate_limit, args.wait_time, args.max_length, args.max_num_requests, args.chunk_tokens, args.response_schema_file, args.endpoints_file, args.request_timeout, args.hedge_budget, args.retry_from, args.dead_letter_file, args.compress_level), args.uvloop)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,76 @@
+import time
+import asyncio
+from collections import Counter, deque
+
+# Latencies kept for the p95 estimate, and how many are needed before hedging starts
+LATENCY_WINDOW = 500
+MIN_LATENCY_SAMPLES = 20
+
+def is_answer(result):
+    # send_request returns (idx, response); only a response dict is a usable answer
+    return isinstance(result[1], dict)
+
+class Hedger:
+    # Sends a duplicate of any request still running after the observed p95 latency.
+    # The first usable answer wins and the other request is cancelled.
+    def __init__(self, budget):
+        self.budget = budget
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.stats = Counter()
+
+    def p95(self):
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def can_hedge(self):
+        # Hedges are capped at a fraction of all requests sent so far
+        return self.stats["fired"] + 1 <= self.budget * self.stats["requests"]
+
+    async def timed(self, make_request):
+        start = time.monotonic()
+        result = await make_request()
+        if is_answer(result):
+            self.latencies.append(time.monotonic() - start)
+        return result
+
+    async def run(self, make_request):
+        self.stats["requests"] += 1
+        primary = asyncio.ensure_future(self.timed(make_request))
+        delay = self.p95()
+        if delay is None:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self.can_hedge():
+            return await primary
+
+        self.stats["fired"] += 1
+        hedge = asyncio.ensure_future(self.timed(make_request))
+        pending = {primary, hedge}
+        finished = []
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if is_answer(task.result()):
+                    for loser in pending:
+                        loser.cancel()
+                    if task is hedge:
+                        self.stats["won"] += 1
+                    return task.result()
+                finished.append(task.result())
+        # Neither produced an answer: pass on a rate limit or auth error so the caller reacts to it
+        for signal in ('unauthorized', 'rate_limit'):
+            for result in finished:
+                if result[1] == signal:
+                    return result
+        return primary.result()
+
+    def summary(self):
+        p95 = self.p95()
+        return f"{self.stats['fired']} hedges fired, {self.stats['won']} won, over {self.stats['requests']} requests (p95 latency {p95:.1f}s)." if p95 else f"{self.stats['fired']} hedges fired over {self.stats['requests']} requests."
+
+async def send_hedged(hedger, make_request):
+    if hedger is None:
+        return await make_request()
+    return await hedger.run(make_request)
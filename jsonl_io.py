@@ -0,0 +1,197 @@
+import io
+import os
+import gzip
+import json
+import shutil
+import logging
+import jsonlines
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Compression by file suffix; everything else is read and written as plain JSONL
+SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+# Default levels: zstd 3 compresses about as well as gzip 6 at several times the speed
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+# Compression threads per zstd writer; -1 uses every core
+ZSTD_THREADS = -1
+# With --compress auto, outputs of inputs at least this large are compressed
+LARGE_INPUT_BYTES = 1 << 30
+# Rough compression ratio of JSONL text, for sizing in-memory buckets from compressed inputs
+COMPRESSION_RATIO = 4
+# Buffer between the (de)compressor and the line reader or writer
+BUFFER_SIZE = 1 << 20
+
+COMPRESS_CHOICES = ['auto', 'none', 'zst', 'gz']
+
+def loads(line):
+    if orjson:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # orjson rejects the bare NaN that pandas writes for missing scores
+            pass
+    return json.loads(line)
+
+def compression(path):
+    return SUFFIXES.get(os.path.splitext(path)[1])
+
+def strip_compression(path):
+    # nob_90000.jsonl.zst -> nob_90000.jsonl
+    root, ext = os.path.splitext(path)
+    return root if ext in SUFFIXES else path
+
+def is_jsonl(path):
+    return strip_compression(path).endswith(".jsonl")
+
+def zstd_available():
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+def open_file(path, mode='r', level=None, like=None):
+    # Opens plain, .gz and .zst files alike. mode is 'r', 'w' or 'a', plus 'b' for bytes; text is UTF-8.
+    # like=<path> compresses as that path would be, for temporary files that are renamed into place.
+    # Appends to a compressed file go through a plain pending file; see PendingAppend.
+    kind = compression(like or path)
+    binary = 'b' in mode
+    base = mode.replace('b', '').replace('t', '')
+    if kind is None:
+        return open(path, mode) if binary else open(path, base, encoding='utf-8')
+    if base == 'a':
+        stream = io.BufferedWriter(PendingAppend(path, level), BUFFER_SIZE)
+    elif kind == "gzip":
+        stream = gzip.open(path, base + 'b', compresslevel=level or GZIP_LEVEL)
+    else:
+        # Imported here so plain and gzip files need no zstandard
+        import zstandard
+
+        raw = open(path, base + 'b')
+        if base == 'r':
+            # Every run that appended added a frame, so reads continue across frames
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True), BUFFER_SIZE)
+        else:
+            compressor = zstandard.ZstdCompressor(level=level or ZSTD_LEVEL, threads=ZSTD_THREADS)
+            stream = io.BufferedWriter(compressor.stream_writer(raw, closefd=True), BUFFER_SIZE)
+    return stream if binary else io.TextIOWrapper(stream, encoding='utf-8')
+
+def open_jsonl(path, mode='r', flush=False, level=None):
+    # jsonlines.open for plain, .gz and .zst files
+    if compression(path) is None:
+        return jsonlines.open(path, mode=mode, flush=flush or None)
+    fp = open_file(path, mode, level)
+    instance = jsonlines.Reader(fp) if mode == 'r' else jsonlines.Writer(fp, flush=flush)
+    # Closing the reader or writer closes the file, as with jsonlines.open
+    instance._should_close_fp = True
+    return instance
+
+def data_size(path):
+    # Bytes of JSONL in the file, estimated for compressed files
+    size = os.path.getsize(path)
+    return size * COMPRESSION_RATIO if compression(path) else size
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open_file(path, 'rb') as f:
+        return sum(1 for _ in f)
+
+def pending_path(path):
+    return f"{path}.pending"
+
+class PendingAppend(io.FileIO):
+    # Appending to a .gz or .zst output writes plain lines to <output>.pending, which is compressed onto the
+    # output as one new gzip member or zstd frame on close. A killed run leaves the pending file rather than a
+    # cut-off member or frame, and the next resume merges it.
+    def __init__(self, path, level=None):
+        self.output_file = path
+        self.level = level
+        merge_pending(path, level)
+        super().__init__(pending_path(path), 'a')
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            merge_pending(self.output_file, self.level)
+
+def drop_partial_line(path):
+    # Cuts a plain file back to its last newline, dropping a line left half-written by a killed run
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        size = end
+        while size > 0:
+            step = min(size, BUFFER_SIZE)
+            f.seek(size - step)
+            newline = f.read(step).rfind(b'\n')
+            if newline >= 0:
+                size += newline + 1 - step
+                break
+            size -= step
+        if size < end:
+            logging.warning(f"Dropping {end - size} bytes of a partial last line from {path}.")
+            f.truncate(size)
+
+def merge_pending(path, level=None):
+    # The output is copied and the new member or frame added to the copy, which then replaces it,
+    # so the output is never left cut off however the merge is interrupted
+    pending = pending_path(path)
+    if not os.path.exists(pending):
+        return
+    drop_partial_line(pending)
+    if os.path.getsize(pending):
+        tmp_file = f"{path}.merge"
+        with open(tmp_file, 'wb') as raw:
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, raw, BUFFER_SIZE)
+            if compression(path) == "gzip":
+                out = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level or GZIP_LEVEL)
+            else:
+                # Imported here so plain and gzip files need no zstandard
+                import zstandard
+
+                out = zstandard.ZstdCompressor(level=level or ZSTD_LEVEL, threads=ZSTD_THREADS).stream_writer(raw, closefd=False)
+            with out, open(pending, 'rb') as f:
+                shutil.copyfileobj(f, out, BUFFER_SIZE)
+        os.replace(tmp_file, path)
+    os.remove(pending)
+
+def count_complete_lines(path):
+    # count_lines for an output being resumed, so the count and the next append both start at a line boundary:
+    # a plain file loses a partial last line, and a compressed one first takes in the lines a killed run left pending
+    if compression(path):
+        merge_pending(path)
+        try:
+            return count_lines(path)
+        except Exception as e:
+            # EOFError for a cut-off gzip member, ZstdError for a cut-off zstd frame
+            raise ValueError(f"{path} is cut off or damaged ({e}), so it cannot be resumed. Move it aside and rerun, or decompress what is readable and resume from the plain file.") from e
+    if not os.path.exists(path):
+        return 0
+    drop_partial_line(path)
+    return count_lines(path)
+
+def output_path(path, input_files, compress='auto'):
+    # --compress: 'none' keeps the name, 'zst' and 'gz' add the suffix, and 'auto' adds .zst (.gz without zstandard)
+    # when an input is compressed or the inputs add up to LARGE_INPUT_BYTES. A name that already ends in .gz or .zst
+    # is kept, and an existing output, plain or compressed, is reused so resumes and --retry_from land in the same file.
+    if compress == 'none' or compression(path):
+        return path
+    if compress == 'auto':
+        if os.path.exists(path):
+            return path
+        for suffix in SUFFIXES:
+            if os.path.exists(path + suffix):
+                return path + suffix
+        inputs = [input_file for input_file in input_files if input_file and os.path.exists(input_file)]
+        if not any(compression(input_file) for input_file in inputs) and sum(os.path.getsize(input_file) for input_file in inputs) < LARGE_INPUT_BYTES:
+            return path
+        compress = 'zst' if zstd_available() else 'gz'
+    compressed = f"{path}.{compress}"
+    logging.info(f"Writing compressed output to {compressed}.")
+    return compressed
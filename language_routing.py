@@ -0,0 +1,65 @@
+import re
+import logging
+from collections import Counter
+from loop_tools import SampledLog
+
+# Prompt languages in template.json and template_linguistic.json
+LANGUAGES = ['en', 'sv', 'da', 'nb', 'nn']
+# Codes seen in corpus metadata (GlotCC uses nob_Latn, fastText lid.176 labels Norwegian as no)
+LANGUAGE_ALIASES = {
+    'eng': 'en',
+    'swe': 'sv',
+    'dan': 'da',
+    'nob': 'nb',
+    'nno': 'nn',
+    'no': 'nb',
+    'nor': 'nb',
+}
+
+# Characters of text given to the language-ID model
+LANGID_CHARS = 1000
+
+def normalize_language(value):
+    if not isinstance(value, str):
+        return None
+    code = re.split(r'[-_]', value.strip().lower())[0]
+    code = LANGUAGE_ALIASES.get(code, code)
+    return code if code in LANGUAGES else None
+
+class LanguageRouter:
+    # Picks the prompt language per record: from a metadata field when it names one of LANGUAGES,
+    # otherwise from a fastText language-ID model, otherwise the default language.
+    # templates are the languages the loaded templates have; any other language falls back to the default.
+    def __init__(self, default_language, language_field=None, model_path=None, templates=LANGUAGES):
+        self.default_language = default_language
+        self.language_field = language_field
+        self.templates = set(templates)
+        self.sampled_log = SampledLog()
+        self.model = None
+        if model_path:
+            # Imported here so routing on a metadata field needs no fasttext install
+            import fasttext
+            self.model = fasttext.load_model(model_path)
+        self.stats = Counter()
+
+    def detect(self, text):
+        labels, _ = self.model.predict(text[:LANGID_CHARS].replace('\n', ' '))
+        return normalize_language(labels[0].replace('__label__', ''))
+
+    def __call__(self, line):
+        language = normalize_language(line.get(self.language_field)) if self.language_field else None
+        if language is None and self.model is not None:
+            language = self.detect(line.get('text') or line.get('content') or '')
+        if language is None:
+            self.stats['default'] += 1
+            return self.default_language
+        if language not in self.templates:
+            # e.g. nn with template_linguistic.json, or a language a --combine_with file lacks
+            self.sampled_log.log(logging.WARNING, "no_template", "No template for language %s; using %s.", language, self.default_language)
+            self.stats[f'{language} (no template)'] += 1
+            return self.default_language
+        self.stats[language] += 1
+        return language
+
+    def summary(self):
+        return ", ".join(f"{language}: {count}" for language, count in self.stats.most_common())
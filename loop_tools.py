@@ -0,0 +1,111 @@
+import time
+import json
+import asyncio
+import logging
+from collections import Counter, deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from profiler import PROFILER
+
+# Threads for CPU work taken off the event loop, and how many such jobs may be queued at once
+CPU_WORKERS = 4
+CPU_QUEUE_SIZE = 8
+# Response bodies smaller than this are decoded on the loop; a thread hop costs more than the parse
+OFFLOAD_BYTES = 64 * 1024
+
+# How often the loop-lag monitor wakes up, in seconds, and how many of the latest samples it keeps (an hour's worth)
+LAG_INTERVAL = 0.05
+LAG_SAMPLES = 72000
+
+# Per-record messages are logged for the first few occurrences of a kind, then every LOG_EVERY-th
+LOG_FIRST = 5
+LOG_EVERY = 100
+
+cpu_pool = None
+cpu_slots = None
+
+async def offload(fn, *args, stage=None):
+    # Runs fn in the CPU pool so socket reads are not held up; the semaphore bounds the queue.
+    # With --profile the job is timed as stage and its time in the queue as a cpu_pool wait.
+    global cpu_pool, cpu_slots
+    if cpu_pool is None:
+        cpu_pool = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+    if cpu_slots is None:
+        cpu_slots = asyncio.Semaphore(CPU_QUEUE_SIZE)
+    if PROFILER.enabled:
+        fn = partial(profiled, fn, stage or fn.__name__, time.perf_counter())
+    async with cpu_slots:
+        return await asyncio.get_running_loop().run_in_executor(cpu_pool, partial(fn, *args))
+
+def profiled(fn, stage, submitted, *args):
+    PROFILER.wait("cpu_pool", time.perf_counter() - submitted)
+    with PROFILER.stage(stage):
+        return fn(*args)
+
+async def read_json(response):
+    body = await response.read()
+    if len(body) < OFFLOAD_BYTES:
+        return json.loads(body)
+    return await offload(json.loads, body, stage="decode")
+
+def client_session(timeout=None):
+    # aiohttp is imported here so scripts that import the generators for their prompts do not load it
+    import aiohttp
+    return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout))
+
+def run(coro, use_uvloop=False):
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning("uvloop is not installed; using the default event loop.")
+        else:
+            return uvloop.run(coro)
+    return asyncio.run(coro)
+
+class SampledLog:
+    # Keeps per-record logging cheap at high concurrency: counts every event, logs a sample
+    def __init__(self):
+        self.counts = Counter()
+
+    def log(self, level, kind, message, *args):
+        self.counts[kind] += 1
+        count = self.counts[kind]
+        if count <= LOG_FIRST or count % LOG_EVERY == 0:
+            logging.log(level, f"[{kind} #{count}] " + message, *args)
+
+    def summary(self):
+        return ", ".join(f"{kind}: {count}" for kind, count in self.counts.most_common())
+
+class LoopLagMonitor:
+    # Measures how late the event loop wakes up a task that sleeps LAG_INTERVAL seconds;
+    # lag means CPU work on the loop thread is delaying socket reads. Percentiles are over the latest
+    # LAG_SAMPLES samples; the maximum and the sample count cover the whole run.
+    def __init__(self):
+        self.lags = deque(maxlen=LAG_SAMPLES)
+        self.samples = 0
+        self.max_lag = 0.0
+        self.task = None
+
+    async def watch(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = time.perf_counter() - start - LAG_INTERVAL
+            self.lags.append(lag)
+            self.samples += 1
+            self.max_lag = max(self.max_lag, lag)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.watch())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    def summary(self):
+        if not self.lags:
+            return "no samples"
+        ordered = sorted(self.lags)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+        return f"p50 {pick(0.5):.1f} ms, p99 {pick(0.99):.1f} ms over the last {len(ordered)} samples, max {self.max_lag * 1000:.1f} ms over {self.samples}"
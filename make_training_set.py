@@ -0,0 +1,115 @@
+import os
+import math
+import random
+import argparse
+import logging
+import tempfile
+from jsonl_io import COMPRESS_CHOICES, data_size, loads, open_file, output_path
+from convert_jsonl_to_parquet import scatter_to_buckets, iter_shuffled_rows, write_parquet_shards
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def file_language(path):
+    # da_processed.jsonl -> da
+    return os.path.basename(path).split('_')[0].split('.')[0]
+
+def score_bucket(value):
+    try:
+        return str(int(round(float(value))))
+    except (TypeError, ValueError):
+        return "none"
+
+def stratum_key(line, language, stratify_by, language_field, score_field):
+    parts = []
+    if "score" in stratify_by or language_field:
+        record = loads(line)
+        if language_field:
+            language = record.get(language_field, language)
+    if "language" in stratify_by:
+        parts.append(language)
+    if "score" in stratify_by:
+        parts.append(score_bucket(record.get(score_field)))
+    return "_".join(parts) or "all"
+
+def split_lines(input_files, validation_size, rng, stratify_by, language_field, score_field, reservoirs):
+    # Reservoir sampling per stratum: validation lines stay in the reservoir, everything it
+    # rejects or evicts is yielded to the training stream, so every input is read exactly once
+    seen = {}
+    for input_file in input_files:
+        language = file_language(input_file)
+        with open_file(input_file, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                key = stratum_key(line, language, stratify_by, language_field, score_field)
+                reservoir = reservoirs.setdefault(key, [])
+                seen[key] = seen.get(key, 0) + 1
+                if len(reservoir) < validation_size:
+                    reservoir.append(line)
+                    continue
+                slot = rng.randrange(seen[key])
+                if slot < validation_size:
+                    line, reservoir[slot] = reservoir[slot], line
+                yield line
+
+def write_lines(lines, output_file, level=None):
+    with open_file(output_file, 'wb', level) as f:
+        for line in lines:
+            f.write(line if line.endswith(b'\n') else line + b'\n')
+
+def make_training_set(input_files, output_dir, validation_size, seed=None, stratify_by=("language",), language_field=None, score_field="educational score", output_format="jsonl", num_parts=8, bucket_size_mb=256, row_group_size=10000, compress='auto', compress_level=None):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    rng = random.Random(seed)
+    stratify_by = set(stratify_by)
+    input_bytes = sum(data_size(input_file) for input_file in input_files)
+
+    def jsonl_output(name):
+        return output_path(os.path.join(output_dir, name), input_files, compress)
+    num_buckets = max(1, math.ceil(input_bytes / (bucket_size_mb * 1024 * 1024)))
+
+    with tempfile.TemporaryDirectory(dir=output_dir) as bucket_dir:
+        reservoirs = {}
+        train_lines = split_lines(input_files, validation_size, rng, stratify_by, language_field, score_field, reservoirs)
+        bucket_files, num_rows = scatter_to_buckets(train_lines, bucket_dir, num_buckets, rng)
+
+        validation = []
+        for key, lines in sorted(reservoirs.items()):
+            write_lines(lines, jsonl_output(f"validation_{key}.jsonl"), compress_level)
+            validation.extend(lines)
+            logging.info(f"Stratum {key}: {len(lines)} validation lines.")
+        rng.shuffle(validation)
+
+        if output_format == "parquet":
+            # Both splits share one schema, so a field first seen in the training rows is added to validation too
+            shards = {}
+            write_parquet_shards(validation, len(validation), output_dir, 1, row_group_size, split='validation', shards=shards)
+            write_parquet_shards(iter_shuffled_rows(bucket_files, rng), num_rows, output_dir, num_parts, row_group_size, shards=shards)
+        else:
+            write_lines(validation, jsonl_output("validation.jsonl"), compress_level)
+            write_lines(iter_shuffled_rows(bucket_files, rng), jsonl_output("train.jsonl"), compress_level)
+
+    logging.info(f"Wrote {len(validation)} validation and {num_rows} training lines to {output_dir}.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Split processed JSONLines files into shuffled, stratified train and validation sets.")
+    parser.add_argument('--input_files', type=str, nargs='+', required=True, help='Processed JSONLines files, e.g. da_processed.jsonl en_processed.jsonl.')
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory to save the train and validation files.')
+    parser.add_argument('--validation_size', type=int, default=2500, help='Validation lines per stratum (default: 2500).')
+    parser.add_argument('--seed', type=int, help='Seed for sampling and shuffling (default: random).')
+    parser.add_argument('--stratify_by', type=str, nargs='+', choices=['language', 'score'], default=['language'], help='Strata for the validation sets (default: language).')
+    parser.add_argument('--language_field', type=str, help='Take the language from this field instead of the file name prefix.')
+    parser.add_argument('--score_field', type=str, default='educational score', help='Score field used for score strata (default: educational score).')
+    parser.add_argument('--output_format', type=str, choices=['jsonl', 'parquet'], default='jsonl', help='Write JSONL or Parquet shards (default: jsonl).')
+    parser.add_argument('--num_parts', type=int, default=8, help='Number of Parquet training shards (default: 8).')
+    parser.add_argument('--bucket_size_mb', type=float, default=256, help='Approximate size of each in-memory shuffle bucket in MB (default: 256).')
+    parser.add_argument('--compress', type=str, choices=COMPRESS_CHOICES, default='auto', help='Compress the JSONL outputs as .zst or .gz, or not at all; auto picks .zst when an input is compressed or the inputs add up to 1 GB (default: auto).')
+    parser.add_argument('--compress_level', type=int, help='zstd or gzip level for compressed output (default: 3 for zstd, 6 for gzip).')
+    args = parser.parse_args()
+
+    make_training_set(args.input_files, args.output_dir, args.validation_size, args.seed, args.stratify_by, args.language_field, args.score_field, args.output_format, args.num_parts, args.bucket_size_mb, compress=args.compress, compress_level=args.compress_level)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import glob
+import asyncio
+import logging
+from tqdm import tqdm
+from dead_letter import DeadLetters, dead_letter_path
+from jsonl_io import count_complete_lines, is_jsonl, open_jsonl, output_path, strip_compression
+from columnar_input import is_columnar, output_records
+from loop_tools import client_session, offload
+from profiler import PROFILER
+
+# Input files read into memory at once; the rest wait until one of them is done
+MAX_OPEN_FILES = 8
+# Attempts per file slice when a batch hits the rate limit
+RETRY_LIMIT = 5
+
+def expand_inputs(patterns, accept=is_jsonl):
+    # Files, globs and directories (every .jsonl, .jsonl.gz and .jsonl.zst in them, or whatever accept(name) takes),
+    # in order and without duplicates
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(os.path.join(pattern, name) for name in os.listdir(pattern) if accept(name))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        files.extend(path for path in matches if path not in files)
+    if not files:
+        raise ValueError(f"No input files match {' '.join(patterns)}.")
+    return files
+
+def output_file_for(input_file, output_dir, compress='auto'):
+    # nob_90000.jsonl (or nob_90000.parquet) -> <output_dir>/nob_90000_processed.jsonl, the naming the README and make_training_set.py use
+    stem = os.path.basename(strip_compression(input_file))[:-len(".jsonl")] if is_jsonl(input_file) else os.path.splitext(os.path.basename(input_file))[0]
+    return output_path(os.path.join(output_dir, f"{stem}_processed.jsonl"), [input_file], compress)
+
+class Source:
+    # One input file of an interleaved run: its output and dead letters, and how far it has got.
+    # Lines already in the output are skipped, so rerunning the same command resumes every file.
+    def __init__(self, input_file, output_file, compress_level=None):
+        self.input_file = input_file
+        self.output_file = output_file
+        self.name = os.path.basename(input_file)
+        self.compress_level = compress_level
+        # Parquet and Arrow inputs get sidecar outputs keyed by row index, without the text
+        self.sidecar = is_columnar(input_file)
+        self.start = count_complete_lines(output_file)
+        self.df = None
+        self.position = 0
+        self.written = 0
+        self.writer = None
+        self.dead_letters = None
+
+    async def open(self, read):
+        df = await offload(read, self.input_file, stage="read")
+        self.df = df[self.start:]
+        self.writer = open_jsonl(self.output_file, 'a', level=self.compress_level)
+        # Appended to, like the output, so resumed runs keep earlier failures
+        self.dead_letters = DeadLetters(dead_letter_path(self.output_file), mode='a')
+        if self.start:
+            logging.info(f"{self.name}: resuming at line {self.start}.")
+        return len(self.df)
+
+    def remaining(self):
+        return len(self.df) - self.position
+
+    def take(self, count):
+        # The frame keeps the input's line numbers as its index, which the dead letters record
+        batch = self.df[self.position:self.position + count].copy()  # Make a copy to avoid SettingWithCopyWarning
+        self.position += len(batch)
+        return batch
+
+    async def write(self, processed):
+        await offload(self.writer.write_all, output_records(processed, self.sidecar), stage="write")
+        self.written += len(processed)
+
+    def close(self):
+        complete = self.written == len(self.df)
+        self.writer.close()
+        self.dead_letters.close()
+        self.df = None
+        logging.info(f"{self.name}: {'done' if complete else 'stopped'}, {self.start + self.written} lines in {self.output_file}.")
+
+def make_sources(input_files, output_dir, compress='auto', compress_level=None):
+    os.makedirs(output_dir, exist_ok=True)
+    sources = [Source(input_file, output_file_for(input_file, output_dir, compress), compress_level) for input_file in input_files]
+    outputs = [source.output_file for source in sources]
+    duplicates = sorted({output for output in outputs if outputs.count(output) > 1})
+    if duplicates:
+        raise ValueError(f"Several inputs would write to {', '.join(duplicates)}; give them separate --output_dir runs.")
+    return sources
+
+def share_out(active, batch_size):
+    # Splits one batch over the open files round-robin, so every file moves on each batch and the
+    # batch stays full while short files run out. Returns [(source, count)] with one entry per file.
+    counts = {source: 0 for source in active}
+    left = batch_size
+    while left:
+        open_sources = [source for source in active if source.remaining() > counts[source]]
+        if not open_sources:
+            break
+        share = max(1, left // len(open_sources))
+        for source in open_sources:
+            extra = min(share, source.remaining() - counts[source], left)
+            counts[source] += extra
+            left -= extra
+            if not left:
+                break
+    return [(source, count) for source, count in counts.items() if count]
+
+async def process_slice(session, source, batch, process, wait_rate_limit):
+    # process(session, batch, dead_letters) returns (success, words, processed_batch) like the generators' process_batch
+    for attempt in range(RETRY_LIMIT + 1):
+        success, words, processed = await process(session, batch.copy(), source.dead_letters)
+        if success:
+            return processed, words
+        if attempt < RETRY_LIMIT:
+            logging.warning(f"{source.name}: retrying lines {batch.index[0]}-{batch.index[-1] + 1} due to rate limit.")
+            await asyncio.sleep(wait_rate_limit)
+    return None, 0
+
+async def process_interleaved(sources, read, process, before_batch, batch_size, wait_time, wait_rate_limit, request_timeout=None, max_open_files=MAX_OPEN_FILES, limit=None):
+    # Scores many input files as one run: each batch of batch_size requests is drawn from up to max_open_files
+    # files, sent over one session and endpoint pool, and paced once with wait_time. Every file's lines are
+    # written to its own output in input order. Returns the number of words sent and received.
+    waiting = list(sources)
+    active = []
+    total_words = 0
+    processed_rows = 0
+    finished = 0
+    with tqdm(total=0, desc="Processing lines", unit="line") as pbar:
+        async with client_session(request_timeout) as session:
+            while True:
+                while waiting and len(active) < max_open_files:
+                    source = waiting.pop(0)
+                    remaining = await source.open(read)
+                    pbar.total += remaining
+                    pbar.refresh()
+                    if remaining:
+                        active.append(source)
+                    else:
+                        source.close()
+                        finished += 1
+                if not active or (limit and processed_rows >= limit):
+                    break
+
+                size = min(batch_size, limit - processed_rows) if limit else batch_size
+                slices = [(source, source.take(count)) for source, count in share_out(active, size)]
+                before_batch()
+                results = await asyncio.gather(*(process_slice(session, source, batch, process, wait_rate_limit) for source, batch in slices))
+
+                stopped = False
+                for (source, batch), (processed, words) in zip(slices, results):
+                    if processed is None:
+                        # Nothing of this slice is written, so the next run resumes the file here
+                        logging.error(f"{source.name}: lines from {batch.index[0]} failed after {RETRY_LIMIT} attempts. Rerun to resume.")
+                        stopped = True
+                        continue
+                    await source.write(processed)
+                    total_words += words
+                    processed_rows += len(batch)
+                    pbar.update(len(batch))
+                if stopped:
+                    break
+
+                for source in [source for source in active if not source.remaining()]:
+                    active.remove(source)
+                    source.close()
+                    finished += 1
+                pbar.set_postfix(files=f"{finished}/{len(sources)}", open=len(active))
+                if active or waiting:
+                    logging.info(f"{sum(len(batch) for _, batch in slices)} lines from {len(slices)} files done. Waiting {wait_time} seconds before next batch.")
+                    with PROFILER.stage("pacing"):
+                        await asyncio.sleep(wait_time)
+    for source in active:
+        source.close()
+    logging.info(f"Finished {finished} of {len(sources)} files.")
+    return total_words
@@ -0,0 +1,164 @@
+import re
+import time
+import random
+import asyncio
+from collections import Counter
+from loop_tools import read_json
+
+# Groq's OpenAI-compatible API; any /chat/completions server (vLLM, Together, the stub server) works with --base_url
+DEFAULT_BASE_URL = "https://api.groq.com/openai/v1"
+DEFAULT_MODEL = "llama-3.1-8b-instant"
+DEFAULT_API_KEY_ENV = "GROQ_API_KEY"
+
+# Attempts per request on 429, 5xx and connection errors before the record is given up
+MAX_ATTEMPTS = 5
+# Backoff for 5xx, connection errors and 429s without a reset header, doubled per attempt
+BASE_BACKOFF = 1
+MAX_BACKOFF = 60
+# Output tokens requested per response, also budgeted against the remaining token quota
+MAX_TOKENS = 512
+# Local estimate of prompt tokens for the token quota, as in plan_run.py
+CHARS_PER_TOKEN = 4
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+
+def parse_duration(value):
+    # Reset headers look like "2m59.56s", "7.66s" or "500ms"; retry-after is plain seconds
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+class RequestError(Exception):
+    def __init__(self, message, attempts):
+        super().__init__(message)
+        self.attempts = attempts
+
+class RateLimiter:
+    # Paces requests from the x-ratelimit-* headers of the responses: once the remaining requests or tokens
+    # of the current window are used up, new requests wait for the window's reset instead of drawing 429s.
+    # Between responses the remaining counts are drawn down locally for every request sent.
+    # max_rpm optionally spaces requests evenly for servers that send no rate-limit headers.
+    def __init__(self, max_rpm=None):
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.requests_reset_at = 0.0
+        self.tokens_reset_at = 0.0
+        self.blocked_until = 0.0
+        self.interval = 60 / max_rpm if max_rpm else 0
+        self.next_slot = 0.0
+        self.held = 0
+
+    def update(self, headers, now=None):
+        now = time.monotonic() if now is None else now
+        remaining = headers.get('x-ratelimit-remaining-requests')
+        if remaining is not None:
+            self.remaining_requests = int(float(remaining))
+            self.requests_reset_at = now + (parse_duration(headers.get('x-ratelimit-reset-requests')) or 0)
+        remaining = headers.get('x-ratelimit-remaining-tokens')
+        if remaining is not None:
+            self.remaining_tokens = int(float(remaining))
+            self.tokens_reset_at = now + (parse_duration(headers.get('x-ratelimit-reset-tokens')) or 0)
+        retry_after = parse_duration(headers.get('retry-after'))
+        if retry_after:
+            self.block(retry_after, now)
+        return retry_after
+
+    def block(self, seconds, now=None):
+        now = time.monotonic() if now is None else now
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def delay(self, tokens, now):
+        # Seconds to wait before a request of about this many tokens may go out; at 0 the request is counted
+        wait = max(self.blocked_until, self.next_slot) - now
+        if self.remaining_requests is not None:
+            if now >= self.requests_reset_at:
+                self.remaining_requests = None
+            elif self.remaining_requests < 1:
+                wait = max(wait, self.requests_reset_at - now)
+        if self.remaining_tokens is not None:
+            if now >= self.tokens_reset_at:
+                self.remaining_tokens = None
+            elif self.remaining_tokens < tokens:
+                wait = max(wait, self.tokens_reset_at - now)
+        if wait > 0:
+            return wait
+        if self.remaining_requests is not None:
+            self.remaining_requests -= 1
+        if self.remaining_tokens is not None:
+            self.remaining_tokens -= tokens
+        self.next_slot = now + self.interval
+        return 0
+
+    async def acquire(self, tokens):
+        held = False
+        while True:
+            wait = self.delay(tokens, time.monotonic())
+            if wait <= 0:
+                self.held += held
+                return
+            held = True
+            await asyncio.sleep(wait)
+
+class ChatClient:
+    # Sends prompts to an OpenAI-compatible /chat/completions endpoint in JSON mode and returns the message text
+    def __init__(self, base_url, model, api_key, concurrency, generation_config, max_rpm=None):
+        self.url = base_url.rstrip('/') + "/chat/completions"
+        self.model = model
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        self.generation_config = generation_config
+        self.slots = asyncio.Semaphore(concurrency)
+        self.limiter = RateLimiter(max_rpm)
+        self.stats = Counter()
+
+    def payload(self, prompt):
+        return dict(self.generation_config, model=self.model, messages=[{"role": "user", "content": prompt}], response_format={"type": "json_object"})
+
+    async def complete(self, session, prompt):
+        tokens = len(prompt) // CHARS_PER_TOKEN + self.generation_config.get("max_tokens", MAX_TOKENS)
+        error = None
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await self.limiter.acquire(tokens)
+            backoff = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+            async with self.slots:
+                try:
+                    async with session.post(self.url, headers=self.headers, json=self.payload(prompt)) as response:
+                        retry_after = self.limiter.update(response.headers)
+                        self.stats[response.status] += 1
+                        if response.status == 200:
+                            result = await read_json(response)
+                            usage = result.get("usage") or {}
+                            self.stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                            self.stats["completion_tokens"] += usage.get("completion_tokens", 0)
+                            return result["choices"][0]["message"]["content"]
+                        body = await response.text()
+                        if response.status in (401, 403):
+                            raise PermissionError(f"{self.url} refused the API key ({response.status}): {body[:200]}")
+                        error = f"HTTP {response.status}: {body[:200]}"
+                        if response.status == 429:
+                            if not retry_after:
+                                self.limiter.block(backoff)
+                            continue
+                        # Groq answers 400 json_validate_failed when the model's output is not JSON; that is worth another try
+                        if response.status < 500 and "json_validate_failed" not in body:
+                            raise RequestError(error, attempt)
+                except (RequestError, PermissionError):
+                    raise
+                except Exception as e:
+                    error = repr(e)
+            await asyncio.sleep(backoff)
+        raise RequestError(error, MAX_ATTEMPTS)
+
+    def summary(self):
+        statuses = {status: count for status, count in self.stats.items() if isinstance(status, int)}
+        return f"statuses {statuses}, {self.stats['prompt_tokens']} prompt and {self.stats['completion_tokens']} completion tokens, {self.limiter.held} requests held back for rate limits"
@@ -0,0 +1,110 @@
+import json
+import time
+import zlib
+import random
+import asyncio
+import argparse
+import logging
+from aiohttp import web
+from response_schema import FIELD_TYPES, SCORE_RANGES, mentions_field
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Length of the stub's rate-limit window in seconds, like the per-minute windows of the real APIs
+WINDOW = 60
+
+def fake_answer(prompt):
+    # Every response field the prompt asks for; scores come from a hash of the prompt so reruns agree
+    seed = zlib.crc32(prompt.encode('utf-8'))
+    answer = {}
+    for field, field_type in FIELD_TYPES.items():
+        if not mentions_field(prompt, field):
+            continue
+        if field_type == "INTEGER":
+            low, high = SCORE_RANGES.get(field, (0, 5))
+            answer[field] = low + seed % (high - low + 1)
+        else:
+            answer[field] = "Stub answer."
+    return answer
+
+class StubServer:
+    # A local stand-in for an OpenAI-compatible /v1/chat/completions endpoint with JSON mode.
+    # It sends Groq-style x-ratelimit-* headers, answers 429 with retry-after once the window's
+    # requests or tokens are used up, and can inject latency, 5xx errors and invalid JSON.
+    def __init__(self, rpm, tpm, latency, fail_rate, invalid_rate, seed=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.invalid_rate = invalid_rate
+        self.rng = random.Random(seed)
+        self.window_start = time.monotonic()
+        self.requests = 0
+        self.tokens = 0
+
+    def rate_headers(self, now):
+        reset = max(0.0, self.window_start + WINDOW - now)
+        return {
+            "x-ratelimit-limit-requests": str(self.rpm),
+            "x-ratelimit-remaining-requests": str(max(0, self.rpm - self.requests)),
+            "x-ratelimit-reset-requests": f"{reset:.2f}s",
+            "x-ratelimit-limit-tokens": str(self.tpm),
+            "x-ratelimit-remaining-tokens": str(max(0, self.tpm - self.tokens)),
+            "x-ratelimit-reset-tokens": f"{reset:.2f}s",
+        }
+
+    async def chat_completions(self, request):
+        if not request.headers.get("Authorization", "").startswith("Bearer "):
+            return web.json_response({"error": {"message": "Missing API key."}}, status=401)
+        body = await request.json()
+        prompt = "\n".join(message.get("content", "") for message in body.get("messages", []))
+        prompt_tokens = len(prompt) // 4
+
+        now = time.monotonic()
+        if now >= self.window_start + WINDOW:
+            self.window_start, self.requests, self.tokens = now, 0, 0
+        if self.requests >= self.rpm or self.tokens + prompt_tokens > self.tpm:
+            headers = dict(self.rate_headers(now), **{"retry-after": str(max(1, round(self.window_start + WINDOW - now)))})
+            return web.json_response({"error": {"message": "Rate limit reached.", "type": "requests"}}, status=429, headers=headers)
+        self.requests += 1
+        self.tokens += prompt_tokens
+
+        if self.latency:
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.latency)
+        if self.rng.random() < self.fail_rate:
+            return web.json_response({"error": {"message": "Injected server error."}}, status=503, headers=self.rate_headers(now))
+
+        content = json.dumps(fake_answer(prompt), ensure_ascii=False)
+        if self.rng.random() < self.invalid_rate:
+            content = content[:len(content) // 2]
+        completion_tokens = len(content) // 4
+        return web.json_response({
+            "id": f"chatcmpl-stub-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }, headers=self.rate_headers(now))
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a stub OpenAI-compatible chat completions API for testing singleline_groq.py without a real endpoint.")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1).')
+    parser.add_argument('--port', type=int, default=8089, help='Port to listen on (default: 8089).')
+    parser.add_argument('--rpm', type=int, default=600, help='Requests per minute before answering 429 (default: 600).')
+    parser.add_argument('--tpm', type=int, default=1000000, help='Prompt tokens per minute before answering 429 (default: 1000000).')
+    parser.add_argument('--latency', type=float, default=0.2, help='Mean response latency in seconds (default: 0.2).')
+    parser.add_argument('--fail_rate', type=float, default=0, help='Fraction of requests answered with 503 (default: 0).')
+    parser.add_argument('--invalid_rate', type=float, default=0, help='Fraction of answers with truncated, invalid JSON (default: 0).')
+    parser.add_argument('--seed', type=int, help='Seed for latency and injected failures.')
+    args = parser.parse_args()
+
+    server = StubServer(args.rpm, args.tpm, args.latency, args.fail_rate, args.invalid_rate, args.seed)
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', server.chat_completions)
+    logging.info(f"Stub API at http://{args.host}:{args.port}/v1")
+    web.run_app(app, host=args.host, port=args.port, print=None)
+
+if __name__ == "__main__":
+    main()
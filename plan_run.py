@@ -0,0 +1,205 @@
+import os
+import json
+import math
+import argparse
+import logging
+import importlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from response_schema import read_templates
+from jsonl_io import compression, loads, open_file
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Vertex AI API details for the countTokens calibration
+PROJECT_ID = "north-390910"
+LOCATION = "us-central1"
+COUNT_TOKENS_TEMPLATE = "https://{location}-aiplatform.googleapis.com/v1/projects/{project_id}/locations/{location}/publishers/google/models/{model_id}:countTokens"
+
+# Local estimate before calibration, the same figure the chunked NER mode uses
+DEFAULT_CHARS_PER_TOKEN = 4
+
+# Byte ranges per worker, so a few slow ranges do not hold up the scan
+RANGES_PER_WORKER = 4
+
+SCRIPTS = ['generate_async', 'generate_async_linguistic', 'generic_generate_async', 'submit_batch_job']
+
+def script_module(script):
+    module = importlib.import_module(script)
+    if script == 'generate_async_linguistic':
+        # A wrapper that runs generate_async.py with its own template file
+        import generate_async
+        generate_async.TEMPLATE_FILE = module.TEMPLATE_FILE
+        return generate_async
+    return module
+
+def prompt_builder(script, language, template_file, max_length, chunk_tokens):
+    # Uses the script's own trimming and templating, so the plan matches what the run sends.
+    # Returns a function from a record to the prompts sent for it.
+    module = script_module(script)
+    if script == 'generic_generate_async':
+        template = module.load_template(template_file)
+        if chunk_tokens:
+            return lambda record: [template.replace("{content}", chunk) for chunk in module.chunk_text((record.get('text') or record.get('content')), chunk_tokens)]
+        return lambda record: [module.format_prompt(record, template, max_length)]
+    if script == 'submit_batch_job':
+        chat_prompt = read_templates('template.json')[0][language]
+        return lambda record: [prompt for prompt in [module.format_prompt(record, chat_prompt)] if prompt]
+    module.load_templates()
+    return lambda record: [module.format_prompt(record, language)]
+
+def byte_ranges(input_file, num_ranges):
+    if compression(input_file):
+        # A compressed stream cannot be entered in the middle, so it is scanned as one range
+        return [(0, None)]
+    size = os.path.getsize(input_file)
+    step = max(1, math.ceil(size / num_ranges))
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+def scan_range(input_file, start, end, builder_args, sample_size):
+    # A line belongs to the range its first byte falls in
+    build = prompt_builder(*builder_args)
+    counts = Counter()
+    sample = []
+    with open_file(input_file, 'rb') as f:
+        if start:
+            f.seek(start - 1)
+            start += len(f.readline()) - 1
+        pos = start
+        while end is None or pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            if not line.strip():
+                continue
+            try:
+                prompts = build(loads(line))
+            except (TypeError, AttributeError, ValueError):
+                # No text or content field: the real run would skip or fail on this record
+                counts['skipped'] += 1
+                continue
+            counts['records'] += 1
+            counts['requests'] += len(prompts)
+            for prompt in prompts:
+                counts['prompt_chars'] += len(prompt)
+                if len(sample) < sample_size:
+                    sample.append(prompt)
+    return counts, sample
+
+def scan_file(input_file, builder_args, num_workers, calibration_size):
+    ranges = byte_ranges(input_file, num_workers * RANGES_PER_WORKER)
+    # The calibration sample is spread over the file rather than taken from its head
+    sample_size = math.ceil(calibration_size / max(len(ranges), 1))
+    totals = Counter()
+    sample = []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(scan_range, input_file, start, end, builder_args, sample_size) for start, end in ranges]
+        for future in futures:
+            counts, range_sample = future.result()
+            totals.update(counts)
+            sample.extend(range_sample)
+    return totals, sample[:calibration_size]
+
+def calibrate_chars_per_token(prompts, model_id):
+    # Imported here so planning without calibration needs no credentials
+    import requests
+    from google.auth import default
+    from google.auth.transport.requests import Request
+
+    credentials, _ = default()
+    credentials.refresh(Request())
+    headers = {
+        "Authorization": f"Bearer {credentials.token}",
+        "Content-Type": "application/json",
+    }
+    endpoint = COUNT_TOKENS_TEMPLATE.format(location=LOCATION, project_id=PROJECT_ID, model_id=model_id)
+    total_chars = total_tokens = 0
+    for prompt in prompts:
+        response = requests.post(endpoint, headers=headers, json={"contents": [{"role": "user", "parts": [{"text": prompt}]}]})
+        response.raise_for_status()
+        total_chars += len(prompt)
+        total_tokens += response.json()["totalTokens"]
+    chars_per_token = total_chars / max(total_tokens, 1)
+    logging.info(f"Calibrated on {len(prompts)} prompts with countTokens: {chars_per_token:.2f} characters per token.")
+    return chars_per_token
+
+def endpoint_rpm(endpoints_file, rpm):
+    if not endpoints_file:
+        return rpm
+    from endpoint_pool import DEFAULT_RPM
+    with open(endpoints_file, 'r') as f:
+        return sum(entry.get("rpm", DEFAULT_RPM) for entry in json.load(f))
+
+def format_duration(minutes):
+    if minutes < 120:
+        return f"{minutes:.0f} min"
+    return f"{minutes / 60:.1f} h"
+
+def plan(args):
+    builder_args = (args.script, args.language, args.template_file, args.max_length, args.chunk_tokens)
+    logging.info(f"Scanning {args.jsonl_file} as {args.script} would format it...")
+    counts, sample = scan_file(args.jsonl_file, builder_args, args.num_workers, args.calibrate)
+
+    chars_per_token = args.chars_per_token
+    if args.calibrate and sample:
+        chars_per_token = calibrate_chars_per_token(sample, args.model_id)
+
+    requests = counts['requests']
+    input_tokens = counts['prompt_chars'] / chars_per_token
+    output_tokens = requests * args.output_tokens
+    online_cost = (input_tokens * args.input_price + output_tokens * args.output_price) / 1e6
+    batch_cost = online_cost * (1 - args.batch_discount)
+
+    logging.info(f"Records: {counts['records']} ({counts['skipped']} without text), requests: {requests}.")
+    logging.info(f"Input tokens: {input_tokens:,.0f} (at {chars_per_token:.2f} characters per token), expected output tokens: {output_tokens:,.0f}.")
+    logging.info(f"Cost: ${online_cost:,.2f} online, ${batch_cost:,.2f} as a batch job.")
+
+    if args.script == 'submit_batch_job':
+        logging.info(f"Batch wall time: up to {args.batch_turnaround_hours} h per job.")
+        return
+    # Online runs are held back by whichever is slowest: the request quota, the token quota,
+    # or the scripts' own pacing of BATCH_SIZE requests per wait_time seconds
+    module = script_module(args.script)
+    wait_time = getattr(module, 'WAIT_TIME', args.wait_time)
+    rpm = endpoint_rpm(args.endpoints_file, args.rpm)
+    limits = {
+        "requests per minute": requests / rpm,
+        "tokens per minute": (input_tokens + output_tokens) / args.tpm,
+        "batch pacing": math.ceil(requests / module.BATCH_SIZE) * wait_time / 60,
+    }
+    bound = max(limits, key=limits.get)
+    logging.info(f"Online wall time: {format_duration(limits[bound])}, bound by {bound} ({', '.join(f'{name}: {format_duration(minutes)}' for name, minutes in limits.items())}).")
+    logging.info(f"Batch wall time: up to {args.batch_turnaround_hours} h per job.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate requests, tokens, cost and wall time for a generation run over a whole JSONLines file.")
+    parser.add_argument('--jsonl_file', type=str, required=True, help='Path to the JSONLines file.')
+    parser.add_argument('--script', type=str, choices=SCRIPTS, default='generate_async', help='Script whose trimming and templating are used (default: generate_async).')
+    parser.add_argument('--language', type=str, choices=['en', 'sv', 'da', 'nb', 'nn'], default='en', help='Language for the prompt (default: en).')
+    parser.add_argument('--template_file', type=str, help='Template file for generic_generate_async.')
+    parser.add_argument('--max_length', type=int, default=1000, help='--max_length of generic_generate_async (default: 1000 characters).')
+    parser.add_argument('--chunk_tokens', type=int, help='--chunk_tokens of generic_generate_async.')
+    parser.add_argument('--output_tokens', type=int, default=150, help='Expected output tokens per request (default: 150).')
+    parser.add_argument('--chars_per_token', type=float, default=DEFAULT_CHARS_PER_TOKEN, help=f'Characters per token for the local estimate (default: {DEFAULT_CHARS_PER_TOKEN}).')
+    parser.add_argument('--calibrate', type=int, default=0, help='Calibrate characters per token with countTokens on this many sampled prompts (default: 0, off).')
+    parser.add_argument('--model_id', type=str, default='gemini-1.5-flash-001', help='Model ID used for countTokens.')
+    parser.add_argument('--input_price', type=float, default=0.075, help='USD per million input tokens; check current pricing (default: 0.075).')
+    parser.add_argument('--output_price', type=float, default=0.30, help='USD per million output tokens; check current pricing (default: 0.30).')
+    parser.add_argument('--batch_discount', type=float, default=0.5, help='Discount for batch jobs (default: 0.5).')
+    parser.add_argument('--batch_turnaround_hours', type=float, default=24, help='Upper bound on batch job wall time (default: 24).')
+    parser.add_argument('--rpm', type=int, default=200, help='Requests per minute quota (default: 200).')
+    parser.add_argument('--tpm', type=int, default=4000000, help='Tokens per minute quota (default: 4000000).')
+    parser.add_argument('--endpoints_file', type=str, help='Endpoint pool of the run; its summed rpm replaces --rpm.')
+    parser.add_argument('--wait_time', type=int, default=65, help='--wait_time of generic_generate_async (default: 65 seconds).')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Processes scanning the file (default: all cores).')
+
+    args = parser.parse_args()
+
+    if args.script == 'generic_generate_async' and not args.template_file:
+        parser.error("--template_file is required with --script generic_generate_async.")
+    plan(args)
+
+if __name__ == "__main__":
+    main()
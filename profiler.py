@@ -0,0 +1,226 @@
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing.util
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+
+# Trace events kept per process; stage totals are still counted past this
+MAX_EVENTS = 200000
+# Interval of the --profile_sample stack sampler in seconds
+SAMPLE_INTERVAL = 0.005
+# Sampled stacks listed in the summary
+TOP_STACKS = 15
+# A loop thread sampled inside one of these is idle, waiting on sockets, timers or the CPU pool
+IDLE_FUNCTIONS = {'select', 'poll', 'epoll', 'kqueue', 'control'}
+
+NULL_STAGE = nullcontext()
+
+class Stage:
+    # Wall time with perf_counter and CPU time of the calling thread with thread_time
+    __slots__ = ('profiler', 'name', 'start', 'cpu')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start, time.thread_time() - self.cpu)
+
+class Profiler:
+    # Per-stage wall and CPU time, queue waits and a Chrome trace (chrome://tracing or ui.perfetto.dev).
+    # Off by default: stage() then returns a shared no-op context, so the instrumented code pays one call.
+    # Worker processes write a part file on exit that the parent merges into its report.
+    def __init__(self):
+        self.enabled = False
+        self.prefix = None
+        self.stages = defaultdict(lambda: [0, 0.0, 0.0, 0.0])  # count, wall, cpu, max wall
+        self.waits = defaultdict(lambda: [0, 0.0, 0.0])  # count, total, max
+        self.events = []
+        self.samples = Counter()
+        self.lock = threading.Lock()
+        self.loop = None
+        self.sampler = None
+        self.started = None
+
+    def enable(self, prefix, sample=False):
+        self.enabled = True
+        self.prefix = prefix
+        self.started = time.perf_counter()
+        if sample:
+            self.sampler = threading.Thread(target=self.sample, args=(threading.main_thread().ident,), daemon=True, name="profile-sampler")
+            self.sampler.start()
+
+    def enable_worker(self, prefix, sample=False):
+        # A forked child starts from the parent's counters, so they are cleared first.
+        # multiprocessing children leave through os._exit, so the part file is written by its finalizer.
+        self.stages.clear()
+        self.waits.clear()
+        self.events = []
+        self.samples = Counter()
+        self.enable(prefix, sample)
+        multiprocessing.util.Finalize(None, self.write_part, exitpriority=10)
+
+    def watch_loop(self):
+        # Lets the sampler name the asyncio task running on the loop
+        self.loop = asyncio.get_running_loop()
+
+    def stage(self, name):
+        return Stage(self, name) if self.enabled else NULL_STAGE
+
+    def timed(self, name, iterable):
+        # For lazily consumed iterators (reading while writing): the time spent producing items
+        # is recorded as one stage entry once the iterator is exhausted
+        if not self.enabled:
+            return iterable
+        return self.time_items(name, iterable)
+
+    def time_items(self, name, iterable):
+        iterator = iter(iterable)
+        start = time.perf_counter()
+        wall = cpu = 0.0
+        while True:
+            began, began_cpu = time.perf_counter(), time.thread_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                wall += time.perf_counter() - began
+                cpu += time.thread_time() - began_cpu
+            yield item
+        self.record(name, start, wall, cpu)
+
+    def record(self, name, start, wall, cpu):
+        with self.lock:
+            stats = self.stages[name]
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] += cpu
+            stats[3] = max(stats[3], wall)
+            self.add_event({"name": name, "ph": "X", "ts": start * 1e6, "dur": wall * 1e6, "args": {"cpu_ms": round(cpu * 1000, 3)}})
+
+    def wait(self, name, seconds):
+        # Time a job spent queued before it started, e.g. for a CPU-pool thread or a prefetched batch
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.waits[name]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            self.add_event({"name": f"wait {name}", "cat": "wait", "ph": "X", "ts": (time.perf_counter() - seconds) * 1e6, "dur": seconds * 1e6})
+
+    def add_event(self, event):
+        if len(self.events) < MAX_EVENTS:
+            event["pid"] = os.getpid()
+            event["tid"] = threading.get_ident()
+            self.events.append(event)
+
+    def current_task(self):
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return None
+        task = getattr(asyncio.tasks, '_current_tasks', {}).get(loop)
+        return task.get_coro().__qualname__ if task is not None else None
+
+    def sample(self, thread_id):
+        # Collapsed stacks (flamegraph.pl / speedscope format) of the main thread, outermost frame first
+        while self.enabled:
+            time.sleep(SAMPLE_INTERVAL)
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack[0].rsplit(':', 1)[1] in IDLE_FUNCTIONS:
+                key = "[event loop idle]"
+            else:
+                task = self.current_task()
+                key = ";".join(([f"task {task}"] if task else []) + stack[::-1])
+            self.samples[key] += 1
+
+    def state(self):
+        return {"stages": dict(self.stages), "waits": dict(self.waits), "events": self.events, "samples": dict(self.samples)}
+
+    def write_part(self):
+        self.enabled = False
+        with open(f"{self.prefix}.part-{os.getpid()}.json", 'w') as f:
+            json.dump(self.state(), f)
+
+    def merge_parts(self):
+        for part_file in glob.glob(f"{glob.escape(self.prefix)}.part-*.json"):
+            with open(part_file, 'r') as f:
+                part = json.load(f)
+            os.remove(part_file)
+            for name, (count, wall, cpu, longest) in part["stages"].items():
+                stats = self.stages[name]
+                stats[0] += count
+                stats[1] += wall
+                stats[2] += cpu
+                stats[3] = max(stats[3], longest)
+            for name, (count, total, longest) in part["waits"].items():
+                stats = self.waits[name]
+                stats[0] += count
+                stats[1] += total
+                stats[2] = max(stats[2], longest)
+            self.events.extend(part["events"])
+            self.samples.update(part["samples"])
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        lines = [f"Profile over {elapsed:.1f} s of wall time (stages in worker processes and threads overlap)",
+                 f"{'stage':<16}{'count':>10}{'wall s':>12}{'cpu s':>12}{'mean ms':>12}{'max ms':>12}"]
+        for name, (count, wall, cpu, longest) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<16}{count:>10}{wall:>12.2f}{cpu:>12.2f}{wall / count * 1000:>12.1f}{longest * 1000:>12.1f}")
+        if self.waits:
+            lines.append(f"{'queue wait':<16}{'count':>10}{'total s':>12}{'':>12}{'mean ms':>12}{'max ms':>12}")
+            for name, (count, total, longest) in sorted(self.waits.items(), key=lambda item: -item[1][1]):
+                lines.append(f"{name:<16}{count:>10}{total:>12.2f}{'':>12}{total / count * 1000:>12.1f}{longest * 1000:>12.1f}")
+        if self.samples:
+            total = sum(self.samples.values())
+            lines.append(f"Top sampled stacks of the main thread ({total} samples every {SAMPLE_INTERVAL * 1000:.0f} ms):")
+            for stack, count in self.samples.most_common(TOP_STACKS):
+                lines.append(f"{count / total:>7.1%}  {' <- '.join(stack.split(';')[::-1][:4])}")
+        return "\n".join(lines)
+
+    def report(self):
+        # Writes <prefix>.txt, <prefix>.trace.json and, when sampling, <prefix>.samples.txt
+        if not self.enabled:
+            return
+        self.enabled = False
+        if self.sampler:
+            self.sampler.join()
+        self.merge_parts()
+        summary = self.summary()
+        logging.info("\n" + summary)
+        with open(f"{self.prefix}.txt", 'w') as f:
+            f.write(summary + "\n")
+        with open(f"{self.prefix}.trace.json", 'w') as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        if self.samples:
+            with open(f"{self.prefix}.samples.txt", 'w') as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        logging.info(f"Profile written to {self.prefix}.txt and {self.prefix}.trace.json.")
+
+def enable_worker(prefix, sample=False):
+    # Module-level so it can be a ProcessPoolExecutor initializer
+    PROFILER.enable_worker(prefix, sample)
+
+def profile_prefix(output):
+    return f"{output.rstrip(os.sep)}.profile"
+
+PROFILER = Profiler()
@@ -0,0 +1,108 @@
+import os
+import re
+import json
+import logging
+from collections import Counter
+
+# Directory of the scripts, where template.json and template_linguistic.json are shipped
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Response fields the templates ask for, with their Vertex AI schema type and allowed range
+FIELD_TYPES = {
+    "reason": "STRING",
+    "educational score": "INTEGER",
+    "cleanliness score": "INTEGER",
+    "trimmed cleanliness score": "INTEGER",
+    "trimmed reason": "STRING",
+}
+SCORE_RANGES = {
+    "educational score": (0, 5),
+    "cleanliness score": (0, 5),
+    "trimmed cleanliness score": (0, 5),
+}
+
+# Number of times an invalid response is re-requested before the line is given up
+INVALID_RETRIES = 2
+
+# Counts of valid and invalid responses for the whole run
+RESPONSE_STATS = Counter()
+
+def mentions_field(template, field):
+    # Fields appear either quoted ("reason" and "educational score") or as a bullet ("• reason: ...")
+    name = re.escape(field)
+    return re.search(rf'["“]{name}["”]|•\s*{name}\s*:', template) is not None
+
+def derive_schema(template):
+    fields = [field for field in FIELD_TYPES if mentions_field(template, field)]
+    if not fields:
+        return None
+    return {
+        "type": "OBJECT",
+        "properties": {field: {"type": FIELD_TYPES[field]} for field in fields},
+        "required": fields,
+    }
+
+def template_path(template_file):
+    # A template in the working directory wins, as before; otherwise the one shipped with the scripts,
+    # so the installed askllm command works from any directory
+    if os.path.isabs(template_file) or os.path.exists(template_file):
+        return template_file
+    return os.path.join(SCRIPT_DIR, template_file)
+
+def read_templates(template_file):
+    # Returns ({language: template}, {language: schema})
+    with open(template_path(template_file), 'r') as f:
+        templates = json.load(f)
+    return templates, {language: derive_schema(template) for language, template in templates.items()}
+
+def load_schema_file(schema_file):
+    with open(schema_file, 'r') as f:
+        return json.load(f)
+
+def with_schema(generation_config, schema):
+    if schema is None:
+        return generation_config
+    return dict(generation_config, response_schema=schema)
+
+def validate_response(response_json, schema):
+    # Returns a list of problems; an empty list means the response can be used as is
+    if schema is None:
+        return []
+    if schema.get("type") == "ARRAY":
+        if not isinstance(response_json, list):
+            return ["response is not a JSON array"]
+        return [error for item in response_json for error in validate_response(item, schema.get("items"))]
+    if not isinstance(response_json, dict):
+        return ["response is not a JSON object"]
+    errors = []
+    for field in schema.get("required", []):
+        if field not in response_json:
+            errors.append(f"missing '{field}'")
+    for field, spec in schema.get("properties", {}).items():
+        if field not in response_json:
+            continue
+        value = response_json[field]
+        if spec.get("type") == "INTEGER":
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or int(value) != value:
+                errors.append(f"'{field}' is not an integer: {value!r}")
+            elif field in SCORE_RANGES and not SCORE_RANGES[field][0] <= value <= SCORE_RANGES[field][1]:
+                errors.append(f"'{field}' out of range: {value}")
+        elif spec.get("type") == "STRING" and not isinstance(value, str):
+            errors.append(f"'{field}' is not a string: {value!r}")
+    return errors
+
+def parse_response(response_text, schema):
+    # Returns (response_json, errors) and updates RESPONSE_STATS
+    try:
+        response_json = json.loads(response_text)
+    except (TypeError, ValueError):
+        response_json, errors = None, ["response is not valid JSON"]
+    else:
+        errors = validate_response(response_json, schema)
+    RESPONSE_STATS["invalid" if errors else "valid"] += 1
+    return response_json, errors
+
+def log_response_stats():
+    total = RESPONSE_STATS["valid"] + RESPONSE_STATS["invalid"]
+    if total:
+        logging.info(f"Responses: {RESPONSE_STATS['valid']} valid, {RESPONSE_STATS['invalid']} invalid ({RESPONSE_STATS['invalid'] / total:.1%}), {RESPONSE_STATS['given_up']} lines given up.")
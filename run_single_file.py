@@ -1,40 +1,59 @@
-import torch
 import argparse
-import jsonlines
 import os
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
-from datasets import Dataset
+import time
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from tqdm import tqdm
+from token_cache import token_cache_path, open_token_cache, map_token_cache, cached_inputs, resume_row, save_row, remove_row_index
+from profiler import PROFILER, profile_prefix
+from jsonl_io import COMPRESS_CHOICES, compression, count_complete_lines, open_file, open_jsonl, output_path
+from columnar_input import count_records, is_columnar, iter_records, without_text
+
+# Number of tokenised batches kept in flight ahead of the model in worker mode
+PREFETCH_BATCHES = 2
+
+def load_model(args):
+    # torch, transformers and datasets are imported in the functions that use them, so --help and
+    # the askllm commands that do not classify start without them
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification
+    import torch
+
+    with PROFILER.stage("load"):
+        tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+        model = AutoModelForSequenceClassification.from_pretrained(args.model_name, torch_dtype=torch.bfloat16)
+    return tokenizer, model
 
 def main(args):
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
-    model = AutoModelForSequenceClassification.from_pretrained(args.model_name, torch_dtype=torch.bfloat16)
+    import torch
+    from datasets import Dataset
+
+    tokenizer, model = load_model(args)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model.to(device)
 
-    # Load local jsonlines file
-    with jsonlines.open(args.input_file) as reader:
-        data = [line for line in reader]
+    # Load local jsonlines file, or the text and id columns of a Parquet or Arrow file
+    with PROFILER.stage("read"):
+        data = list(iter_records(args.input_file, [args.text_column]))
 
-    # Convert list of dictionaries to dictionary of lists
-    data_dict = {key: [d[key] for d in data] for key in data[0]}
-    dataset = Dataset.from_dict(data_dict)
+        # Convert list of dictionaries to dictionary of lists
+        data_dict = {key: [d[key] for d in data] for key in data[0]}
+        dataset = Dataset.from_dict(data_dict)
 
     # Check how many lines have already been written to the output file
-    if os.path.exists(args.output_file):
-        with open(args.output_file, 'r') as f:
-            existing_lines = sum(1 for _ in f)
+    remove_row_index(args.output_file)
+    existing_lines = count_complete_lines(args.output_file)
+    if existing_lines > 0:
         print(f"Skipping {existing_lines} already processed lines.")
-    else:
-        existing_lines = 0
 
     # Skip already processed lines
     if existing_lines > 0:
         dataset = dataset.select(range(existing_lines, len(dataset)))
 
     def compute_scores(batch):
-        inputs = tokenizer(batch[args.text_column], return_tensors="pt", padding="longest", truncation=True, max_length=args.max_length).to(device)
-        with torch.no_grad():
+        with PROFILER.stage("tokenize"):
+            inputs = tokenizer(batch[args.text_column], return_tensors="pt", padding="longest", truncation=True, max_length=args.max_length).to(device)
+        with PROFILER.stage("infer"), torch.no_grad():
             outputs = model(**inputs)
             logits = outputs.logits.squeeze(-1).float().cpu().numpy()
 
@@ -43,20 +62,223 @@ def main(args):
         return batch
 
     # Process and write each batch incrementally
-    with jsonlines.open(args.output_file, mode='a') as writer:
+    with open_jsonl(args.output_file, 'a', level=args.compress_level) as writer:
         for batch in tqdm(dataset.iter(batch_size=args.batch_size), total=(len(dataset) + args.batch_size - 1) // args.batch_size):
             processed_batch = compute_scores(batch)
-            writer.write_all([dict(zip(batch.keys(), vals)) for vals in zip(*processed_batch.values())])
+            with PROFILER.stage("write"):
+                records = [dict(zip(batch.keys(), vals)) for vals in zip(*processed_batch.values())]
+                writer.write_all([without_text(record, [args.text_column]) for record in records] if args.sidecar else records)
 
-if __name__ == "__main__":
+def main_cached(args):
+    import torch
+
+    tokenizer, model = load_model(args)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+    model.eval()
+
+    cache_path = token_cache_path(args.token_cache_dir, args.input_file, args.model_name, args.text_column, args.max_length, args.token_cache_full_hash)
+    with PROFILER.stage("tokenize"):
+        table = open_token_cache(cache_path, args.input_file, tokenizer, args.text_column, args.max_length)
+
+    # Resume from the row index checkpoint instead of re-counting output lines
+    start = resume_row(args.output_file)
+    if start > 0:
+        print(f"Skipping {start} already processed lines.")
+
+    with open_jsonl(args.output_file, 'a', flush=True) as writer:
+        batches = iter_batches(args.input_file, start, table.num_rows, args.batch_size, args.text_column)
+        for row in tqdm(range(start, table.num_rows, args.batch_size), total=(table.num_rows - start + args.batch_size - 1) // args.batch_size):
+            end = min(row + args.batch_size, table.num_rows)
+            with PROFILER.stage("cache_read"):
+                inputs = {key: value.to(device) for key, value in cached_inputs(table, row, end, tokenizer.pad_token_id).items()}
+            write_scored(model, writer, next(batches), inputs, args)
+            save_row(args.output_file, end)
+
+def split_cores(num_workers):
+    # Give every worker a disjoint, contiguous slice of the cores we are allowed to run on
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    per_worker = max(1, len(cores) // num_workers)
+    return [cores[i * per_worker:(i + 1) * per_worker] or cores[-1:] for i in range(num_workers)]
+
+def part_file_name(output_file, start, end):
+    return f"{output_file}.part-{start:012d}-{end:012d}"
+
+def iter_batches(input_file, start, end, batch_size, text_column):
+    records = iter_records(input_file, [text_column], start, end)
+    while True:
+        with PROFILER.stage("read"):
+            batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def score_shard(args, worker_id, start, end, cores, part_file):
+    import torch
+
+    if args.profile:
+        PROFILER.enable_worker(profile_prefix(args.output_file), args.profile_sample)
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    num_threads = args.threads_per_worker or max(1, len(cores) - args.tokenizer_threads)
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+    tokenizer, model = load_model(args)
+    model.eval()
+
+    if args.token_cache_dir:
+        score_shard_cached(args, worker_id, start, end, tokenizer, model, part_file)
+        return
+
+    # Per-worker resume: the part file holds this shard's finished lines
+    remove_row_index(part_file)
+    done = count_complete_lines(part_file)
+    start += done
+    if start >= end:
+        return
+
+    def tokenize(batch):
+        with PROFILER.stage("tokenize"):
+            texts = [record[args.text_column] for record in batch]
+            return batch, tokenizer(texts, return_tensors="pt", padding="longest", truncation=True, max_length=args.max_length)
+
+    # Tokenisation runs in its own thread pool and stays PREFETCH_BATCHES ahead of inference
+    with ThreadPoolExecutor(max_workers=args.tokenizer_threads) as pool, open_jsonl(part_file, 'a') as writer:
+        pending = []
+        batches = iter_batches(args.input_file, start, end, args.batch_size, args.text_column)
+        progress = tqdm(total=(end - start + args.batch_size - 1) // args.batch_size, desc=f"Worker {worker_id}", position=worker_id)
+        for batch in batches:
+            pending.append(pool.submit(tokenize, batch))
+            if len(pending) <= PREFETCH_BATCHES:
+                continue
+            write_scored(model, writer, *prefetched(pending.pop(0)), args)
+            progress.update(1)
+        for future in pending:
+            write_scored(model, writer, *prefetched(future), args)
+            progress.update(1)
+        progress.close()
+
+def prefetched(future):
+    # Time the model sits idle waiting for the tokenizer threads
+    waiting = time.perf_counter()
+    result = future.result()
+    PROFILER.wait("tokenizer", time.perf_counter() - waiting)
+    return result
+
+def score_shard_cached(args, worker_id, start, end, tokenizer, model, part_file):
+    table = map_token_cache(args.token_cache_file)
+
+    # Per-worker resume from the part file's row index checkpoint
+    done = resume_row(part_file)
+    batches = iter_batches(args.input_file, start + done, end, args.batch_size, args.text_column)
+    with open_jsonl(part_file, 'a', flush=True) as writer:
+        for row in tqdm(range(start + done, end, args.batch_size), desc=f"Worker {worker_id}", position=worker_id):
+            batch_end = min(row + args.batch_size, end)
+            with PROFILER.stage("cache_read"):
+                inputs = cached_inputs(table, row, batch_end, tokenizer.pad_token_id)
+            write_scored(model, writer, next(batches), inputs, args)
+            save_row(part_file, batch_end - start)
+
+def write_scored(model, writer, batch, inputs, args):
+    import torch
+
+    with PROFILER.stage("infer"), torch.no_grad():
+        logits = model(**inputs).logits.squeeze(-1).float().cpu().numpy()
+    with PROFILER.stage("write"):
+        for record, score in zip(batch, logits.tolist()):
+            record["score"] = score
+            record["int_score"] = int(round(max(0, min(score, 5))))
+        # The output of a Parquet or Arrow input is a sidecar keyed by row index, without the text
+        writer.write_all([without_text(record, [args.text_column]) for record in batch] if args.sidecar else batch)
+
+def main_workers(args):
+    if args.token_cache_dir:
+        # Build the cache once here so the workers only ever map it
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+        args.token_cache_file = token_cache_path(args.token_cache_dir, args.input_file, args.model_name, args.text_column, args.max_length, args.token_cache_full_hash)
+        with PROFILER.stage("tokenize"):
+            total_lines = open_token_cache(args.token_cache_file, args.input_file, tokenizer, args.text_column, args.max_length).num_rows
+        existing_lines = resume_row(args.output_file)
+    else:
+        # Lines already merged into the output file are skipped as before
+        total_lines = count_records(args.input_file)
+        remove_row_index(args.output_file)
+        existing_lines = count_complete_lines(args.output_file)
+    if existing_lines > 0:
+        print(f"Skipping {existing_lines} already processed lines.")
+    remaining = total_lines - existing_lines
+    if remaining <= 0:
+        return
+
+    num_workers = min(args.num_workers, remaining)
+    shard_size = (remaining + num_workers - 1) // num_workers
+    bounds = [(existing_lines + i * shard_size, min(existing_lines + (i + 1) * shard_size, total_lines)) for i in range(num_workers)]
+    core_sets = split_cores(num_workers)
+    part_files = [part_file_name(args.output_file, start, end) for start, end in bounds]
+
+    ctx = mp.get_context("spawn")
+    processes = []
+    for worker_id, ((start, end), cores, part_file) in enumerate(zip(bounds, core_sets, part_files)):
+        process = ctx.Process(target=score_shard, args=(args, worker_id, start, end, cores, part_file))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+
+    failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Workers {failed} failed. Rerun with the same --num_workers to resume their shards.")
+
+    # Merge the shards in input order and drop the part files; the part files stay plain and
+    # compression, if any, happens here, once
+    with PROFILER.stage("merge"), open_file(args.output_file, 'ab', args.compress_level) as out:
+        for part_file in part_files:
+            with open(part_file, 'rb') as part:
+                for line in part:
+                    out.write(line)
+    # Checkpointed once the output is closed, so a compressed output's size includes the end of its frame
+    if args.token_cache_dir:
+        save_row(args.output_file, total_lines)
+    for part_file in part_files:
+        os.remove(part_file)
+        remove_row_index(part_file)
+
+def cli():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("--model_name", type=str, default="north/scandinavian_education_classifier_bert")
-    parser.add_argument("--input_file", type=str, required=True, help="Path to the input jsonlines file")
-    parser.add_argument("--output_file", type=str, required=True, help="Path to save the output jsonlines file")
+    parser.add_argument("--input_file", type=str, required=True, help="Path to the input jsonlines file, or a Parquet or Arrow file of which only --text_column and id are read")
+    parser.add_argument("--output_file", type=str, required=True, help="Path to save the output jsonlines file; for Parquet and Arrow inputs it holds the row index, id and scores of every row")
     parser.add_argument("--text_column", type=str, default="text")
     parser.add_argument("--max_length", type=int, default=512, help="Maximum sequence length for tokenization")
     parser.add_argument("--batch_size", type=int, default=1024, help="Batch size for processing")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of CPU worker processes, each pinned to its own cores (default: 1, single process)")
+    parser.add_argument("--threads_per_worker", type=int, default=None, help="torch intra-op threads per worker (default: worker cores minus tokenizer threads)")
+    parser.add_argument("--tokenizer_threads", type=int, default=1, help="Tokenizer threads per worker, overlapping with inference (default: 1)")
+    parser.add_argument("--token_cache_dir", type=str, default=None, help="Directory for memory-mapped Arrow caches of tokenised input, reused across runs (default: off)")
+    parser.add_argument("--token_cache_full_hash", action="store_true", help="Key the token cache on a hash of the whole input instead of its path, size, modification time and first and last MB")
+    parser.add_argument("--compress", type=str, choices=COMPRESS_CHOICES, default="auto", help="Compress the output as .zst or .gz, or not at all; auto picks .zst when the input is compressed or at least 1 GB (default: auto)")
+    parser.add_argument("--compress_level", type=int, default=None, help="zstd or gzip level for compressed output (default: 3 for zstd, 6 for gzip)")
+    parser.add_argument("--profile", action="store_true", help="Time the read, tokenize, infer and write stages of every worker and write <output_file>.profile.txt and a Chrome trace (<output_file>.profile.trace.json)")
+    parser.add_argument("--profile_sample", action="store_true", help="With --profile, also sample each process's main-thread stacks to <output_file>.profile.samples.txt")
 
     args = parser.parse_args()
-    main(args)
+    args.output_file = output_path(args.output_file, [args.input_file], args.compress)
+    args.sidecar = is_columnar(args.input_file)
+    if compression(args.output_file) and args.token_cache_dir and args.num_workers == 1:
+        # The cached path checkpoints byte offsets into the output, which a compressed stream cannot be cut at
+        parser.error("Compressed output with --token_cache_dir needs --num_workers 2 or more (it is compressed when the shards are merged), or --compress none.")
+    if args.profile:
+        PROFILER.enable(profile_prefix(args.output_file), args.profile_sample)
+    if args.num_workers > 1:
+        main_workers(args)
+    elif args.token_cache_dir:
+        main_cached(args)
+    else:
+        main(args)
+    PROFILER.report()
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import argparse
+import logging
+from collections import Counter, defaultdict
+from jsonl_io import is_jsonl, loads, open_file, strip_compression
+from multi_input import expand_inputs
+from make_training_set import file_language
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Score fields written by template.json and template_linguistic.json
+SCORE_FIELDS = ["educational score", "cleanliness score", "trimmed cleanliness score"]
+# Pair of score fields whose joint distribution is counted
+COOCCURRENCE = ["educational score", "cleanliness score"]
+# Bytes of JSONL parsed into one record batch; a single line may not be longer
+BLOCK_SIZE = 16 << 20
+# Rows per record batch read from Parquet
+PARQUET_BATCH_ROWS = 1 << 17
+# Lines per record batch when a file has to be parsed in Python
+FALLBACK_BATCH_LINES = 100000
+# Width of the histogram bars
+BAR_WIDTH = 40
+
+def is_report_input(path):
+    return is_jsonl(path) or path.endswith(".parquet")
+
+def source_name(path):
+    # ../GlotCC/nob-Latn/nob_90000_processed.jsonl.zst -> nob_90000_processed
+    return os.path.splitext(os.path.basename(strip_compression(path)))[0]
+
+def projection(score_fields, key_fields):
+    # The only columns that are read: scores as floats, the language and source fields as strings
+    import pyarrow as pa
+
+    fields = [(field, pa.float64()) for field in score_fields]
+    fields += [(field, pa.string()) for field in dict.fromkeys(key_fields) if field and field not in score_fields]
+    return pa.schema(fields)
+
+def jsonl_batches(path, schema):
+    import pyarrow as pa
+    import pyarrow.json as pj
+
+    # Fields outside the schema are skipped by the parser, so texts and reasons are never built
+    parse_options = pj.ParseOptions(explicit_schema=schema, unexpected_field_behavior='ignore')
+    with pa.input_stream(path, compression='detect') as stream:
+        yield from pj.open_json(stream, read_options=pj.ReadOptions(block_size=BLOCK_SIZE), parse_options=parse_options)
+
+def python_batches(path, schema):
+    # For files the Arrow parser rejects because a field changes type between lines (e.g. a score written as "4");
+    # values that are not numbers count as missing scores
+    import pyarrow as pa
+
+    def value(record, field):
+        item = record.get(field.name)
+        if pa.types.is_floating(field.type):
+            try:
+                return float(item)
+            except (TypeError, ValueError):
+                return None
+        return None if item is None else str(item)
+
+    rows = []
+    with open_file(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = loads(line)
+            rows.append({field.name: value(record, field) for field in schema})
+            if len(rows) == FALLBACK_BATCH_LINES:
+                yield pa.RecordBatch.from_pylist(rows, schema=schema)
+                rows = []
+    if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema=schema)
+
+def parquet_batches(path, schema):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    present = [name for name in schema.names if name in parquet_file.schema_arrow.names]
+    for batch in parquet_file.iter_batches(batch_size=PARQUET_BATCH_ROWS, columns=present):
+        # Missing fields become nulls, and integer scores floats, so every batch has the same schema
+        columns = [batch.column(field.name).cast(field.type) if field.name in present else pa.nulls(batch.num_rows, field.type) for field in schema]
+        yield pa.RecordBatch.from_arrays(columns, schema=schema)
+
+def keyed(batch, score_fields, language_field, source_field, path):
+    # Adds the language and source of every row; rows without the field get the file's language (its name prefix,
+    # as in make_training_set.py) or its name. NaN, which pandas writes for missing scores, becomes null.
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    def key(field, default):
+        values = batch.column(field) if field else pa.nulls(batch.num_rows, pa.string())
+        return pc.fill_null(values, default)
+
+    columns = {"language": key(language_field, file_language(path)), "source": key(source_field, source_name(path))}
+    for field in score_fields:
+        values = batch.column(field)
+        columns[field] = pc.if_else(pc.is_nan(values), pa.scalar(None, pa.float64()), values)
+    return pa.table(columns)
+
+class Report:
+    # Running counts over record batches. Each batch is reduced with Arrow compute to a handful of rows
+    # (one per language, source and score bucket), so memory does not grow with the number of rows.
+    def __init__(self, score_fields, cooccurrence=None):
+        self.score_fields = score_fields
+        self.cooccurrence = cooccurrence
+        self.files = 0
+        self.histograms = {field: Counter() for field in score_fields}
+        self.groups = {"language": defaultdict(Counter), "source": defaultdict(Counter)}
+        self.pairs = Counter()
+
+    def add(self, table):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        # Scores are bucketed by rounding, as make_training_set.py does for its score strata
+        buckets = {field: pc.cast(pc.round(table.column(field)), pa.int64()) for field in self.score_fields}
+        for field, values in buckets.items():
+            for item in pc.value_counts(pc.drop_null(values)).to_pylist():
+                self.histograms[field][item["values"]] += item["counts"]
+
+        aggregates = [([], "count_all")] + [(field, "count") for field in self.score_fields] + [(field, "sum") for field in self.score_fields]
+        for key, groups in self.groups.items():
+            for group in table.group_by(key).aggregate(aggregates).to_pylist():
+                counts = groups[group[key]]
+                counts["rows"] += group["count_all"]
+                for field in self.score_fields:
+                    counts[f"{field} scored"] += group[f"{field}_count"]
+                    counts[f"{field} sum"] += group[f"{field}_sum"] or 0
+
+        if self.cooccurrence:
+            first, second = self.cooccurrence
+            pairs = pa.table({"first": buckets[first], "second": buckets[second]}).drop_null()
+            for group in pairs.group_by(["first", "second"]).aggregate([([], "count_all")]).to_pylist():
+                self.pairs[(group["first"], group["second"])] += group["count_all"]
+
+    def merge(self, other):
+        self.files += other.files
+        for field in self.score_fields:
+            self.histograms[field].update(other.histograms[field])
+        for key, groups in self.groups.items():
+            for name, counts in other.groups[key].items():
+                groups[name].update(counts)
+        self.pairs.update(other.pairs)
+
+    def summary(self):
+        def stats(counts):
+            rows = counts["rows"]
+            fields = {}
+            for field in self.score_fields:
+                scored = counts[f"{field} scored"]
+                fields[field] = {
+                    "scored": scored,
+                    "missing": rows - scored,
+                    "missing_rate": (rows - scored) / rows if rows else 0,
+                    "mean": counts[f"{field} sum"] / scored if scored else None,
+                }
+            return {"rows": rows, "scores": fields}
+
+        overall = Counter()
+        for counts in self.groups["language"].values():
+            overall.update(counts)
+        summary = dict(files=self.files, **stats(overall))
+        for field in self.score_fields:
+            summary["scores"][field]["histogram"] = {str(bucket): count for bucket, count in sorted(self.histograms[field].items())}
+        for key, groups in self.groups.items():
+            summary[f"by_{key}"] = {name: stats(counts) for name, counts in sorted(groups.items())}
+        if self.cooccurrence:
+            matrix = defaultdict(dict)
+            for (first, second), count in sorted(self.pairs.items()):
+                matrix[str(first)][str(second)] = count
+            summary["cooccurrence"] = {"fields": self.cooccurrence, "counts": matrix}
+        return summary
+
+def read_file(path, schema, score_fields, language_field, source_field, cooccurrence):
+    if path.endswith(".parquet"):
+        readers = [parquet_batches]
+    else:
+        readers = [jsonl_batches, python_batches]
+    for reader in readers:
+        # Counted per file, so a file the Arrow parser gives up on halfway is not counted twice
+        report = Report(score_fields, cooccurrence)
+        try:
+            for batch in reader(path, schema):
+                report.add(keyed(batch, score_fields, language_field, source_field, path))
+        except Exception as e:
+            if reader is readers[-1]:
+                raise
+            logging.warning(f"{path}: {e}; reading it line by line instead.")
+            continue
+        report.files = 1
+        return report
+
+def format_table(title, groups, fields):
+    rows = [[title, "rows"] + [f"{field} {column}" for field in fields for column in ("mean", "missing")]]
+    for name, stats in groups.items():
+        row = [name, f"{stats['rows']:,}"]
+        for field in fields:
+            score = stats["scores"][field]
+            row += ["-" if score["mean"] is None else f"{score['mean']:.2f}", f"{score['missing_rate']:.1%}"]
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return ["  ".join(cell.ljust(width) if i == 0 else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths))) for row in rows]
+
+def format_report(summary):
+    lines = [f"{summary['rows']:,} rows in {summary['files']} files"]
+    # Fields that no file has are left out of the tables
+    fields = [field for field, score in summary["scores"].items() if score["scored"]]
+    absent = [field for field in summary["scores"] if field not in fields]
+    if absent:
+        lines.append(f"No values for {', '.join(absent)}")
+    for field in fields:
+        score = summary["scores"][field]
+        lines += ["", f"{field}: {score['scored']:,} scored, {score['missing']:,} missing ({score['missing_rate']:.1%}), mean {score['mean']:.2f}"]
+        largest = max(score["histogram"].values())
+        for bucket, count in score["histogram"].items():
+            bar = "#" * round(BAR_WIDTH * count / largest)
+            lines.append(f"  {bucket:>3}  {bar:<{BAR_WIDTH}}  {count:>12,}  {count / score['scored']:6.1%}")
+    for key in ("language", "source"):
+        lines += [""] + format_table(key, summary[f"by_{key}"], fields)
+    cooccurrence = summary.get("cooccurrence")
+    if cooccurrence and all(field in fields for field in cooccurrence["fields"]):
+        first, second = cooccurrence["fields"]
+        columns = sorted({bucket for row in cooccurrence["counts"].values() for bucket in row}, key=int)
+        rows = [[f"{first} \\ {second}"] + columns]
+        rows += [[bucket] + [f"{row.get(column, 0):,}" for column in columns] for bucket, row in cooccurrence["counts"].items()]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines += [""] + ["  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows]
+    return lines
+
+def score_report(input_files, score_fields=SCORE_FIELDS, language_field=None, source_field=None, cooccurrence=COOCCURRENCE, output_json=None):
+    # The co-occurrence fields are read like every other score field
+    score_fields = list(dict.fromkeys(score_fields + (cooccurrence or [])))
+    schema = projection(score_fields, [language_field, source_field])
+    report = Report(score_fields, cooccurrence)
+    start = time.time()
+    for path in input_files:
+        report.merge(read_file(path, schema, score_fields, language_field, source_field, cooccurrence))
+    summary = report.summary()
+    elapsed = time.time() - start
+    logging.info(f"Read {summary['rows']:,} rows from {summary['files']} files in {elapsed:.1f} seconds ({summary['rows'] / max(elapsed, 1e-9):,.0f} rows/s).")
+
+    print("\n".join(format_report(summary)))
+    if output_json:
+        with open(output_json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        logging.info(f"Wrote the report to {output_json}")
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Report score distributions per language and source for processed JSONL or Parquet files.")
+    parser.add_argument('--input_files', type=str, nargs='+', required=True, help='Processed JSONL (.jsonl, .jsonl.gz, .jsonl.zst) or Parquet files, globs (quoted) or directories.')
+    parser.add_argument('--score_fields', type=str, nargs='+', default=SCORE_FIELDS, help=f'Score fields to report (default: {", ".join(SCORE_FIELDS)}).')
+    parser.add_argument('--cooccurrence', type=str, nargs=2, default=COOCCURRENCE, metavar='FIELD', help=f'Two score fields whose joint distribution is counted (default: {" and ".join(COOCCURRENCE)}).')
+    parser.add_argument('--no_cooccurrence', action='store_true', help='Skip the joint distribution.')
+    parser.add_argument('--language_field', type=str, help='Take the language from this field instead of the file name prefix.')
+    parser.add_argument('--source_field', type=str, help='Take the source from this field instead of the file name.')
+    parser.add_argument('--output_json', type=str, help='Also write the full report, with every count, to this JSON file.')
+    args = parser.parse_args()
+
+    input_files = expand_inputs(args.input_files, accept=is_report_input)
+    score_report(input_files, args.score_fields, args.language_field, args.source_field, None if args.no_cooccurrence else args.cooccurrence, args.output_json)
+
+if __name__ == "__main__":
+    main()
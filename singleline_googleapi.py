@@ -1,22 +1,15 @@
 import os
 import argparse
-import json
-import google.generativeai as genai
 import time
-import jsonlines
 import logging
 from tqdm import tqdm
+from dead_letter import DeadLetters, dead_letter_path, load_dead_letters, retry_records
+from response_schema import read_templates, with_schema, parse_response, log_response_stats
+from jsonl_io import count_complete_lines, open_jsonl
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Configure the Google AI API
-genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-
-# Load the templates from the template.json file
-with open('template.json', 'r') as f:
-    templates = json.load(f)
-
 # Define the model configuration
 generation_config = {
     "temperature": 0.5,
@@ -44,29 +37,52 @@ safety_settings = [
     },
 ]
 
-model = genai.GenerativeModel(
-    model_name="gemini-1.5-flash",
-    safety_settings=safety_settings,
-    generation_config=generation_config,
-)
+def create_model():
+    # The SDK is imported and configured here so --help and --retry_from argument errors need no API key
+    import google.generativeai as genai
+
+    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+    return genai.GenerativeModel(
+        model_name="gemini-1.5-flash",
+        safety_settings=safety_settings,
+        generation_config=generation_config,
+    )
 
-def process_batch(chat_session, chat_prompt, batch, text_field):
+def process_batch(chat_session, chat_prompt, batch, text_field, schema=None):
     responses = []
     for line in batch:
         input_text = line[text_field]
         prompt = chat_prompt.format(content=input_text)
-        response = chat_session.send_message(prompt)
+        response = chat_session.send_message(prompt, generation_config=with_schema(generation_config, schema))
         responses.append((line, response))
         time.sleep(2)  # Wait for 2 seconds between each request
     return responses
 
-def process_json_lines(json_lines_file, output_file, num_examples, max_requests_per_minute, batch_size, language, text_field, verbose):
+def parse_batch(responses, schema):
+    # Validate the whole batch before writing so a retry never duplicates lines
+    parsed = []
+    for line, response in responses:
+        response_json, errors = parse_response(response.text, schema)
+        if errors:
+            raise ValueError(f"Invalid response: {'; '.join(errors)}")
+        parsed.append((line, response_json))
+    return parsed
+
+def score_line(chat_session, chat_prompt, line, text_field, schema):
+    [(line, response_json)] = parse_batch(process_batch(chat_session, chat_prompt, [line], text_field, schema), schema)
+    line["justification"] = response_json["reason"]
+    line["educational score"] = response_json["educational score"]
+    return line
+
+def process_json_lines(json_lines_file, output_file, num_examples, max_requests_per_minute, batch_size, language, text_field, verbose, dead_letter_file=None, retry_from=None):
     if verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    templates, response_schemas = read_templates('template.json')
     chat_prompt = templates[language]
+    schema = response_schemas[language]
 
-    chat_session = model.start_chat(
+    chat_session = create_model().start_chat(
         history=[
             {
                 "role": "user",
@@ -77,21 +93,31 @@ def process_json_lines(json_lines_file, output_file, num_examples, max_requests_
         ]
     )
 
+    dead_letter_file = dead_letter_file or dead_letter_path(output_file)
+
+    if retry_from:
+        # Only the dead-letter lines are re-run and merged back into the output at their line numbers
+        retried = load_dead_letters(retry_from)
+        try:
+            with DeadLetters(dead_letter_file, retried=retried) as dead_letters:
+                retry_records(retried, output_file, dead_letters, lambda line: score_line(chat_session, chat_prompt, line, text_field, schema))
+        finally:
+            log_response_stats()
+        return
+
+    # Appended to, like the output, so resumed runs keep earlier failures
+    dead_letters = DeadLetters(dead_letter_file, mode='a')
     try:
         # Count the number of lines already processed in the output file
-        if os.path.exists(output_file):
-            with jsonlines.open(output_file, mode='r') as reader:
-                processed_lines_count = sum(1 for _ in reader)
-        else:
-            processed_lines_count = 0
+        processed_lines_count = count_complete_lines(output_file)
 
-        with jsonlines.open(json_lines_file, mode='r') as reader:
+        with open_jsonl(json_lines_file) as reader:
             lines = list(reader)
 
         retries = 0
         total_lines = min(processed_lines_count + num_examples, len(lines))
         
-        with jsonlines.open(output_file, mode='a') as writer:
+        with open_jsonl(output_file, 'a') as writer:
             with tqdm(total=total_lines - processed_lines_count, desc="Processing lines", disable=verbose) as pbar:
                 for idx in range(processed_lines_count, total_lines, batch_size):
                     batch = lines[idx:idx + batch_size]
@@ -114,11 +140,11 @@ def process_json_lines(json_lines_file, output_file, num_examples, max_requests_
 
                     while retries < 5:
                         try:
-                            responses = process_batch(chat_session, chat_prompt, batch, text_field)
-                            for line, response in responses:
-                                response_json = json.loads(response.text)
-                                line["justification"] = response_json.get("reason", "No justification found")
-                                line["educational score"] = response_json.get("educational score", 0)
+                            responses = process_batch(chat_session, chat_prompt, batch, text_field, schema)
+                            parsed = parse_batch(responses, schema)
+                            for line, response_json in parsed:
+                                line["justification"] = response_json["reason"]
+                                line["educational score"] = response_json["educational score"]
                                 writer.write(line)
                                 pbar.update(1)
                             retries = 0  # Reset retries after a successful operation
@@ -132,10 +158,19 @@ def process_json_lines(json_lines_file, output_file, num_examples, max_requests_
                             retries += 1
                             logging.error(f"An error occurred while processing batch starting at line {idx+1} (attempt {retries}): {e}")
                             if retries >= 5:
-                                logging.error("Maximum retry limit reached. Exiting the script.")
-                                exit(1)
+                                # The lines keep their place in the output, unscored, so resuming by line count still works
+                                logging.error(f"Maximum retry limit reached. Writing the batch starting at line {idx+1} to {dead_letter_file}.")
+                                for offset, line in enumerate(batch):
+                                    writer.write(line)
+                                    dead_letters.add(idx + offset, line, type(e).__name__, retries, str(e))
+                                    pbar.update(1)
+                                retries = 0
+                                break
     except Exception as e:
         logging.error(f"An error occurred: {e}")
+    finally:
+        dead_letters.close()
+        log_response_stats()
 
 def main():
     parser = argparse.ArgumentParser(description="Process a JSONLines file with the Google Generative AI model.")
@@ -146,11 +181,13 @@ def main():
     parser.add_argument('--batch_size', type=int, default=10, help='Number of requests to process in each batch (default: 10).')
     parser.add_argument('--language', type=str, choices=['en', 'sv', 'da', 'nb', 'nn'], default='en', help='Language for the prompt (default: en).')
     parser.add_argument('--text_field', type=str, default='text', help='Field in JSON lines containing the text (default: text).')
+    parser.add_argument('--dead_letter_file', type=str, help='Where lines whose batch fails 5 times are written with their error and attempt count (default: <output_file>.dead.jsonl).')
+    parser.add_argument('--retry_from', type=str, help='Re-run only the lines in this dead-letter file and merge the results into --output_file.')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose logging.')
 
     args = parser.parse_args()
 
-    process_json_lines(args.json_lines_file, args.output_file, args.num_examples, args.max_requests_per_minute, args.batch_size, args.language, args.text_field, args.verbose)
+    process_json_lines(args.json_lines_file, args.output_file, args.num_examples, args.max_requests_per_minute, args.batch_size, args.language, args.text_field, args.verbose, args.dead_letter_file, args.retry_from)
 
 if __name__ == "__main__":
     main()
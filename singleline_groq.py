@@ -1,156 +1,132 @@
 import os
+import asyncio
 import argparse
-import json
-import time
-import jsonlines
 import logging
 from tqdm import tqdm
-import requests
-from google.auth import default
-from google.auth.transport.requests import Request
+from dead_letter import REQUEST_FAILED, INVALID_RESPONSE, DeadLetters, MergeWriter, dead_letter_path, load_dead_letters
+from loop_tools import SampledLog, client_session, run
+from openai_compat import DEFAULT_BASE_URL, DEFAULT_MODEL, DEFAULT_API_KEY_ENV, MAX_TOKENS, ChatClient, RequestError
+from response_schema import INVALID_RETRIES, RESPONSE_STATS, read_templates, parse_response, log_response_stats
+from jsonl_io import count_complete_lines, open_jsonl
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Configure the Vertex AI API details
-PROJECT_ID = "north-390910"
-LOCATION = "us-central1"
-MODEL_ID = "gemini-1.5-flash-001"
-ENDPOINT = f"https://{LOCATION}-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}/locations/{LOCATION}/publishers/google/models/{MODEL_ID}:generateContent"
-
-# Load the templates from the template.json file
-with open('template.json', 'r') as f:
-    templates = json.load(f)
-
-# Define the model configuration
+# Sampling settings sent with every request, in OpenAI naming
 generation_config = {
     "temperature": 0.5,
     "top_p": 0.95,
-    "top_k": 40,  # Adjusted value
-    "max_output_tokens": 8192,
-    "response_mime_type": "application/json",
+    "max_tokens": MAX_TOKENS,
 }
-# Removed the problematic safety settings
-safety_settings = []
-
-# Get an authentication token
-def get_auth_token():
-    credentials, _ = default()
-    credentials.refresh(Request())
-    return credentials.token
-
-def send_request(prompt):
-    headers = {
-        "Authorization": f"Bearer {get_auth_token()}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "contents": [{
-            "role": "user",
-            "parts": [{"text": prompt}]
-        }],
-        "generation_config": generation_config,
-        "safety_settings": safety_settings
-    }
-    response = requests.post(ENDPOINT, headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()
 
-def process_batch(chat_prompt, batch, text_field, wait_time):
-    responses = []
-    for line in batch:
-        input_text = line[text_field]
-        prompt = chat_prompt.format(content=input_text)
-        response = send_request(prompt)
-        responses.append((line, response))
-        time.sleep(wait_time)  # Wait for the specified time between each request
-    return responses
-
-def process_json_lines(json_lines_file, output_file, num_examples, max_requests_per_minute, batch_size, language, text_field, verbose, wait_time):
+# Per-request warnings are sampled so a burst of failures does not flood the log
+sampled_log = SampledLog()
+
+async def score_record(client, session, record, prompt, schema):
+    # Returns (record, None) with the response fields added, or (record, (error, attempts, detail))
+    for attempt in range(INVALID_RETRIES + 1):
+        try:
+            content = await client.complete(session, prompt)
+        except RequestError as e:
+            sampled_log.log(logging.ERROR, "request_failed", "Request failed after %s attempts: %s", e.attempts, e)
+            return record, (REQUEST_FAILED, e.attempts, str(e))
+        response_json, errors = parse_response(content, schema)
+        if not errors:
+            # The same fields and names as generate_async.py, so the converters read both outputs
+            record.update({field: response_json[field] for field in schema['properties']})
+            return record, None
+        sampled_log.log(logging.WARNING, "invalid_response", "Invalid response (attempt %s): %s", attempt + 1, '; '.join(errors))
+    RESPONSE_STATS['given_up'] += 1
+    return record, (INVALID_RESPONSE, INVALID_RETRIES + 1, '; '.join(errors))
+
+async def score_window(client, session, records, chat_prompt, text_field, schema):
+    # Records without text or already scored pass through unchanged
+    results = [(record, None) for record in records]
+    jobs = {}
+    for i, record in enumerate(records):
+        if all(field in record for field in schema['properties']):
+            continue
+        if not record.get(text_field):
+            sampled_log.log(logging.ERROR, "missing_text", "Field '%s' not found in a line. Make sure the input JSONL file contains this field.", text_field)
+            continue
+        jobs[i] = score_record(client, session, record, chat_prompt.format(content=record[text_field]), schema)
+    for i, result in zip(jobs, await asyncio.gather(*jobs.values())):
+        results[i] = result
+    return results
+
+async def process_json_lines(json_lines_file, output_file, num_examples, batch_size, language, text_field, verbose, base_url, model, api_key_env, concurrency, max_rpm, request_timeout, template_file='template.json', dead_letter_file=None, retry_from=None):
     if verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    templates, response_schemas = read_templates(template_file)
     chat_prompt = templates[language]
-
-    try:
-        # Count the number of lines already processed in the output file
-        if os.path.exists(output_file):
-            with jsonlines.open(output_file, mode='r') as reader:
-                processed_lines_count = sum(1 for _ in reader)
-        else:
-            processed_lines_count = 0
-
-        logging.info(f"Starting from line: {processed_lines_count}")
-
-        with jsonlines.open(json_lines_file, mode='r') as reader:
+    schema = response_schemas[language]
+    client = ChatClient(base_url, model, os.environ[api_key_env], concurrency, generation_config, max_rpm)
+
+    dead_letter_file = dead_letter_file or dead_letter_path(output_file)
+    if retry_from:
+        # Only the dead-letter lines are re-run and merged back into the output at their line numbers
+        retried = load_dead_letters(retry_from)
+        lines = [entry["record"] for entry in retried]
+        start = 0
+        dead_letters = DeadLetters(dead_letter_file, retried=retried)
+        writer = MergeWriter(output_file, retried)
+    else:
+        # Resume by counting the lines already in the output file
+        start = count_complete_lines(output_file)
+        logging.info(f"Starting from line: {start}")
+        with open_jsonl(json_lines_file) as reader:
             lines = list(reader)
+        lines = lines[:start + num_examples]
+        # Appended to, like the output, so resumed runs keep earlier failures
+        dead_letters = DeadLetters(dead_letter_file, mode='a')
+        writer = open_jsonl(output_file, 'a', flush=True)
 
-        retries = 0
-        total_lines = min(processed_lines_count + num_examples, len(lines))
-        
-        with jsonlines.open(output_file, mode='a') as writer:
-            with tqdm(total=total_lines - processed_lines_count, desc="Processing lines", disable=verbose) as pbar:
-                for idx in range(processed_lines_count, total_lines, batch_size):
-                    batch = lines[idx:idx + batch_size]
-
-                    if any("educational score" in line for line in batch):
-                        for line in batch:
-                            if "educational score" in line:
-                                writer.write(line)
-                                logging.debug(f"Line already processed, skipping: {line}")
-                                pbar.update(1)
-                        continue
-
-                    if any(text_field not in line for line in batch):
-                        for line in batch:
-                            if text_field not in line:
-                                logging.error(f"Field '{text_field}' not found in line {idx+1}. Make sure the input JSONL file contains this field.")
-                                writer.write(line)
-                                pbar.update(1)
-                        continue
-
-                    while retries < 5:
-                        try:
-                            responses = process_batch(chat_prompt, batch, text_field, wait_time)
-                            for line, response in responses:
-                                response_json_str = response['candidates'][0]['content']['parts'][0]['text']
-                                response_json = json.loads(response_json_str)
-                                logging.debug(f"Response JSON: {response_json}")
-                                line["justification"] = response_json.get("reason", "No justification found")
-                                line["educational score"] = response_json.get("educational score", 0)
-                                writer.write(line)
-                                logging.debug(f"Written line: {line}")
-                                pbar.update(1)
-                            retries = 0  # Reset retries after a successful operation
-
-                            if (idx + batch_size) % max_requests_per_minute == 0:
-                                logging.info(f"Processed {idx + batch_size} entries. Waiting for a minute to respect rate limit.")
-                                time.sleep(60)  # Wait for a minute to respect rate limit
-                            break
-                        except Exception as e:
-                            retries += 1
-                            logging.error(f"An error occurred while processing batch starting at line {idx+1} (attempt {retries}): {e}")
-                            if retries >= 5:
-                                logging.error("Maximum retry limit reached. Exiting the script.")
-                                exit(1)
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
+    completed = False
+    try:
+        async with client_session(request_timeout) as session:
+            with writer, tqdm(total=len(lines) - start, desc="Processing lines", disable=verbose) as pbar:
+                # Up to --batch_size records are in flight at once; each window is written in input order
+                for window_start in range(start, len(lines), batch_size):
+                    window = lines[window_start:window_start + batch_size]
+                    results = await score_window(client, session, window, chat_prompt, text_field, schema)
+                    for offset, (record, failure) in enumerate(results):
+                        # Failed lines keep their place in the output, unscored, so resuming by line count still works
+                        writer.write(record)
+                        if failure:
+                            dead_letters.add(window_start + offset, record, *failure)
+                    pbar.update(len(window))
+        completed = True
+    finally:
+        dead_letters.close(completed)
+        log_response_stats()
+        logging.info(f"{model} at {base_url}: {client.summary()}")
+        if sampled_log.counts:
+            logging.info(f"Request problems: {sampled_log.summary()}")
 
 def main():
-    parser = argparse.ArgumentParser(description="Process a JSONLines file with the Vertex AI API.")
+    parser = argparse.ArgumentParser(description="Process a JSONLines file with an OpenAI-compatible chat completions API (Groq by default).")
     parser.add_argument('--json_lines_file', type=str, required=True, help='Path to the JSONLines file.')
     parser.add_argument('--output_file', type=str, required=True, help='Path to the output JSONLines file.')
-    parser.add_argument('--num_examples', type=int, default=100, help='Number of requests to process (default: 100).')
-    parser.add_argument('--max_requests_per_minute', type=int, default=1000, help='Maximum number of requests per minute (default: 1000).')
-    parser.add_argument('--batch_size', type=int, default=10, help='Number of requests to process in each batch (default: 10).')
+    parser.add_argument('--num_examples', type=int, default=100, help='Number of lines to process (default: 100).')
+    parser.add_argument('--batch_size', type=int, default=50, help='Lines scored concurrently before they are written (default: 50).')
     parser.add_argument('--language', type=str, choices=['en', 'sv', 'da', 'nb', 'nn'], default='en', help='Language for the prompt (default: en).')
+    parser.add_argument('--template_file', type=str, default='template.json', help='Template file, e.g. template_linguistic.json (default: template.json).')
     parser.add_argument('--text_field', type=str, default='text', help='Field in JSON lines containing the text (default: text).')
-    parser.add_argument('--wait_time', type=float, default=0, help='Time to wait between requests in seconds (default: 0).')
+    parser.add_argument('--base_url', type=str, default=DEFAULT_BASE_URL, help=f'Base URL of the OpenAI-compatible API (default: {DEFAULT_BASE_URL}).')
+    parser.add_argument('--model', type=str, default=DEFAULT_MODEL, help=f'Model name (default: {DEFAULT_MODEL}).')
+    parser.add_argument('--api_key_env', type=str, default=DEFAULT_API_KEY_ENV, help=f'Environment variable holding the API key (default: {DEFAULT_API_KEY_ENV}).')
+    parser.add_argument('--concurrency', type=int, default=16, help='Maximum requests in flight (default: 16).')
+    parser.add_argument('--max_requests_per_minute', type=int, help='Space requests evenly up to this rate; otherwise pacing follows the x-ratelimit-* response headers.')
+    parser.add_argument('--request_timeout', type=float, default=120, help='Deadline in seconds for each request, 0 for none (default: 120).')
+    parser.add_argument('--dead_letter_file', type=str, help='Where lines that still fail after the retries are written with their error and attempt count (default: <output_file>.dead.jsonl).')
+    parser.add_argument('--retry_from', type=str, help='Re-run only the lines in this dead-letter file and merge the results into --output_file.')
+    parser.add_argument('--uvloop', action='store_true', help='Run on uvloop if it is installed.')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose logging.')
 
     args = parser.parse_args()
 
-    process_json_lines(args.json_lines_file, args.output_file, args.num_examples, args.max_requests_per_minute, args.batch_size, args.language, args.text_field, args.verbose, args.wait_time)
+    run(process_json_lines(args.json_lines_file, args.output_file, args.num_examples, args.batch_size, args.language, args.text_field, args.verbose, args.base_url, args.model, args.api_key_env, args.concurrency, args.max_requests_per_minute, args.request_timeout or None, args.template_file, args.dead_letter_file, args.retry_from), args.uvloop)
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,11 @@
-import os
 import argparse
-import json
 import time
-import jsonlines
 import logging
 from tqdm import tqdm
 import requests
-from google.auth import default
-from google.auth.transport.requests import Request
+from dead_letter import DeadLetters, dead_letter_path, load_dead_letters, retry_records
+from response_schema import read_templates, with_schema, parse_response, log_response_stats
+from jsonl_io import count_complete_lines, open_jsonl
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,10 +16,6 @@ LOCATION = "us-central1"
 MODEL_ID = "gemini-1.5-flash-001"
 ENDPOINT = f"https://{LOCATION}-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}/locations/{LOCATION}/publishers/google/models/{MODEL_ID}:generateContent"
 
-# Load the templates from the template.json file
-with open('template.json', 'r') as f:
-    templates = json.load(f)
-
 # Define the model configuration
 generation_config = {
     "temperature": 0.5,
@@ -37,6 +31,10 @@ safety_settings = []
 auth_token = None
 
 def get_auth_token():
+    # Imported here so --help does not pay for google-auth
+    from google.auth import default
+    from google.auth.transport.requests import Request
+
     global auth_token
     if auth_token is None:
         credentials, _ = default()
@@ -44,7 +42,7 @@ def get_auth_token():
         auth_token = credentials.token
     return auth_token
 
-def send_request(prompt):
+def send_request(prompt, schema=None):
     headers = {
         "Authorization": f"Bearer {get_auth_token()}",
         "Content-Type": "application/json",
@@ -54,35 +52,60 @@ def send_request(prompt):
             "role": "user",
             "parts": [{"text": prompt}]
         }],
-        "generation_config": generation_config,
+        "generation_config": with_schema(generation_config, schema),
         "safety_settings": safety_settings
     }
     response = requests.post(ENDPOINT, headers=headers, json=payload)
     response.raise_for_status()
     return response.json()
 
-def process_json_lines(json_lines_file, output_file, num_examples, max_requests_per_minute, language, text_field, verbose, wait_time):
+def score_line(line, chat_prompt, schema, text_field):
+    input_text = line[text_field]
+    prompt = chat_prompt.format(content=input_text)
+    response = send_request(prompt, schema)
+    response_json_str = response['candidates'][0]['content']['parts'][0]['text']
+    response_json, errors = parse_response(response_json_str, schema)
+    if errors:
+        # Raising re-requests the line instead of writing default scores
+        raise ValueError(f"Invalid response: {'; '.join(errors)}")
+    logging.debug(f"Response JSON: {response_json}")
+    line["justification"] = response_json["reason"]
+    line["educational score"] = response_json["educational score"]
+    return line
+
+def process_json_lines(json_lines_file, output_file, num_examples, max_requests_per_minute, language, text_field, verbose, wait_time, dead_letter_file=None, retry_from=None):
     if verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    templates, response_schemas = read_templates('template.json')
     chat_prompt = templates[language]
-
+    schema = response_schemas[language]
+    dead_letter_file = dead_letter_file or dead_letter_path(output_file)
+
+    if retry_from:
+        # Only the dead-letter lines are re-run and merged back into the output at their line numbers
+        retried = load_dead_letters(retry_from)
+        try:
+            with DeadLetters(dead_letter_file, retried=retried) as dead_letters:
+                retry_records(retried, output_file, dead_letters, lambda line: score_line(line, chat_prompt, schema, text_field))
+        finally:
+            log_response_stats()
+        return
+
+    # Appended to, like the output, so resumed runs keep earlier failures
+    dead_letters = DeadLetters(dead_letter_file, mode='a')
     try:
         # Count the number of lines already processed in the output file
-        if os.path.exists(output_file):
-            with jsonlines.open(output_file, mode='r') as reader:
-                processed_lines_count = sum(1 for _ in reader)
-        else:
-            processed_lines_count = 0
+        processed_lines_count = count_complete_lines(output_file)
 
         logging.info(f"Starting from line: {processed_lines_count}")
 
-        with jsonlines.open(json_lines_file, mode='r') as reader:
+        with open_jsonl(json_lines_file) as reader:
             lines = list(reader)
 
         total_lines = min(processed_lines_count + num_examples, len(lines))
         
-        with jsonlines.open(output_file, mode='a') as writer:
+        with open_jsonl(output_file, 'a') as writer:
             with tqdm(total=total_lines - processed_lines_count, desc="Processing lines") as pbar:
                 for idx in range(processed_lines_count, total_lines):
                     line = lines[idx]
@@ -102,14 +125,7 @@ def process_json_lines(json_lines_file, output_file, num_examples, max_requests_
                     retries = 0
                     while retries < 5:
                         try:
-                            input_text = line[text_field]
-                            prompt = chat_prompt.format(content=input_text)
-                            response = send_request(prompt)
-                            response_json_str = response['candidates'][0]['content']['parts'][0]['text']
-                            response_json = json.loads(response_json_str)
-                            logging.debug(f"Response JSON: {response_json}")
-                            line["justification"] = response_json.get("reason", "No justification found")
-                            line["educational score"] = response_json.get("educational score", 0)
+                            line = score_line(line, chat_prompt, schema, text_field)
                             logging.debug(f"Writing line: {line}")
                             writer.write(line)
                             logging.debug(f"Written line: {line}")
@@ -120,8 +136,11 @@ def process_json_lines(json_lines_file, output_file, num_examples, max_requests_
                             retries += 1
                             logging.error(f"An error occurred while processing line {idx+1} (attempt {retries}): {e}")
                             if retries >= 5:
-                                logging.error("Maximum retry limit reached. Exiting the script.")
-                                exit(1)
+                                # The line keeps its place in the output, unscored, so resuming by line count still works
+                                logging.error(f"Maximum retry limit reached. Writing line {idx+1} to {dead_letter_file}.")
+                                writer.write(line)
+                                dead_letters.add(idx, line, type(e).__name__, retries, str(e))
+                                pbar.update(1)
                     
                     if (idx + 1) % max_requests_per_minute == 0:
                         logging.info(f"Processed {idx + 1} entries. Waiting for a minute to respect rate limit.")
@@ -129,6 +148,9 @@ def process_json_lines(json_lines_file, output_file, num_examples, max_requests_
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
+    finally:
+        dead_letters.close()
+        log_response_stats()
 
 def main():
     parser = argparse.ArgumentParser(description="Process a JSONLines file with the Vertex AI API.")
@@ -139,11 +161,13 @@ def main():
     parser.add_argument('--language', type=str, choices=['en', 'sv', 'da', 'nb', 'nn'], default='en', help='Language for the prompt (default: en).')
     parser.add_argument('--text_field', type=str, default='text', help='Field in JSON lines containing the text (default: text).')
     parser.add_argument('--wait_time', type=float, default=0, help='Time to wait between requests in seconds (default: 0).')
+    parser.add_argument('--dead_letter_file', type=str, help='Where lines that fail 5 times are written with their error and attempt count (default: <output_file>.dead.jsonl).')
+    parser.add_argument('--retry_from', type=str, help='Re-run only the lines in this dead-letter file and merge the results into --output_file.')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose logging.')
 
     args = parser.parse_args()
 
-    process_json_lines(args.json_lines_file, args.output_file, args.num_examples, args.max_requests_per_minute, args.language, args.text_field, args.verbose, args.wait_time)
+    process_json_lines(args.json_lines_file, args.output_file, args.num_examples, args.max_requests_per_minute, args.language, args.text_field, args.verbose, args.wait_time, args.dead_letter_file, args.retry_from)
 
 if __name__ == "__main__":
     main()
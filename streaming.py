@@ -0,0 +1,114 @@
+import re
+import json
+import math
+import logging
+from collections import Counter
+
+# Observations per template before the output-token cap is tightened
+MIN_OBSERVATIONS = 50
+# Headroom over the highest observed response length, and the smallest cap ever used
+CAP_HEADROOM = 1.5
+MIN_CAP = 256
+
+def stream_endpoint(endpoint):
+    return endpoint.replace(':generateContent', ':streamGenerateContent') + '?alt=sse'
+
+def complete_fields(text, schema):
+    # Extracts the fields whose values are already complete in a partial JSON response.
+    # Strings are complete at their closing quote, integers once a delimiter follows them.
+    fields = {}
+    for field, spec in schema["properties"].items():
+        name = re.escape(json.dumps(field))
+        if spec.get("type") == "STRING":
+            match = re.search(name + r'\s*:\s*("(?:[^"\\]|\\.)*")', text)
+        else:
+            match = re.search(name + r'\s*:\s*(-?\d+(?:\.\d+)?)\s*[,}\n]', text)
+        if match:
+            fields[field] = json.loads(match.group(1))
+    return fields
+
+async def send_request_stream(session, endpoints, prompt, idx, generation_config, schema, auth_token, sampled_log):
+    # Reads the SSE stream and closes it as soon as every required field is complete.
+    # The result has the same shape as a generateContent response; problems are logged through the caller's SampledLog.
+    headers = {
+        "Authorization": f"Bearer {auth_token}",
+        "Content-Type": "application/json",
+    }
+    payload = {
+        "contents": [{
+            "role": "user",
+            "parts": [{"text": prompt}]
+        }],
+        "generation_config": generation_config,
+    }
+    for attempt in range(len(endpoints)):
+        endpoint = await endpoints.acquire()
+        text = ""
+        output_tokens = 0
+        finish_reason = None
+        try:
+            async with session.post(stream_endpoint(endpoint.url), headers=headers, json=payload) as response:
+                endpoints.record(endpoint, response.status)
+                if response.status == 401:
+                    sampled_log.log(logging.ERROR, "unauthorized", "Request %s failed with status: 401 Unauthorized. Check your credentials.", idx)
+                    return idx, 'unauthorized'
+                if response.status != 200 and endpoints.should_retry(response.status):
+                    sampled_log.log(logging.WARNING, "endpoint_retry", "Request %s failed with status %s on %s. Retrying on another endpoint.", idx, response.status, endpoint)
+                    continue
+                if response.status == 429:
+                    sampled_log.log(logging.WARNING, "rate_limit", "Request %s hit rate limit.", idx)
+                    return idx, 'rate_limit'
+                if response.status != 200:
+                    sampled_log.log(logging.ERROR, "request_failed", "Request %s failed with status: %s", idx, response.status)
+                    return idx, None
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    chunk = json.loads(line[len('data:'):])
+                    candidate = chunk.get('candidates', [{}])[0]
+                    for part in candidate.get('content', {}).get('parts', []):
+                        text += part.get('text', '')
+                    finish_reason = candidate.get('finishReason', finish_reason)
+                    output_tokens = chunk.get('usageMetadata', {}).get('candidatesTokenCount', output_tokens)
+                    fields = complete_fields(text, schema)
+                    if all(field in fields for field in schema.get("required", [])):
+                        # Leaving the context manager closes the connection and stops generation
+                        text = json.dumps(fields, ensure_ascii=False)
+                        finish_reason = finish_reason or 'EARLY_STOP'
+                        break
+        except Exception as e:
+            endpoints.record(endpoint, None)
+            sampled_log.log(logging.ERROR, "request_exception", "Request %s failed with exception: %r", idx, e)
+            return idx, None
+        return idx, {
+            "candidates": [{"content": {"parts": [{"text": text}]}, "finishReason": finish_reason}],
+            "usageMetadata": {"candidatesTokenCount": output_tokens or math.ceil(len(text) / 4)},
+        }
+    return idx, None
+
+class OutputTokenCaps:
+    # Per-template max_output_tokens derived from the longest response seen so far. A cap raised after a
+    # truncation is a floor: later responses, all cut at the old cap, never lower it again.
+    def __init__(self, default_cap):
+        self.default_cap = default_cap
+        self.counts = Counter()
+        self.longest = {}
+        self.floors = {}
+        self.caps = {}
+
+    def cap(self, template_key):
+        return self.caps.get(template_key, self.default_cap)
+
+    def observe(self, template_key, output_tokens, truncated=False):
+        if truncated:
+            # The cap cut a response short: back off towards the default
+            self.caps[template_key] = self.floors[template_key] = min(self.default_cap, self.cap(template_key) * 2)
+            logging.warning(f"Response for '{template_key}' hit max_output_tokens; raising the cap to {self.caps[template_key]}.")
+            return
+        self.counts[template_key] += 1
+        self.longest[template_key] = max(self.longest.get(template_key, 0), output_tokens)
+        if self.counts[template_key] % MIN_OBSERVATIONS == 0:
+            cap = max(MIN_CAP, self.floors.get(template_key, 0), math.ceil(self.longest[template_key] * CAP_HEADROOM))
+            self.caps[template_key] = min(self.default_cap, cap)
+            logging.info(f"max_output_tokens for '{template_key}' set to {self.caps[template_key]} from {self.counts[template_key]} responses.")
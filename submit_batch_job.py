@@ -2,21 +2,49 @@ import os
 import argparse
 import json
 import logging
-from google.cloud import bigquery
-from google.cloud.exceptions import NotFound
-from google.auth import default
-from google.auth.transport.requests import Request
+import tempfile
 import requests
+from response_schema import read_templates, with_schema
+from jsonl_io import open_file
+from gcs_batch import SHARD_LINES, UPLOAD_WORKERS, Storage, write_request_shards
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Model configuration for every request in the batch
+GENERATION_CONFIG = {
+    "temperature": 0.5,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+    "response_mime_type": "application/json",
+}
+
 def get_auth_token():
+    # Imported here, like bigquery, so --dryrun and the planner need no Google Cloud libraries
+    from google.auth import default
+    from google.auth.transport.requests import Request
+
     credentials, _ = default()
     credentials.refresh(Request())
     return credentials.token
 
+def format_prompt(data, chat_prompt):
+    # Batch jobs send the whole document, untrimmed
+    text = data.get('text') or data.get('content')
+    return chat_prompt.format(content=text) if text else None
+
+def build_request(prompt, generation_config):
+    return {
+        "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+        "generation_config": generation_config,
+        "safety_settings": []
+    }
+
 def insert_rows_to_bigquery(client, dataset_name, table_name, rows, batch_size=500):
+    from google.cloud import bigquery
+    from google.cloud.exceptions import NotFound
+
     table_ref = client.dataset(dataset_name).table(table_name)
     try:
         client.get_table(table_ref)
@@ -42,7 +70,37 @@ def insert_rows_to_bigquery(client, dataset_name, table_name, rows, batch_size=5
     else:
         logging.info(f"Inserted {len(rows)} rows successfully.")
 
-def submit_batch_prediction_job(project_id, location, model_id, job_name, dataset_name, input_table_name, output_table_name):
+def bigquery_config(project_id, dataset_name, input_table_name, output_table_name):
+    input_config = {
+        "instancesFormat": "bigquery",
+        "bigquerySource": {
+            "inputUri": f"bq://{project_id}.{dataset_name}.{input_table_name}"
+        }
+    }
+    output_config = {
+        "predictionsFormat": "bigquery",
+        "bigqueryDestination": {
+            "outputUri": f"bq://{project_id}.{dataset_name}.{output_table_name}"
+        }
+    }
+    return input_config, output_config
+
+def gcs_config(input_uris, gcs_uri):
+    input_config = {
+        "instancesFormat": "jsonl",
+        "gcsSource": {
+            "uris": input_uris
+        }
+    }
+    output_config = {
+        "predictionsFormat": "jsonl",
+        "gcsDestination": {
+            "outputUriPrefix": f"{gcs_uri.rstrip('/')}/predictions"
+        }
+    }
+    return input_config, output_config
+
+def submit_batch_prediction_job(project_id, location, model_id, job_name, input_config, output_config):
     ENDPOINT = f"https://{location}-aiplatform.googleapis.com/v1/projects/{project_id}/locations/{location}/batchPredictionJobs"
     
     auth_token = get_auth_token()
@@ -56,18 +114,8 @@ def submit_batch_prediction_job(project_id, location, model_id, job_name, datase
         "name": job_name,
         "displayName": job_name,
         "model": f"projects/{project_id}/locations/{location}/publishers/google/models/{model_id}",
-        "inputConfig": {
-            "instancesFormat": "bigquery",
-            "bigquerySource": {
-                "inputUri": f"bq://{project_id}.{dataset_name}.{input_table_name}"
-            }
-        },
-        "outputConfig": {
-            "predictionsFormat": "bigquery",
-            "bigqueryDestination": {
-                "outputUri": f"bq://{project_id}.{dataset_name}.{output_table_name}"
-            }
-        }
+        "inputConfig": input_config,
+        "outputConfig": output_config
     }
     
     response = requests.post(ENDPOINT, headers=headers, json=payload)
@@ -78,33 +126,22 @@ def submit_batch_prediction_job(project_id, location, model_id, job_name, datase
     return job_id
 
 def process_json_file(json_lines_file, dataset_name, input_table_name, output_table_name, job_name, project_id, location, model_id, language, batch_size):
+    from google.cloud import bigquery
+
     client = bigquery.Client()
     
     # Load the templates from the template.json file
-    with open('template.json', 'r') as f:
-        templates = json.load(f)
+    templates, response_schemas = read_templates('template.json')
 
     chat_prompt = templates[language]
+    generation_config = with_schema(GENERATION_CONFIG, response_schemas[language])
 
-    with open(json_lines_file, 'r') as file:
+    with open_file(json_lines_file) as file:
         rows = []
         for line in file:
-            data = json.loads(line)
-            text = data.get('text') or data.get('content')
-            if text:
-                prompt = chat_prompt.format(content=text)
-                row = {"request": json.dumps({
-                    "contents": [{"role": "user", "parts": [{"text": prompt}]}],
-                    "generation_config": {
-                        "temperature": 0.5,
-                        "top_p": 0.95,
-                        "top_k": 40,
-                        "max_output_tokens": 8192,
-                        "response_mime_type": "application/json"
-                    },
-                    "safety_settings": []
-                })}
-                rows.append(row)
+            prompt = format_prompt(json.loads(line), chat_prompt)
+            if prompt:
+                rows.append({"request": json.dumps(build_request(prompt, generation_config))})
             else:
                 logging.error(f"Field 'text' or 'content' not found in line: {line}")
 
@@ -112,53 +149,78 @@ def process_json_file(json_lines_file, dataset_name, input_table_name, output_ta
     insert_rows_to_bigquery(client, dataset_name, input_table_name, rows, batch_size=batch_size)
 
     logging.info("Submitting batch prediction job...")
-    job_id = submit_batch_prediction_job(project_id, location, model_id, job_name, dataset_name, input_table_name, output_table_name)
+    job_id = submit_batch_prediction_job(project_id, location, model_id, job_name, *bigquery_config(project_id, dataset_name, input_table_name, output_table_name))
+    return job_id
+
+def iter_requests(json_lines_file, chat_prompt, generation_config):
+    # (line, request) for every line with text; the line number comes back with the prediction
+    with open_file(json_lines_file) as file:
+        for line_no, line in enumerate(file):
+            prompt = format_prompt(json.loads(line), chat_prompt)
+            if prompt:
+                yield line_no, build_request(prompt, generation_config)
+            else:
+                logging.error(f"Field 'text' or 'content' not found in line {line_no + 1}.")
+
+def process_json_file_gcs(json_lines_file, gcs_uri, job_name, project_id, location, model_id, language, shard_dir=None, shard_lines=SHARD_LINES, upload_workers=UPLOAD_WORKERS, compress=True, submit=True):
+    # Skips BigQuery: the requests are written to compressed JSONL files, uploaded to <gcs_uri>/requests
+    # and the job writes its predictions as JSONL under <gcs_uri>/predictions
+    templates, response_schemas = read_templates('template.json')
+    generation_config = with_schema(GENERATION_CONFIG, response_schemas[language])
+
+    shard_dir = shard_dir or tempfile.mkdtemp(prefix=f"{job_name}-")
+    paths = write_request_shards(iter_requests(json_lines_file, templates[language], generation_config), shard_dir, shard_lines, compress)
+    logging.info(f"Wrote {len(paths)} request files to {shard_dir}.")
+
+    logging.info("Uploading request files to Cloud Storage...")
+    input_uris = Storage().upload_all(paths, f"{gcs_uri.rstrip('/')}/requests", upload_workers)
+    if not submit:
+        return None
+
+    logging.info("Submitting batch prediction job...")
+    job_id = submit_batch_prediction_job(project_id, location, model_id, job_name, *gcs_config(input_uris, gcs_uri))
+    logging.info(f"When the job has succeeded, fetch the results with fetch_batch_predictions.py --predictions_uri {gcs_uri.rstrip('/')}/predictions")
     return job_id
 
 def main():
     parser = argparse.ArgumentParser(description="Submit a batch prediction job to Vertex AI.")
     parser.add_argument('--project_id', type=str, required=True, help='Google Cloud project ID.')
-    parser.add_argument('--dataset_name', type=str, required=True, help='BigQuery dataset name.')
-    parser.add_argument('--input_table_name', type=str, required=True, help='BigQuery input table name.')
-    parser.add_argument('--output_table_name', type=str, required=True, help='BigQuery output table name.')
+    parser.add_argument('--dataset_name', type=str, help='BigQuery dataset name (required without --gcs_uri).')
+    parser.add_argument('--input_table_name', type=str, help='BigQuery input table name (required without --gcs_uri).')
+    parser.add_argument('--output_table_name', type=str, help='BigQuery output table name (required without --gcs_uri).')
+    parser.add_argument('--gcs_uri', type=str, help='Cloud Storage prefix (gs://bucket/path) for JSONL requests and predictions instead of BigQuery tables.')
+    parser.add_argument('--shard_dir', type=str, help='Local directory for the request files with --gcs_uri (default: a temporary directory).')
+    parser.add_argument('--shard_lines', type=int, default=SHARD_LINES, help=f'Requests per request file with --gcs_uri (default: {SHARD_LINES}).')
+    parser.add_argument('--upload_workers', type=int, default=UPLOAD_WORKERS, help=f'Request files uploaded in parallel with --gcs_uri (default: {UPLOAD_WORKERS}).')
+    parser.add_argument('--no_compress', action='store_true', help='Write plain .jsonl request files instead of .jsonl.gz with --gcs_uri.')
+    parser.add_argument('--upload_only', action='store_true', help='With --gcs_uri, write and upload the request files without submitting the job.')
     parser.add_argument('--job_name', type=str, required=True, help='Name of the batch prediction job.')
     parser.add_argument('--input_jsonl_file', type=str, required=True, help='Path to the input JSONL file.')
     parser.add_argument('--language', type=str, choices=['en', 'sv', 'da', 'nb', 'nn'], default='en', help='Language for the prompt (default: en).')
     parser.add_argument('--model_id', type=str, required=True, help='Model ID to use for the prediction.')
     parser.add_argument('--location', type=str, required=True, help='Location of the Vertex AI endpoint.')
     parser.add_argument('--batch_size', type=int, default=500, help='Batch size for BigQuery inserts (default: 500).')
-    parser.add_argument('--dryrun', action='store_true', help='Output formatted example and do not execute the batch job.')
+    parser.add_argument('--dryrun', action='store_true', help='Output formatted example and do not execute the batch job. Use plan_run.py --script submit_batch_job for the cost of the whole file.')
 
     args = parser.parse_args()
+    if not args.gcs_uri and not (args.dataset_name and args.input_table_name and args.output_table_name):
+        parser.error("--dataset_name, --input_table_name and --output_table_name are required without --gcs_uri.")
 
     if args.dryrun:
-        with open(args.input_jsonl_file, 'r') as file:
+        # Load the templates from the template.json file
+        templates, response_schemas = read_templates('template.json')
+        with open_file(args.input_jsonl_file) as file:
             for line in file:
-                data = json.loads(line)
-                text = data.get('text') or data.get('content')
-                if text:
-                    # Load the templates from the template.json file
-                    with open('template.json', 'r') as f:
-                        templates = json.load(f)
-
-                    chat_prompt = templates[args.language]
-                    prompt = chat_prompt.format(content=text)
+                prompt = format_prompt(json.loads(line), templates[args.language])
+                if prompt:
                     formatted_example = {
-                        "request": json.dumps({
-                            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
-                            "generation_config": {
-                                "temperature": 0.5,
-                                "top_p": 0.95,
-                                "top_k": 40,
-                                "max_output_tokens": 8192,
-                                "response_mime_type": "application/json"
-                            },
-                            "safety_settings": []
-                        })
+                        "request": json.dumps(build_request(prompt, with_schema(GENERATION_CONFIG, response_schemas[args.language])))
                     }
                     logging.info("Dry run - formatted example:")
                     logging.info(json.dumps(formatted_example, indent=4))
                     break
+    elif args.gcs_uri:
+        process_json_file_gcs(args.input_jsonl_file, args.gcs_uri, args.job_name, args.project_id, args.location, args.model_id, args.language, args.shard_dir, args.shard_lines, args.upload_workers, not args.no_compress, not args.upload_only)
     else:
         process_json_file(args.input_jsonl_file, args.dataset_name, args.input_table_name, args.output_table_name, args.job_name, args.project_id, args.location, args.model_id, args.language, args.batch_size)
 
@@ -0,0 +1,112 @@
+import os
+import hashlib
+import logging
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+from jsonl_io import count_complete_lines
+from columnar_input import iter_records
+from itertools import islice
+
+# Rows tokenised per Arrow record batch when building the cache
+CACHE_CHUNK_SIZE = 8192
+# Bytes read from each end of the input for its cache key, unless --token_cache_full_hash hashes all of it
+FINGERPRINT_BYTES = 1 << 20
+
+SCHEMA = pa.schema([
+    ("input_ids", pa.list_(pa.int32())),
+    ("length", pa.int32()),
+])
+
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def file_fingerprint(path):
+    # Path, size and modification time, plus the first and last FINGERPRINT_BYTES; reads at most 2 MB
+    # however large the input, where file_hash reads all of it on every run
+    stat = os.stat(path)
+    sha = hashlib.sha256(f"{os.path.realpath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}".encode())
+    with open(path, 'rb') as f:
+        sha.update(f.read(FINGERPRINT_BYTES))
+        if stat.st_size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, stat.st_size - FINGERPRINT_BYTES))
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def token_cache_path(cache_dir, input_file, tokenizer_name, text_column, max_length, full_hash=False):
+    tokenizer_key = tokenizer_name.strip('/').replace('/', '--')
+    file_key = file_hash(input_file) if full_hash else file_fingerprint(input_file)
+    return os.path.join(cache_dir, f"{file_key[:16]}-{tokenizer_key}-{text_column}-{max_length}.arrow")
+
+def build_token_cache(cache_path, input_file, tokenizer, text_column, max_length):
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    rows = 0
+    # Parquet and Arrow inputs are read a row group at a time, text column only
+    reader = iter_records(input_file, [text_column])
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with ipc.new_file(sink, SCHEMA) as writer:
+            while True:
+                chunk = list(islice(reader, CACHE_CHUNK_SIZE))
+                if not chunk:
+                    break
+                encoded = tokenizer([record[text_column] for record in chunk], truncation=True, max_length=max_length)["input_ids"]
+                writer.write_batch(pa.record_batch([
+                    pa.array(encoded, type=pa.list_(pa.int32())),
+                    pa.array([len(ids) for ids in encoded], type=pa.int32()),
+                ], schema=SCHEMA))
+                rows += len(chunk)
+    # Only a complete cache ever appears under the final name
+    os.replace(tmp_path, cache_path)
+    logging.info(f"Wrote token cache with {rows} rows to {cache_path}.")
+
+def open_token_cache(cache_path, input_file, tokenizer, text_column, max_length):
+    if not os.path.exists(cache_path):
+        logging.info(f"No token cache at {cache_path}, tokenising {input_file}.")
+        build_token_cache(cache_path, input_file, tokenizer, text_column, max_length)
+    return map_token_cache(cache_path)
+
+def map_token_cache(cache_path):
+    # Memory-mapped read: batches are sliced straight out of the page cache
+    return ipc.open_file(pa.memory_map(cache_path, 'r')).read_all()
+
+def cached_inputs(table, start, end, pad_token_id):
+    import torch
+
+    lengths = table.column("length").slice(start, end - start).to_numpy()
+    ids = table.column("input_ids").slice(start, end - start).combine_chunks()
+    flat = ids.flatten().to_numpy(zero_copy_only=False)
+    width = int(lengths.max()) if len(lengths) else 0
+    mask = np.arange(width)[None, :] < lengths[:, None]
+    input_ids = np.full((len(lengths), width), pad_token_id, dtype=np.int64)
+    input_ids[mask] = flat
+    return {
+        "input_ids": torch.from_numpy(input_ids),
+        "attention_mask": torch.from_numpy(mask.astype(np.int64)),
+    }
+
+def resume_row(output_file):
+    # The row index sidecar records how many rows are done and how many bytes of output they occupy.
+    # Output written after the last checkpoint is truncated away so nothing is duplicated.
+    index_file = output_file + ".rowidx"
+    if not os.path.exists(index_file):
+        return count_complete_lines(output_file)
+    with open(index_file, 'r') as f:
+        row, size = (int(value) for value in f.read().split())
+    if os.path.exists(output_file) and os.path.getsize(output_file) > size:
+        os.truncate(output_file, size)
+    return row
+
+def save_row(output_file, row):
+    index_file = output_file + ".rowidx"
+    with open(index_file + ".tmp", 'w') as f:
+        f.write(f"{row} {os.path.getsize(output_file)}")
+    os.replace(index_file + ".tmp", index_file)
+
+def remove_row_index(output_file):
+    if os.path.exists(output_file + ".rowidx"):
+        os.remove(output_file + ".rowidx")